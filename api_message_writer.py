@@ -1,118 +1,406 @@
+import asyncio
+import configparser
+import logging
 import time
-from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
 
+import requests
 import urllib3
 
 from AretasPythonAPI.utils import Utils as AretasUtils
-from AretasPythonAPI.api_config import *
-from AretasPythonAPI.auth import *
-from AretasPythonAPI.sensor_data_ingest import *
+from app_config import AppConfig
+from log_utils import RATE_LIMITED
+from api_uploader import APIUploader, HTTPBatchTransport, TokenManager, AsyncAPIUploader, AsyncHTTPBatchTransport, \
+    AsyncTokenManager
+from message_spool import MessageSpool
+from metrics import REGISTRY, mark_startup
+from report_policy import ReportFilter, REPORT_NONE, REPORT_NOW
+from sensor_message_batch import SensorMessageBatch
 from sensor_message_item import SensorMessageItem
+from sink_queue import SinkQueue
+
+
+END_TO_END_SECONDS = REGISTRY.histogram("pmm_end_to_end_latency_seconds",
+                                        "Time from a reading's capture to its acknowledgement by the API")
+SPOOL_BACKLOG = REGISTRY.gauge("pmm_spool_backlog", "Undelivered datums in the spool")
+
+
+def get_ingest_url(config: configparser.ConfigParser) -> str:
+    return config.get('DEFAULT', 'API_URL') + config.get('API', 'api_ingest_path', fallback='sensordata/batch')
+
+
+def observe_end_to_end(batch: SensorMessageBatch):
+    now_ = AretasUtils.now_ms()
+    for n in range(len(batch)):
+        END_TO_END_SECONDS.observe((now_ - batch.get_timestamp(n)) / 1000)
 
 
 class APIMessageWriter(Thread):
     """
     This class writes the data to API
-    inject data into this class by enqueue_msg
+    It consumes its own SinkQueue (fed by the harvester) and adds the messages to the local buffer with enqueue_msg
     Create an instance of this Thread and run it
     Data will be sent every report_interval milliseconds as specified in the config
     This means that any new data arriving before the interval elapsed will overwrite what's
     sitting in the local buffer
+    Every reading goes through the ReportFilter first: readings within their deadband aren't reported unless
+    the heartbeat is due, readings crossing a threshold are sent immediately instead of at the next report
+    If the spool is enabled, every batch is written to it before sending, batches that couldn't be
+    delivered are replayed from it in large batches once the API is reachable again
+    The uploads themselves are handed to the APIUploader, so a slow request doesn't hold up this thread
     """
 
-    def __init__(self, sig_event: Event):
+    def __init__(self, sig_event: Event, sink_queue: SinkQueue, config: AppConfig = None):
 
         super(APIMessageWriter, self).__init__()
 
         self.logger = logging.getLogger(__name__)
         self.sig_event = sig_event
+        self.sink_queue = sink_queue
 
-        # read in the global app config
-        config = configparser.ConfigParser()
-        config.read('config.cfg')
+        if config is None:
+            config = AppConfig.load()
 
         self.last_message_time = 0
-        self.polling_interval = config.getint('API', 'report_interval')
+        self.polling_interval = config.report_interval
 
-        self.api_config = APIConfig()
-        self.api_auth = APIAuth(self.api_config)
-        self.api_writer = SensorDataIngest(self.api_auth)
+        # the Aretas API client is only loaded (and logs in) when it's first needed, on the TokenManager
+        # or uploader thread, so a slow or unreachable API doesn't hold up startup
+        self._api_auth = None
+        self._api_writer = None
+        self._api_lock = Lock()
+
+        # the upload engine, "legacy" (the default) goes through SensorDataIngest, the opt-in "pooled" posts
+        # over our own keep-alive session with gzip and a background token refresh, both get the retries
+        # and concurrency
+        self.upload_engine = config.upload_engine
+        self.token_manager = None
+        self.uploader = self.create_uploader(config)
+
+        # spool records that are currently being uploaded, so the drainer doesn't pick them up again
+        self._in_flight_seqs: set = set()
+        self._in_flight_lock = Lock()
+        self._draining = False
 
         # a hashmap of sensor messages we want to send to the API
-        self.to_send: dict([int, SensorMessageItem]) = dict()
+        self.to_send: dict[tuple, SensorMessageItem] = dict()
+
+        # the per sensor type deadband / heartbeat / threshold policies, and the readings that crossed
+        # a threshold and are waiting to go out of band
+        self.report_filter = ReportFilter(config)
+        self.urgent: dict[tuple, SensorMessageItem] = dict()
+        self._last_suppressed = 0
+
+        # the on-disk store and forward spool
+        self.spool = None
+        self.spool_enabled = config.getboolean('SPOOL', 'spool_enable', fallback=True)
+
+        if self.spool_enabled is True:
+            self.spool = MessageSpool(config.get('SPOOL', 'spool_dir', fallback='spool'),
+                                      config.getint('SPOOL', 'spool_segment_size', fallback=1048576),
+                                      config.getint('SPOOL', 'spool_max_bytes', fallback=104857600),
+                                      config.getint('SPOOL', 'spool_max_age', fallback=604800000),
+                                      config.getboolean('SPOOL', 'spool_fsync', fallback=True))
+
+        if self.spool is not None:
+            SPOOL_BACKLOG.set_function(self.spool.get_backlog_size)
 
-        self.thread_sleep = config.getboolean('DEFAULT', 'thread_sleep')
-        self.thread_sleep_time = config.getfloat('DEFAULT', 'thread_sleep_time')
+        # the backlog drain rate: at most drain_batch_size datums every drain_interval milliseconds
+        self.drain_batch_size = config.getint('SPOOL', 'drain_batch_size', fallback=500)
+        self.drain_interval = config.getint('SPOOL', 'drain_interval', fallback=1000)
+        self.last_drain_time = 0
 
-        self.is_sending = False
+        # we only drain the backlog while the API is reachable, we assume it is until a send fails
+        self.api_reachable = True
 
     def enqueue_msg(self, message: SensorMessageItem):
         """
         Enqueue a message to be sent, the message may or may not be sent as it may be overwritten
         by a new value before being sent
         This thread manages its own send intervals and this function just
-        adds the datum to a key/value store (indexed by sensor type)
-        As such the key/value store index for a particular sensor type just gets overwritten by new data
+        adds the datum to a key/value store (indexed by mac and sensor type)
+        As such the key/value store index for a particular mac and sensor type just gets overwritten by new data
         A flag is set in the dict entry to indicate if it has been sent or not
-        New messages added to the dict always have the is_sent flag set to False
+        New messages have the is_sent flag set to False unless the ReportFilter suppresses them, and a change
+        that's waiting for the report stays due whatever arrives after it
+        Only this thread touches the dict, so nothing gets dropped while we're sending
+        """
+        # every channel reports under its own mac, so one batch covers all of them
+        dict_key = (message.get_mac(), message.get_type())
+
+        decision = self.report_filter.evaluate(message.get_mac(), message.get_type(), message.get_data())
+        previous = self.to_send.get(dict_key)
+        due = (decision != REPORT_NONE) or ((previous is not None) and (previous.get_is_sent() is False))
+
+        message.set_is_sent(not due)
+        self.to_send[dict_key] = message
+
+        if decision == REPORT_NOW:
+            self.urgent[dict_key] = message
+
+    def apply_config(self, config: AppConfig):
+        """
+        Pick up the reloadable settings (see ConfigWatcher), the buffered messages, the spool and
+        the uploader's connections are kept
+        """
+        self.polling_interval = config.report_interval
+        self.drain_batch_size = config.getint('SPOOL', 'drain_batch_size', fallback=500)
+        self.drain_interval = config.getint('SPOOL', 'drain_interval', fallback=1000)
+        self.uploader.max_retries = config.getint('API', 'upload_max_retries', fallback=5)
+        self.uploader.backoff_base = config.getfloat('API', 'upload_backoff_base', fallback=1.0)
+        self.uploader.backoff_max = config.getfloat('API', 'upload_backoff_max', fallback=60.0)
+        self.report_filter.load_policies(config)
+
+    def create_uploader(self, config: AppConfig):
+        if self.upload_engine == 'pooled':
+            self.token_manager = TokenManager(self.fetch_token,
+                                              config.getfloat('API', 'token_refresh_interval', fallback=1800.0),
+                                              self.sig_event)
+            transport = HTTPBatchTransport(get_ingest_url(config),
+                                           self.token_manager,
+                                           config.getfloat('API', 'upload_timeout', fallback=30.0),
+                                           config.getint('API', 'upload_gzip_threshold', fallback=1024))
+        else:
+            transport = self.send_batch_to_api
+
+        return APIUploader(transport,
+                           self.sig_event,
+                           max_in_flight=config.getint('API', 'upload_max_in_flight', fallback=2),
+                           max_retries=config.getint('API', 'upload_max_retries', fallback=5),
+                           backoff_base=config.getfloat('API', 'upload_backoff_base', fallback=1.0),
+                           backoff_max=config.getfloat('API', 'upload_backoff_max', fallback=60.0),
+                           token_manager=self.token_manager,
+                           max_queued=config.getint('API', 'upload_max_queued', fallback=32))
+
+    def get_api_client(self) -> tuple:
+        """
+        @return: the (APIAuth, SensorDataIngest) pair, created on first use
+        """
+        with self._api_lock:
+            if self._api_writer is None:
+                from AretasPythonAPI.api_config import APIConfig
+                from AretasPythonAPI.auth import APIAuth
+                from AretasPythonAPI.sensor_data_ingest import SensorDataIngest
+
+                self._api_auth = APIAuth(APIConfig())
+                self._api_writer = SensorDataIngest(self._api_auth)
+            return self._api_auth, self._api_writer
+
+    def fetch_token(self):
+        """
+        Authenticate against the API, called from the TokenManager thread
         """
-        # don't accept new messages if we're in the process of sending
-        # it's unlikely this will ever happen but...
-        if self.is_sending is False:
-            dict_key = message.get_type()
-            # we're going to assert that it has not been sent
-            message.set_is_sent(False)
-            self.to_send[dict_key] = message
-        return
+        api_auth, _ = self.get_api_client()
+        token = api_auth.get_token()
+        if token:
+            mark_startup('api_token')
+        return token
 
     def run(self):
         """
         We send any of the messages in the self.to_send hashmap only if they have not
         been flagged as sent
         """
+        if self.token_manager is not None:
+            self.token_manager.start()
+
         while True:
-            if self.sig_event.is_set():
+            if self.sig_event.is_set() or self.sink_queue.is_closed():
                 self.logger.info("Exiting {}".format(self.__class__.__name__))
+                # nothing consumes the queue from here on, closing it releases a harvester blocked in put()
+                self.sink_queue.close()
+                self.uploader.close()
+                if self.spool is not None:
+                    self.spool.close()
                 break
 
-            # get the current time in milliseconds
-            now_ = AretasUtils.now_ms()
-
-            # determine if the polling interval has elapsed
-            if (now_ - self.last_message_time) >= self.polling_interval:
-                n_send = len(list(filter(lambda x: x.get_is_sent() is False, self.to_send.values())))
-                self.logger.info("Sending {} messages to API".format(n_send))
-                self.last_message_time = now_
-                # use the apiwriter
-                self.is_sending = True
-
-                # gather the items for the batch send
-                to_send_items = []
-
-                for key, message in self.to_send.items():
-                    # if it hasn't been previously sent, then send it
-                    if not message.get_is_sent():
-                        datum: dict = {
-                            'mac': message.get_mac(),
-                            'type': message.get_type(),
-                            'timestamp': message.get_timestamp(),
-                            'data': message.get_data()
-                        }
-
-                        to_send_items.append(datum)
-
-                # send as a batch then if sent, mark all as sent
-                if len(to_send_items) > 0:
-                    send_status = self.send_batch_to_api(to_send_items)
-                    if send_status is True:
-                        for key, message in self.to_send.items():
-                            message.set_is_sent(True)
-
-                else:
-                    if self.thread_sleep is True:
-                        time.sleep(self.thread_sleep_time)
-
-                self.is_sending = False
+            self.send_due()
+
+            # block on our queue until the next report (or drain) is due, buffering whatever arrives
+            # a shutdown closes the queue and wakes us immediately
+            wait_ms = self.get_next_deadline() - AretasUtils.now_ms()
+            if wait_ms > 0:
+                message = self.sink_queue.get(wait_ms / 1000)
+                if message is not None:
+                    self.enqueue_msg(message)
+                    for message in self.sink_queue.drain(self.sink_queue.capacity):
+                        self.enqueue_msg(message)
+
+    def send_due(self):
+        """
+        Send the report if the report interval has elapsed, otherwise replay some of the backlog if that's due
+        """
+        # get the current time in milliseconds
+        now_ = AretasUtils.now_ms()
+
+        # threshold crossings don't wait for the report interval
+        if len(self.urgent) > 0:
+            self.logger.info("Sending {} threshold crossings to API".format(len(self.urgent)), extra=RATE_LIMITED)
+            self.send_messages(list(self.urgent.values()), now_)
+            self.urgent.clear()
+
+        # determine if the polling interval has elapsed
+        if (now_ - self.last_message_time) >= self.polling_interval:
+            # anything that hasn't been previously sent, and the unchanged readings due for their heartbeat
+            messages = list()
+            heartbeats = 0
+            for key, message in self.to_send.items():
+                if not message.get_is_sent():
+                    messages.append(message)
+                elif self.report_filter.is_heartbeat_due(key[0], key[1], now_):
+                    messages.append(message)
+                    heartbeats += 1
+
+            self.logger.info("Sending {} messages to API ({} heartbeats, {} readings suppressed by deadband)".format(
+                len(messages), heartbeats, self.report_filter.suppressed - self._last_suppressed), extra=RATE_LIMITED)
+            self._last_suppressed = self.report_filter.suppressed
+            self.log_upload_stats()
+            self.last_message_time = now_
+
+            # send as a batch then if sent, mark all as sent
+            if len(messages) > 0:
+                self.send_messages(messages, now_)
+
+        elif (self.spool is not None) and (self.api_reachable is True) and (self._draining is False) and \
+                self.spool.has_backlog() and ((now_ - self.last_drain_time) >= self.drain_interval):
+            # live data always goes first, the backlog only gets the time between report intervals
+            self.last_drain_time = now_
+            self.drain_backlog()
+
+    def send_messages(self, messages: list[SensorMessageItem], now_: int):
+        """
+        Send the messages as one batch, they become the baseline for the deadbands and heartbeats
+        """
+        to_send_items = SensorMessageBatch()
+
+        for message in messages:
+            to_send_items.append_item(message)
+            self.report_filter.mark_reported(message.get_mac(), message.get_type(), message.get_data(), now_,
+                                             message.get_is_sent())
+
+        if self.spool is not None:
+            self.send_spooled(to_send_items, messages)
+        else:
+            self.send_unspooled(to_send_items, messages)
+
+    def log_upload_stats(self):
+        stats = self.uploader.get_stats()
+        self.logger.info("Uploads: {} sent {} failed {} retries {} in flight, {:.2f} datums/s, "
+                         "latency p50:{:.3f}s p95:{:.3f}s".format(stats['batches_sent'],
+                                                                   stats['batches_failed'],
+                                                                   stats['retries'],
+                                                                   stats['in_flight'],
+                                                                   stats['datums_per_second'],
+                                                                   stats['latency_p50'],
+                                                                   stats['latency_p95']),
+                         extra=RATE_LIMITED)
+
+    def get_next_deadline(self) -> int:
+        """
+        @return: the time (in milliseconds) of the next report or backlog drain
+        """
+        next_deadline = self.last_message_time + self.polling_interval
+        if (self.spool is not None) and (self.api_reachable is True) and (self._draining is False) and \
+                self.spool.has_backlog():
+            next_deadline = min(next_deadline, self.last_drain_time + self.drain_interval)
+        return next_deadline
+
+    def send_unspooled(self, to_send_items: SensorMessageBatch, messages: list[SensorMessageItem]):
+        """
+        Upload the batch without the spool, the messages are marked as sent once it's delivered
+        """
+        def on_done(send_status: bool):
+            self.api_reachable = send_status
+            if send_status is True:
+                observe_end_to_end(to_send_items)
+                for message in messages:
+                    message.set_is_sent(True)
+
+        self.uploader.submit(to_send_items.to_api_dicts(), on_done)
+
+    def send_spooled(self, to_send_items: SensorMessageBatch, messages: list[SensorMessageItem]):
+        """
+        Write the batch to the spool and then hand it to the uploader
+        Once it's in the spool the spool owns its delivery, so the messages are marked as sent either way
+        """
+        for message in messages:
+            message.set_is_sent(True)
+
+        self.submit_spooled(to_send_items, self.append_to_spool(to_send_items))
+
+    def append_to_spool(self, to_send_items: SensorMessageBatch):
+        """
+        Append the batch to the spool and mark it in flight, so the drainer doesn't pick it up
+        @return: its sequence number, or None if it couldn't be spooled
+        """
+        try:
+            seq = self.spool.append(to_send_items)
+        except OSError as e:
+            self.logger.error("Error writing batch to spool, sending without it:{}".format(e))
+            return None
+
+        with self._in_flight_lock:
+            self._in_flight_seqs.add(seq)
+        return seq
+
+    def submit_spooled(self, to_send_items: SensorMessageBatch, seq):
+        if seq is None:
+            self.uploader.submit(to_send_items.to_api_dicts(), None)
+            return
+
+        def on_done(send_status: bool):
+            self.api_reachable = send_status
+            if send_status is True:
+                observe_end_to_end(to_send_items)
+                self.ack_spooled([seq])
+            with self._in_flight_lock:
+                self._in_flight_seqs.discard(seq)
+
+        self.uploader.submit(to_send_items.to_api_dicts(), on_done)
+
+    def ack_spooled(self, seqs: list[int]):
+        self.spool.ack(seqs)
+
+    def drain_backlog(self):
+        """
+        Replay the oldest undelivered batches from the spool as one large batch
+        Only one replay is in flight at a time so the live data always has an upload slot
+        """
+        self._draining = True
+        self.submit_backlog(*self.read_spooled_backlog())
+
+    def read_spooled_backlog(self) -> tuple:
+        """
+        Read the next batches to replay and mark them in flight
+        @return: a (seqs, datums) tuple, see MessageSpool.read_backlog
+        """
+        with self._in_flight_lock:
+            exclude = set(self._in_flight_seqs)
+
+        seqs, datums = self.spool.read_backlog(self.drain_batch_size, exclude)
+
+        with self._in_flight_lock:
+            self._in_flight_seqs.update(seqs)
+        return seqs, datums
+
+    def submit_backlog(self, seqs: list[int], datums: list[dict]):
+        if len(datums) == 0:
+            self._draining = False
+            return
+
+        self.logger.info("Replaying {} spooled messages ({} remaining)".format(
+            len(datums), self.spool.get_backlog_size()), extra=RATE_LIMITED)
+
+        def on_done(send_status: bool):
+            self.api_reachable = send_status
+            if send_status is True:
+                self.ack_spooled(seqs)
+            with self._in_flight_lock:
+                self._in_flight_seqs.difference_update(seqs)
+            self._draining = False
+
+        self.uploader.submit(datums, on_done)
 
     def send_batch_to_api(self, batch: list[dict]) -> bool:
         """
@@ -121,7 +409,8 @@ class APIMessageWriter(Thread):
         """
         try:
             # we're using the token self-management function
-            err = self.api_writer.send_data(batch, True)
+            _, api_writer = self.get_api_client()
+            err = api_writer.send_data(batch, True)
             if err is False:
                 self.logger.error("Error sending messages, aborting rest")
                 return False
@@ -151,3 +440,102 @@ class APIMessageWriter(Thread):
         except Exception as e:
             self.logger.error("Unknown exception trying to send messages to API:{}".format(e))
             return False
+
+
+class AsyncAPIMessageWriter(APIMessageWriter):
+    """
+    The API writer for the asyncio runtime (see async_runtime)
+    Buffering, spooling and backlog replay work exactly as in APIMessageWriter, the batches are
+    uploaded by an AsyncAPIUploader (over aiohttp with the pooled engine) on the event loop
+    The spool (fsync'ed appends and acks, backlog reads) is only ever touched from one spool worker thread,
+    so the loop never waits on the disk and the batches are still spooled and submitted in order
+    """
+
+    def __init__(self, sig_event: Event, sink_queue: SinkQueue, config: AppConfig = None):
+        super(AsyncAPIMessageWriter, self).__init__(sig_event, sink_queue, config)
+
+        self._spool_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Spool")
+        # the spooling tasks still waiting on the spool worker
+        self._spool_tasks: set = set()
+
+    def run_spooled(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._spool_tasks.add(task)
+        task.add_done_callback(self._spool_tasks.discard)
+
+    def send_spooled(self, to_send_items: SensorMessageBatch, messages: list[SensorMessageItem]):
+        for message in messages:
+            message.set_is_sent(True)
+
+        self.run_spooled(self.send_spooled_async(to_send_items))
+
+    async def send_spooled_async(self, to_send_items: SensorMessageBatch):
+        # the spool worker runs the appends in order and the tasks resume in that order, so they're submitted in order
+        seq = await asyncio.get_running_loop().run_in_executor(self._spool_executor, self.append_to_spool,
+                                                               to_send_items)
+        self.submit_spooled(to_send_items, seq)
+
+    def ack_spooled(self, seqs: list[int]):
+        self._spool_executor.submit(self.spool.ack, seqs)
+
+    def drain_backlog(self):
+        self._draining = True
+        self.run_spooled(self.drain_backlog_async())
+
+    async def drain_backlog_async(self):
+        seqs, datums = await asyncio.get_running_loop().run_in_executor(self._spool_executor,
+                                                                        self.read_spooled_backlog)
+        self.submit_backlog(seqs, datums)
+
+    def create_uploader(self, config: AppConfig):
+        if self.upload_engine == 'pooled':
+            self.token_manager = AsyncTokenManager(self.fetch_token,
+                                                   config.getfloat('API', 'token_refresh_interval', fallback=1800.0))
+            transport = AsyncHTTPBatchTransport(get_ingest_url(config),
+                                                self.token_manager,
+                                                config.getfloat('API', 'upload_timeout', fallback=30.0),
+                                                config.getint('API', 'upload_gzip_threshold', fallback=1024))
+        else:
+            transport = self.send_batch_to_api_async
+
+        return AsyncAPIUploader(transport,
+                                max_in_flight=config.getint('API', 'upload_max_in_flight', fallback=2),
+                                max_retries=config.getint('API', 'upload_max_retries', fallback=5),
+                                backoff_base=config.getfloat('API', 'upload_backoff_base', fallback=1.0),
+                                backoff_max=config.getfloat('API', 'upload_backoff_max', fallback=60.0),
+                                token_manager=self.token_manager)
+
+    async def send_batch_to_api_async(self, batch: list[dict]) -> bool:
+        # SensorDataIngest is blocking
+        return await asyncio.get_running_loop().run_in_executor(None, self.send_batch_to_api, batch)
+
+    async def run_async(self):
+        token_task = None
+        if self.token_manager is not None:
+            token_task = asyncio.get_running_loop().create_task(self.token_manager.run())
+
+        try:
+            while (self.sig_event.is_set() is False) and (self.sink_queue.is_closed() is False):
+                self.send_due()
+
+                # wait on our queue until the next report (or drain) is due, buffering whatever arrives
+                # a shutdown closes the queue and wakes us immediately
+                wait_ms = self.get_next_deadline() - AretasUtils.now_ms()
+                if wait_ms > 0:
+                    message = await self.sink_queue.get_async(wait_ms / 1000)
+                    if message is not None:
+                        self.enqueue_msg(message)
+                        for message in self.sink_queue.drain(self.sink_queue.capacity):
+                            self.enqueue_msg(message)
+        finally:
+            self.logger.info("Exiting {}".format(self.__class__.__name__))
+            # the batches still being spooled are submitted before the uploader closes
+            if len(self._spool_tasks) > 0:
+                await asyncio.gather(*self._spool_tasks, return_exceptions=True)
+            await self.uploader.close()
+            if token_task is not None:
+                token_task.cancel()
+            # then the acks the uploads queued on the spool worker are written out
+            await asyncio.get_running_loop().run_in_executor(None, self._spool_executor.shutdown)
+            if self.spool is not None:
+                self.spool.close()
@@ -0,0 +1,606 @@
+import asyncio
+import gzip
+import json
+import logging
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Event, Thread, Lock
+
+import requests
+
+from log_utils import RATE_LIMITED
+from metrics import REGISTRY, SIZE_BUCKETS
+
+UPLOAD_SECONDS = REGISTRY.histogram("pmm_upload_seconds", "Time to deliver a batch, including retries")
+UPLOAD_BATCH_SIZE = REGISTRY.histogram("pmm_upload_batch_size", "Datums per uploaded batch", buckets=SIZE_BUCKETS)
+UPLOAD_FAILURES = REGISTRY.counter("pmm_upload_failures_total", "Batches abandoned after all retries")
+UPLOAD_RETRIES = REGISTRY.counter("pmm_upload_retries_total", "Upload attempts that were retried")
+UPLOAD_IN_FLIGHT = REGISTRY.gauge("pmm_upload_in_flight", "Batches currently being uploaded")
+
+
+class UploadError(Exception):
+    """
+    A failed upload attempt, retryable tells the uploader whether trying again could help
+    """
+
+    def __init__(self, message: str, retryable: bool = True, auth_failed: bool = False):
+        super(UploadError, self).__init__(message)
+        self.retryable = retryable
+        self.auth_failed = auth_failed
+
+
+def encode_batch(datums: list[dict], gzip_threshold: int) -> tuple:
+    """
+    @return: the (raw payload, request body, extra headers) for a batch, gzipped at gzip_threshold bytes or more
+    """
+    payload = json.dumps(datums, separators=(',', ':')).encode('utf-8')
+    headers = dict()
+
+    body = payload
+    if len(payload) >= gzip_threshold:
+        body = gzip.compress(payload, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+
+    return payload, body, headers
+
+
+def check_status(status_code: int):
+    """
+    Raise the UploadError matching a non successful HTTP status
+    """
+    if status_code == 401:
+        raise UploadError("Token rejected", retryable=True, auth_failed=True)
+    if (status_code == 429) or (status_code >= 500):
+        raise UploadError("Server returned {}".format(status_code))
+    if status_code >= 300:
+        raise UploadError("Server returned {}".format(status_code), retryable=False)
+
+
+def get_backoff(attempt: int, backoff_base: float, backoff_max: float) -> float:
+    # "full jitter", spreads out the retries of units that lost connectivity at the same time
+    return random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+
+
+class UploadStats:
+    """
+    The upload counters and recent latencies behind get_stats(), shared by both upload engines
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.batches_sent = 0
+        self.batches_failed = 0
+        self.datums_sent = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=1000)
+        self.start_time = time.monotonic()
+
+    def record_sent(self, n_datums: int, latency: float):
+        with self._lock:
+            self.batches_sent += 1
+            self.datums_sent += n_datums
+            self.latencies.append(latency)
+        UPLOAD_SECONDS.observe(latency)
+        UPLOAD_BATCH_SIZE.observe(n_datums)
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+        UPLOAD_RETRIES.inc()
+
+    def record_failed(self):
+        with self._lock:
+            self.batches_failed += 1
+        UPLOAD_FAILURES.inc()
+
+    def get_stats(self, in_flight: int) -> dict:
+        with self._lock:
+            latencies = sorted(self.latencies)
+            elapsed = max(time.monotonic() - self.start_time, 0.001)
+            stats = {
+                'batches_sent': self.batches_sent,
+                'batches_failed': self.batches_failed,
+                'datums_sent': self.datums_sent,
+                'retries': self.retries,
+                'in_flight': in_flight,
+                'datums_per_second': self.datums_sent / elapsed,
+                'latency_p50': 0.0,
+                'latency_p95': 0.0
+            }
+
+        if len(latencies) > 0:
+            stats['latency_p50'] = latencies[len(latencies) // 2]
+            stats['latency_p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+        return stats
+
+
+class TokenManager(Thread):
+    """
+    Keeps a bearer token fresh in the background so uploads never wait on authentication
+    The token is fetched once up front and then refreshed every refresh_interval seconds,
+    or immediately when an upload reports the token was rejected
+    """
+
+    def __init__(self, token_provider, refresh_interval: float, sig_event: Event):
+        super(TokenManager, self).__init__(name="TokenManager", daemon=True)
+
+        self.logger = logging.getLogger(__name__)
+        self.token_provider = token_provider
+        self.refresh_interval = refresh_interval
+        self.sig_event = sig_event
+
+        self._token = None
+        self._have_token = Event()
+        self._refresh_now = Event()
+
+    def get_token(self, timeout: float = None):
+        """
+        @return: the current token, waiting up to timeout seconds for the first one
+        """
+        self._have_token.wait(timeout)
+        return self._token
+
+    def invalidate(self):
+        self._refresh_now.set()
+
+    def refresh(self):
+        try:
+            token = self.token_provider()
+            if token:
+                self._token = token
+                self._have_token.set()
+            else:
+                self.logger.error("Token refresh returned no token")
+        except Exception as e:
+            self.logger.error("Error refreshing API token:{}".format(e))
+
+    def run(self):
+        while not self.sig_event.is_set():
+            self.refresh()
+            # retry quickly until we get a first token, then settle into the refresh interval
+            wait_time = self.refresh_interval if self._have_token.is_set() else 5.0
+            self._refresh_now.wait(wait_time)
+            self._refresh_now.clear()
+
+
+class HTTPBatchTransport:
+    """
+    Posts JSON batches over a persistent keep-alive session, gzipping payloads above gzip_threshold bytes
+    """
+
+    def __init__(self, url: str, token_manager: TokenManager, timeout: float, gzip_threshold: int):
+        self.url = url
+        self.token_manager = token_manager
+        self.timeout = timeout
+        self.gzip_threshold = gzip_threshold
+
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+        self._lock = Lock()
+        self.bytes_raw = 0
+        self.bytes_sent = 0
+
+    def __call__(self, datums: list[dict]):
+        payload, body, headers = encode_batch(datums, self.gzip_threshold)
+
+        token = self.token_manager.get_token(self.timeout)
+        if token is None:
+            raise UploadError("No API token available")
+        headers['Authorization'] = "Bearer {}".format(token)
+
+        try:
+            response = self.session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise UploadError("Connection error:{}".format(e))
+
+        with self._lock:
+            self.bytes_raw += len(payload)
+            self.bytes_sent += len(body)
+
+        check_status(response.status_code)
+
+
+class APIUploader:
+    """
+    The upload engine for the API writer
+     * up to max_in_flight batches are uploaded concurrently by a small worker pool
+     * a batch waits for the earlier batches that share one of its (mac, type) keys, so per sensor ordering
+       is preserved, without holding up the caller or a worker
+     * failed attempts are retried with jittered exponential backoff
+    The transport is a callable taking the list of datums which raises UploadError (or returns False) on failure
+    """
+
+    def __init__(self, transport, sig_event: Event, max_in_flight: int = 2, max_retries: int = 5,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0, token_manager: TokenManager = None,
+                 max_queued: int = 32):
+
+        self.logger = logging.getLogger(__name__)
+
+        self.transport = transport
+        self.sig_event = sig_event
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.token_manager = token_manager
+        self.max_queued = max_queued
+
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="APIUploader")
+        self._lock = Lock()
+        self._in_flight = 0
+        # batches submitted but not uploading yet
+        self._queued = 0
+        # the last batch submitted for each (mac, type)
+        self._last_for_key = dict()
+        self._closed = False
+
+        self.stats = UploadStats()
+
+        UPLOAD_IN_FLIGHT.set_function(lambda: self._in_flight)
+
+    def submit(self, datums: list[dict], callback=None) -> Future:
+        """
+        Queue a batch for upload, returns immediately
+        It starts once an upload slot is free and the earlier batches with one of its (mac, type) keys are done
+        With max_queued batches already waiting (e.g. the API has been down for a while) the batch is abandoned
+        straight away, it's still in the spool (or its messages are still unsent) so nothing is lost
+        @param callback: called with True/False once the batch is delivered or abandoned
+        """
+        keys = set((datum['mac'], datum['type']) for datum in datums)
+        future = Future()
+
+        with self._lock:
+            abandon = self._closed or (self._queued >= self.max_queued)
+            if not abandon:
+                self._queued += 1
+                previous = set(self._last_for_key[key] for key in keys if key in self._last_for_key)
+                for key in keys:
+                    self._last_for_key[key] = future
+
+        if abandon:
+            self.logger.info("{} batches waiting to upload, abandoning a batch of {} datums".format(
+                self._queued, len(datums)), extra=RATE_LIMITED)
+            self._complete(future, set(), False, callback)
+            return future
+
+        if len(previous) == 0:
+            self._start(future, datums, keys, callback)
+            return future
+
+        waiting = [len(previous)]
+
+        def on_previous_done(_):
+            with self._lock:
+                waiting[0] -= 1
+                ready = waiting[0] == 0
+            if ready:
+                self._start(future, datums, keys, callback)
+
+        for previous_future in previous:
+            previous_future.add_done_callback(on_previous_done)
+
+        return future
+
+    def _start(self, future: Future, datums: list[dict], keys: set, callback):
+        try:
+            if self._closed:
+                raise RuntimeError("closed")
+            self._executor.submit(self._upload, future, datums, keys, callback)
+        except RuntimeError:
+            # we're shutting down, the batch stays in the spool
+            with self._lock:
+                self._queued -= 1
+            self._complete(future, keys, False, callback)
+
+    def _upload(self, future: Future, datums: list[dict], keys: set, callback) -> bool:
+        with self._lock:
+            self._queued -= 1
+            self._in_flight += 1
+
+        status = False
+        try:
+            status = self.send(datums)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._complete(future, keys, status, callback)
+
+        return status
+
+    def _complete(self, future: Future, keys: set, status: bool, callback):
+        with self._lock:
+            for key in keys:
+                if self._last_for_key.get(key) is future:
+                    del self._last_for_key[key]
+
+        if callback is not None:
+            try:
+                callback(status)
+            except Exception as e:
+                self.logger.error("Error in upload callback:{}".format(e))
+
+        # the batches waiting on this one start from here
+        future.set_result(status)
+
+    def get_backoff(self, attempt: int) -> float:
+        return get_backoff(attempt, self.backoff_base, self.backoff_max)
+
+    def send(self, datums: list[dict]) -> bool:
+        """
+        Upload a batch synchronously, retrying with backoff
+        @return: True if the batch was delivered
+        """
+        start = time.monotonic()
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = self.transport(datums)
+                if result is False:
+                    raise UploadError("Transport reported failure")
+
+                self.stats.record_sent(len(datums), time.monotonic() - start)
+                return True
+
+            except UploadError as e:
+                self.logger.error("Upload attempt {} of {} datums failed:{}".format(attempt + 1, len(datums), e))
+                if (e.auth_failed is True) and (self.token_manager is not None):
+                    self.token_manager.invalidate()
+                if e.retryable is False:
+                    break
+
+            except Exception as e:
+                self.logger.error("Unknown exception uploading {} datums:{}".format(len(datums), e))
+
+            if attempt < self.max_retries:
+                self.stats.record_retry()
+                # the event wakes us on shutdown, we give up on the batch then (it stays in the spool)
+                if self.sig_event.wait(self.get_backoff(attempt)):
+                    break
+
+        self.stats.record_failed()
+        return False
+
+    def get_stats(self) -> dict:
+        return self.stats.get_stats(self._in_flight)
+
+    def close(self):
+        """
+        Let the uploads in flight finish (the ones backing off give up), the batches still waiting are abandoned
+        """
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=True)
+
+
+class AsyncTokenManager:
+    """
+    The TokenManager of the asyncio runtime, refresh() runs the (blocking) token provider on an executor
+    Start run() as a task and cancel it on shutdown
+    """
+
+    def __init__(self, token_provider, refresh_interval: float):
+        self.logger = logging.getLogger(__name__)
+        self.token_provider = token_provider
+        self.refresh_interval = refresh_interval
+
+        self._token = None
+        self._have_token = asyncio.Event()
+        self._refresh_now = asyncio.Event()
+
+    async def get_token(self, timeout: float = None):
+        """
+        @return: the current token, waiting up to timeout seconds for the first one
+        """
+        try:
+            await asyncio.wait_for(self._have_token.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self._token
+
+    def invalidate(self):
+        self._refresh_now.set()
+
+    async def refresh(self):
+        try:
+            token = await asyncio.get_running_loop().run_in_executor(None, self.token_provider)
+            if token:
+                self._token = token
+                self._have_token.set()
+            else:
+                self.logger.error("Token refresh returned no token")
+        except Exception as e:
+            self.logger.error("Error refreshing API token:{}".format(e))
+
+    async def run(self):
+        while True:
+            await self.refresh()
+            # retry quickly until we get a first token, then settle into the refresh interval
+            wait_time = self.refresh_interval if self._have_token.is_set() else 5.0
+            try:
+                await asyncio.wait_for(self._refresh_now.wait(), wait_time)
+            except asyncio.TimeoutError:
+                pass
+            self._refresh_now.clear()
+
+
+class AsyncHTTPBatchTransport:
+    """
+    The HTTPBatchTransport of the asyncio runtime, posts over an aiohttp keep-alive session
+    """
+
+    def __init__(self, url: str, token_manager: AsyncTokenManager, timeout: float, gzip_threshold: int):
+        # only the asyncio runtime needs aiohttp
+        import aiohttp
+
+        self.aiohttp = aiohttp
+        self.url = url
+        self.token_manager = token_manager
+        self.timeout = timeout
+        self.gzip_threshold = gzip_threshold
+
+        # the session has to be created on the running event loop, so it's opened on the first upload
+        self.session = None
+
+        self.bytes_raw = 0
+        self.bytes_sent = 0
+
+    async def __call__(self, datums: list[dict]):
+        payload, body, headers = encode_batch(datums, self.gzip_threshold)
+        headers['Content-Type'] = 'application/json'
+
+        token = await self.token_manager.get_token(self.timeout)
+        if token is None:
+            raise UploadError("No API token available")
+        headers['Authorization'] = "Bearer {}".format(token)
+
+        if self.session is None:
+            self.session = self.aiohttp.ClientSession(timeout=self.aiohttp.ClientTimeout(total=self.timeout))
+
+        try:
+            async with self.session.post(self.url, data=body, headers=headers) as response:
+                status_code = response.status
+        except (self.aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise UploadError("Connection error:{}".format(e))
+
+        self.bytes_raw += len(payload)
+        self.bytes_sent += len(body)
+
+        check_status(status_code)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class AsyncAPIUploader:
+    """
+    The APIUploader of the asyncio runtime, every batch is uploaded by its own task
+     * at most max_in_flight batches are uploading at once
+     * a batch waits for the earlier batches that share one of its (mac, type) keys, so per sensor ordering is preserved
+     * failed attempts are retried with jittered exponential backoff
+    The transport is an async callable taking the list of datums which raises UploadError (or returns False) on failure
+    submit() doesn't block, so it has to be called from the event loop
+    """
+
+    def __init__(self, transport, max_in_flight: int = 2, max_retries: int = 5, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0, token_manager: AsyncTokenManager = None):
+
+        self.logger = logging.getLogger(__name__)
+
+        self.transport = transport
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.token_manager = token_manager
+
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._in_flight = 0
+        # the last batch submitted for each (mac, type)
+        self._last_for_key = dict()
+        self._tasks: set = set()
+        self._closing = asyncio.Event()
+
+        self.stats = UploadStats()
+
+        UPLOAD_IN_FLIGHT.set_function(lambda: self._in_flight)
+
+    def submit(self, datums: list[dict], callback=None) -> asyncio.Task:
+        """
+        Start the upload of a batch
+        @param callback: called with True/False once the batch is delivered or abandoned
+        """
+        keys = set((datum['mac'], datum['type']) for datum in datums)
+        previous = set(self._last_for_key[key] for key in keys if key in self._last_for_key)
+
+        task = asyncio.get_running_loop().create_task(self._upload(datums, previous, callback))
+
+        for key in keys:
+            self._last_for_key[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._forget(done, keys))
+
+        return task
+
+    def _forget(self, task: asyncio.Task, keys: set):
+        self._tasks.discard(task)
+        for key in keys:
+            if self._last_for_key.get(key) is task:
+                del self._last_for_key[key]
+
+    async def _upload(self, datums: list[dict], previous: set, callback) -> bool:
+        if len(previous) > 0:
+            await asyncio.wait(previous)
+
+        async with self._slots:
+            self._in_flight += 1
+            try:
+                status = await self.send(datums)
+            finally:
+                self._in_flight -= 1
+
+        if callback is not None:
+            try:
+                callback(status)
+            except Exception as e:
+                self.logger.error("Error in upload callback:{}".format(e))
+
+        return status
+
+    def get_backoff(self, attempt: int) -> float:
+        return get_backoff(attempt, self.backoff_base, self.backoff_max)
+
+    async def send(self, datums: list[dict]) -> bool:
+        """
+        Upload a batch, retrying with backoff
+        @return: True if the batch was delivered
+        """
+        start = time.monotonic()
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = await self.transport(datums)
+                if result is False:
+                    raise UploadError("Transport reported failure")
+
+                self.stats.record_sent(len(datums), time.monotonic() - start)
+                return True
+
+            except UploadError as e:
+                self.logger.error("Upload attempt {} of {} datums failed:{}".format(attempt + 1, len(datums), e))
+                if (e.auth_failed is True) and (self.token_manager is not None):
+                    self.token_manager.invalidate()
+                if e.retryable is False:
+                    break
+
+            except Exception as e:
+                self.logger.error("Unknown exception uploading {} datums:{}".format(len(datums), e))
+
+            if attempt < self.max_retries:
+                self.stats.record_retry()
+                # closing wakes us, we give up on the batch then (it stays in the spool)
+                try:
+                    await asyncio.wait_for(self._closing.wait(), self.get_backoff(attempt))
+                    break
+                except asyncio.TimeoutError:
+                    pass
+
+        self.stats.record_failed()
+        return False
+
+    def get_stats(self) -> dict:
+        return self.stats.get_stats(self._in_flight)
+
+    async def close(self):
+        """
+        Let the uploads in flight finish (the ones backing off give up) and close the transport
+        """
+        self._closing.set()
+        if len(self._tasks) > 0:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if hasattr(self.transport, 'close'):
+            await self.transport.close()
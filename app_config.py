@@ -0,0 +1,305 @@
+import configparser
+import logging
+import os
+from threading import Event, Thread
+from deadline_scheduler import OVERRUN_POLICIES
+from edge_analytics import get_analytics_types
+from report_policy import ReportFilter
+from sensor_message_item import MAX_MAC_LENGTH
+from sink_queue import OVERFLOW_POLICIES
+
+CONFIG_FILE = 'config.cfg'
+
+RUNTIMES = ("threads", "asyncio", "processes")
+
+# "legacy" (SensorDataIngest) is the default, "pooled" speaks an assumed batch protocol, see the README
+UPLOAD_ENGINES = ("legacy", "pooled")
+
+# the settings that are applied live on a reload, any other change needs a restart
+# (section, key), a section ending in ":" covers every section with that prefix
+RELOADABLE = {
+    ('SERIAL', 'sample_interval'),
+    ('SERIAL', 'read_timeout'),
+    ('SERIAL', 'read_budget'),
+    ('SERIAL', 'reconnect_after'),
+    ('SERIAL', 'reconnect_backoff_min'),
+    ('SERIAL', 'reconnect_backoff_max'),
+    ('SERIAL', 'max_pair_skew'),
+    ('XDM', 'xdm_shunt_resistance'),
+    ('XDM', 'xdm_current_reverse_polarity'),
+    ('CHANNEL:', 'xdm_shunt_resistance'),
+    ('CHANNEL:', 'xdm_current_reverse_polarity'),
+    ('API', 'report_interval'),
+    ('API', 'upload_max_retries'),
+    ('API', 'upload_backoff_base'),
+    ('API', 'upload_backoff_max'),
+    ('SPOOL', 'drain_batch_size'),
+    ('SPOOL', 'drain_interval'),
+    ('REPORT:', '*'),
+    ('REDIS', 'redis_batch_size'),
+    ('REDIS', 'redis_ts_maxlen'),
+    ('REDIS', 'redis_ts_retention'),
+    ('STORE', 'store_flush_interval'),
+    ('STORE', 'store_retention'),
+    ('LOGGING', 'log_level'),
+    ('DEFAULT', 'config_reload_interval')
+}
+
+
+def is_reloadable(section: str, key: str) -> bool:
+    for reloadable_section, reloadable_key in RELOADABLE:
+        if reloadable_section.endswith(":"):
+            matches_section = section.startswith(reloadable_section)
+        else:
+            matches_section = section == reloadable_section
+        if matches_section and (reloadable_key in ('*', key)):
+            return True
+    return False
+
+
+class AppConfig(configparser.ConfigParser):
+    """
+    The daemon's configuration, read and validated once at startup and handed to every component
+    The settings most components share are typed attributes, the rest is read through the ConfigParser
+    interface as before (the [CHANNEL:*], [SINK:*], [REPORT:*] sections...)
+    A bad config raises a ValueError listing every problem, rather than failing in whichever thread reads it first
+    """
+
+    def __init__(self, path: str = CONFIG_FILE):
+        super(AppConfig, self).__init__()
+        self.path = path
+
+        # the typed settings start at validate()'s fallbacks, so a config that was never validated still has
+        # them all, sample_interval and report_interval have no fallback and start at config.cfg.example's values
+        self.runtime = RUNTIMES[0]
+        self.config_reload_interval = 5000
+        self.sample_interval = 5000
+        self.read_timeout = 5.0
+        self.read_budget = 1.0
+        self.max_pair_skew = 250
+        self.high_rate_mode = False
+        self.report_interval = 20000
+        self.upload_engine = UPLOAD_ENGINES[0]
+
+    @staticmethod
+    def load(path: str = CONFIG_FILE) -> 'AppConfig':
+        config = AppConfig(path)
+        if len(config.read(path)) == 0:
+            raise ValueError("Could not read {}".format(path))
+        config.validate()
+        return config
+
+    def validate(self):
+        errors = []
+
+        def check(description: str, getter, condition=None, message: str = None):
+            try:
+                value = getter()
+            except (ValueError, configparser.Error) as e:
+                errors.append("{}: {}".format(description, e))
+                return None
+            if (condition is not None) and (not condition(value)):
+                errors.append("{}: {}".format(description, message))
+            return value
+
+        self.runtime = check("runtime", lambda: self.get('DEFAULT', 'runtime', fallback='threads'),
+                             lambda value: value in RUNTIMES, "expected one of {}".format(RUNTIMES))
+        self.config_reload_interval = check(
+            "config_reload_interval", lambda: self.getint('DEFAULT', 'config_reload_interval', fallback=5000),
+            lambda value: value >= 0, "can't be negative")
+
+        self.sample_interval = check("sample_interval", lambda: self.getint('SERIAL', 'sample_interval'),
+                                     lambda value: value > 0, "has to be positive")
+        self.read_timeout = check("read_timeout", lambda: self.getfloat('SERIAL', 'read_timeout', fallback=5.0),
+                                  lambda value: value > 0, "has to be positive")
+        self.read_budget = check("read_budget", lambda: self.getfloat('SERIAL', 'read_budget', fallback=1.0),
+                                 lambda value: value > 0, "has to be positive")
+        check("reconnect_after", lambda: self.getint('SERIAL', 'reconnect_after', fallback=3),
+              lambda value: value > 0, "has to be positive")
+        check("reconnect_backoff_min", lambda: self.getfloat('SERIAL', 'reconnect_backoff_min', fallback=1.0),
+              lambda value: value > 0, "has to be positive")
+        check("reconnect_backoff_max", lambda: self.getfloat('SERIAL', 'reconnect_backoff_max', fallback=30.0),
+              lambda value: value >= self.getfloat('SERIAL', 'reconnect_backoff_min', fallback=1.0),
+              "can't be less than reconnect_backoff_min")
+        self.max_pair_skew = check("max_pair_skew", lambda: self.getint('SERIAL', 'max_pair_skew', fallback=250),
+                                   lambda value: value >= 0, "can't be negative")
+        self.high_rate_mode = check("high_rate_mode",
+                                    lambda: self.getboolean('SERIAL', 'high_rate_mode', fallback=False))
+        check("sample_overrun_policy", lambda: self.get('SERIAL', 'sample_overrun_policy', fallback='skip'),
+              lambda value: value in OVERRUN_POLICIES, "expected one of {}".format(OVERRUN_POLICIES))
+
+        self.report_interval = check("report_interval", lambda: self.getint('API', 'report_interval'),
+                                     lambda value: value > 0, "has to be positive")
+        self.upload_engine = check("upload_engine", lambda: self.get('API', 'upload_engine', fallback='legacy'),
+                                   lambda value: value in UPLOAD_ENGINES, "expected one of {}".format(UPLOAD_ENGINES))
+
+        for section in self.get_meter_sections():
+            for kind in ("current", "voltage"):
+                if check("[{}] xdm_{}_enable".format(section, kind),
+                         lambda: self.getboolean(section, 'xdm_{}_enable'.format(kind), fallback=False)) is True:
+                    # a meter is found by its port or by its USB serial number
+                    check("[{}] xdm_{}_port".format(section, kind),
+                          lambda: self.get(section, 'xdm_{}_port'.format(kind),
+                                           fallback=self.get(section, 'xdm_{}_usb_serial'.format(kind), fallback='')),
+                          lambda value: value != '', "needs xdm_{}_port or xdm_{}_usb_serial".format(kind, kind))
+                    if kind == "current":
+                        check("[{}] xdm_shunt_resistance".format(section),
+                              lambda: self.getfloat(section, 'xdm_shunt_resistance'),
+                              lambda value: value > 0, "has to be positive")
+
+        for section in self.sections():
+            if section.startswith("SINK:"):
+                check("[{}] overflow_policy".format(section),
+                      lambda: self.get(section, 'overflow_policy', fallback=OVERFLOW_POLICIES[0]),
+                      lambda value: value in OVERFLOW_POLICIES, "expected one of {}".format(OVERFLOW_POLICIES))
+
+        if check("analytics_enable", lambda: self.getboolean('ANALYTICS', 'analytics_enable', fallback=False)) is True:
+            for base_type in check("analytics_types", lambda: get_analytics_types(self)) or []:
+                section = "ANALYTICS:{}".format(base_type)
+                if not self.has_section(section):
+                    section = 'ANALYTICS'
+                check("[{}] ewma_time_constant".format(section),
+                      lambda: self.getint(section, 'ewma_time_constant', fallback=10000),
+                      lambda value: value > 0, "has to be positive")
+                check("[{}] rolling_window".format(section),
+                      lambda: self.getint(section, 'rolling_window', fallback=600),
+                      lambda value: value > 1, "has to be at least 2")
+            for section in self.get_meter_sections():
+                check("[{}] battery_capacity_ah".format(section),
+                      lambda: self.getfloat(section, 'battery_capacity_ah', fallback=0.0),
+                      lambda value: value >= 0, "can't be negative")
+
+        if self.runtime == 'processes':
+            check("ring_capacity", lambda: self.getint('PROCESSES', 'ring_capacity', fallback=65536),
+                  lambda value: value > 0, "has to be positive")
+            for section in self.get_meter_sections():
+                # the readings cross the sample ring with their MAC in a fixed size field
+                mac_key = 'self_mac' if section == "XDM" else 'mac'
+                check("[{}] {}".format(section, mac_key), lambda: self.get(section, mac_key),
+                      lambda value: len(value.encode('utf-8')) <= MAX_MAC_LENGTH,
+                      "can't be longer than {} bytes with the processes runtime".format(MAX_MAC_LENGTH))
+
+        check("reporting policies", lambda: ReportFilter(self))
+
+        if len(errors) > 0:
+            raise ValueError("Invalid configuration in {}: {}".format(self.path, "; ".join(errors)))
+
+    def get_meter_sections(self) -> list[str]:
+        """
+        @return: the [CHANNEL:<name>] sections, or [XDM] if there are none
+        """
+        sections = [section for section in self.sections() if section.startswith("CHANNEL:")]
+        return sections if len(sections) > 0 else ["XDM"]
+
+    def to_dict(self) -> dict:
+        """
+        @return: every raw setting keyed by (section, key), a section's copy of a default only counts if it differs
+        """
+        defaults = self.defaults()
+        ret = {('DEFAULT', key): value for key, value in defaults.items()}
+        for section in self.sections():
+            for key, value in self.items(section, raw=True):
+                if defaults.get(key) != value:
+                    ret[(section, key)] = value
+        return ret
+
+    def get_changes(self, other: 'AppConfig') -> list[tuple]:
+        """
+        @return: the (section, key) of every setting that differs in other
+        """
+        mine = self.to_dict()
+        theirs = other.to_dict()
+        return sorted(key for key in set(mine) | set(theirs) if mine.get(key) != theirs.get(key))
+
+
+class ConfigWatcher(Thread):
+    """
+    Reloads the config when the file changes (checked every config_reload_interval milliseconds, 0 disables it)
+    or on request (SIGHUP), and hands the new AppConfig to every subscriber
+    The subscribers are the components' apply_config() methods, they pick up the tunables in RELOADABLE
+    without touching their serial ports, connections or buffers, anything else is logged as needing a restart
+    A config that doesn't validate is logged and ignored, we carry on with the current one
+    """
+
+    def __init__(self, config: AppConfig, sig_event: Event):
+        super(ConfigWatcher, self).__init__(name="ConfigWatcher", daemon=True)
+
+        self.logger = logging.getLogger(__name__)
+
+        self.config = config
+        self.sig_event = sig_event
+        self._subscribers = []
+        self._reload_requested = Event()
+        self._mtime = self.get_mtime()
+
+        self.reloads = 0
+
+    def subscribe(self, callback):
+        """
+        @param callback: called with the new AppConfig after every successful reload
+        """
+        self._subscribers.append(callback)
+
+    def request_reload(self, *args):
+        """
+        Ask for a reload, safe to call from a signal handler
+        """
+        self._reload_requested.set()
+
+    def get_mtime(self) -> float:
+        try:
+            return os.stat(self.config.path).st_mtime
+        except OSError:
+            return 0.0
+
+    def run(self):
+        while self.sig_event.is_set() is False:
+            interval = self.config.config_reload_interval
+            self._reload_requested.wait(interval / 1000 if interval > 0 else None)
+
+            if self.sig_event.is_set():
+                break
+
+            mtime = self.get_mtime()
+            if self._reload_requested.is_set() or (mtime != self._mtime):
+                self._reload_requested.clear()
+                self._mtime = mtime
+                self.reload()
+
+    def stop(self):
+        self.sig_event.set()
+        self._reload_requested.set()
+
+    def reload(self) -> bool:
+        """
+        @return: True if a new config was applied
+        """
+        try:
+            config = AppConfig.load(self.config.path)
+        except (ValueError, configparser.Error) as e:
+            self.logger.error("Not reloading the config:{}".format(e))
+            return False
+
+        changes = self.config.get_changes(config)
+        if len(changes) == 0:
+            self.logger.info("Config reloaded, nothing changed")
+            return False
+
+        restart = ["[{}] {}".format(section, key) for section, key in changes if not is_reloadable(section, key)]
+        if len(restart) > 0:
+            self.logger.warning("These config changes only take effect after a restart: {}".format(
+                ", ".join(restart)))
+
+        self.logger.info("Applying config changes: {}".format(
+            ", ".join("[{}] {}".format(section, key) for section, key in changes if is_reloadable(section, key))))
+
+        self.config = config
+        self.reloads += 1
+
+        for callback in self._subscribers:
+            try:
+                callback(config)
+            except Exception as e:
+                self.logger.error("Error applying the new config with {}:{}".format(callback, e))
+
+        return True
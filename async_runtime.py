@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+
+from app_config import AppConfig, ConfigWatcher
+from energy_integrator import write_checkpoint
+from message_harvester import get_sink_names, get_sink_config, create_sink, apply_sink_config, \
+    register_sink_metrics, log_sink_stats
+from log_utils import RATE_LIMITED
+from meter_reader import MeterReader, READING_OK, READING_STALE
+from metrics import mark_startup
+from sensor_message_item import SensorMessageItem
+from serial_port_read_writer import SerialPortReadWriter
+from sink_queue import SinkQueue
+
+# the sinks with an asyncio version, any other sink still runs on its own thread
+ASYNC_SINKS = {
+    'api_message_writer.APIMessageWriter': 'api_message_writer.AsyncAPIMessageWriter',
+    'redis_message_processor.RedisQueueReader': 'redis_message_processor.AsyncRedisQueueReader'
+}
+
+logger = logging.getLogger(__name__)
+
+
+def write_checkpoint_logged(path: str, record: bytes):
+    """
+    write_checkpoint on the checkpoint worker, where nobody is waiting to catch the error
+    """
+    try:
+        write_checkpoint(path, record)
+    except OSError as e:
+        logger.error("Error writing checkpoint {}:{}".format(path, e))
+
+
+class AsyncSinkQueue(SinkQueue):
+    """
+    The SinkQueue of a sink running on the asyncio runtime, the sink awaits get_async() rather than blocking in get()
+    Messages must be put from the event loop thread, with put_nowait() since nothing may block the loop
+    """
+
+    def __init__(self, name: str, capacity: int, policy: str):
+        super(AsyncSinkQueue, self).__init__(name, capacity, policy)
+        self._ready = asyncio.Event()
+
+    def put(self, message: SensorMessageItem, block: bool = True):
+        super(AsyncSinkQueue, self).put(message, block)
+        self._ready.set()
+
+    def close(self):
+        super(AsyncSinkQueue, self).close()
+        self._ready.set()
+
+    async def get_async(self, timeout: float = None):
+        """
+        Wait until a message is available
+        @param timeout: seconds to wait, None waits until a message arrives or the queue is closed
+        @return: the oldest message, or None on timeout or once the queue is closed and empty
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            self._ready.clear()
+
+            messages = self.drain(1)
+            if len(messages) > 0:
+                return messages[0]
+            if self._closed:
+                return None
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if (remaining is not None) and (remaining <= 0):
+                return None
+
+            try:
+                await asyncio.wait_for(self._ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+
+class AsyncSerialPortReadWriter(SerialPortReadWriter):
+    """
+    The sampler for the asyncio runtime
+    pyserial is blocking, so each meter is read on its own single worker executor and the readings
+    are awaited together on the event loop, the samples are processed exactly as in the threaded sampler
+    The payload queue is whatever the runtime hands us, it only needs put_nowait()
+    """
+
+    def __init__(self, payload_queue, sig_event: Event, config: AppConfig):
+        super(AsyncSerialPortReadWriter, self).__init__(payload_queue, sig_event, config)
+
+        # one worker per meter, a read that runs past the read budget keeps its meter's worker busy
+        # so the following read can never talk over it on the port
+        self._executors = {reader.meter_name: ThreadPoolExecutor(max_workers=1,
+                                                                 thread_name_prefix="MeterReader-{}".format(
+                                                                     reader.meter_name))
+                           for reader in self.get_meter_readers()}
+        # the reads that ran past their sample's read budget, by meter
+        self._pending = dict()
+
+        # the energy and state of charge checkpoints are fsync'ed, they're written in order on their own
+        # worker rather than on the loop
+        self._checkpoint_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Checkpoint")
+        for channel in self.channels:
+            channel.set_checkpoint_writer(self.write_checkpoint_async)
+
+    def write_checkpoint_async(self, path: str, record: bytes):
+        self._checkpoint_executor.submit(write_checkpoint_logged, path, record)
+
+    async def read_meter_async(self, reader: MeterReader, deadline: float):
+        """
+        A read that runs past the deadline is left running on the meter's executor and awaited by the
+        following sample, as a stale reading, rather than queueing another read behind it
+        @param deadline: when (on the time.monotonic() clock) the sample's read budget is up
+        @return: a (value, timestamp_ms, status) tuple, or None if the read failed or timed out
+        """
+        status = READING_STALE
+        future = self._pending.pop(reader.meter_name, None)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executors[reader.meter_name], reader.read_meter)
+            status = READING_OK
+
+        try:
+            reading = await asyncio.wait_for(asyncio.shield(future), max(deadline - time.monotonic(), 0.0))
+        except asyncio.TimeoutError:
+            self._pending[reader.meter_name] = future
+            self.logger.info("Timed out waiting for meter {}".format(reader.meter_name), extra=RATE_LIMITED)
+            return None
+
+        if reading is None:
+            return None
+        return reading[0], reading[1], status
+
+    async def acquire_async(self) -> list[tuple]:
+        """
+        The asyncio version of acquire(), all the meters are read concurrently
+        @return: a (current, current_ts, voltage, voltage_ts) tuple per channel, the values are None if not available
+        """
+        deadline = self.get_read_deadline()
+        reads = {reader: asyncio.ensure_future(self.read_meter_async(reader, deadline))
+                 for reader in self.get_meter_readers()}
+
+        samples = []
+        for channel in self.channels:
+            current_reading = None
+            voltage_reading = None
+
+            if channel.current_reader is not None:
+                current_reading = await reads[channel.current_reader]
+
+            if channel.voltage_reader is not None:
+                voltage_reading = await reads[channel.voltage_reader]
+
+            samples.append(channel.convert_readings(current_reading, voltage_reading))
+
+        return samples
+
+    async def run_async(self):
+        """
+        Sample until the task is cancelled
+        """
+        mark_startup('sampler')
+        try:
+            while True:
+                await asyncio.sleep(self.scheduler.get_wait_time())
+                if self.scheduler.tick() is False:
+                    # woken too late under the skip policy, wait for the next deadline
+                    continue
+
+                if self.pause_reading:
+                    # skip this tick and allow UART to "settle"
+                    continue
+
+                self.take_sample(await self.acquire_async())
+        finally:
+            self.finish()
+            for executor in self._executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+            # wait for the final checkpoints (queued by finish) off the loop
+            await asyncio.get_running_loop().run_in_executor(None, self._checkpoint_executor.shutdown)
+
+
+class SinkFanOut:
+    """
+    Takes the place of the payload queue (and the harvester) on the asyncio runtime,
+    every reading the sampler enqueues goes straight into each sink's queue
+    Nothing may block the event loop, so a full queue with the block policy drops the reading (see SinkQueue.put)
+    """
+
+    def __init__(self, sink_queues: list[SinkQueue]):
+        self.sink_queues = sink_queues
+
+    def put_nowait(self, item):
+        if item is None:
+            return
+        for sink_queue in self.sink_queues:
+            sink_queue.put_nowait(item)
+
+    def close(self):
+        for sink_queue in self.sink_queues:
+            sink_queue.close()
+
+
+async def log_sink_stats_every(sink_queues: list[SinkQueue], stats_interval: int):
+    while True:
+        await asyncio.sleep(stats_interval / 1000)
+        log_sink_stats(logger, sink_queues)
+
+
+async def run_async_daemon(sig_event: Event, config: AppConfig, config_watcher: ConfigWatcher):
+    """
+    Run the sampler and the sinks as tasks on one event loop, until SIGINT or SIGTERM
+    The shutdown is structured: the sampler is cancelled first (which checkpoints the energy counters),
+    then the sink queues are closed and the sinks exit once they've written what was queued
+    sig_event is set on shutdown too, for the sinks that still run on their own thread
+    SIGHUP reloads the config, the components subscribe to config_watcher
+    """
+    loop = asyncio.get_running_loop()
+    shutdown = asyncio.Event()
+
+    def signal_handler():
+        print('You pressed Ctrl+C!')
+        shutdown.set()
+
+    # SIGINT and SIGTERM (systemd stop)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, signal_handler)
+    loop.add_signal_handler(signal.SIGHUP, config_watcher.request_reload)
+
+    sink_queues: list[SinkQueue] = []
+    sink_configs = []
+    async_sinks = []
+    thread_sinks: list[Thread] = []
+
+    # the queues come first so the sampler can start right away, they buffer its readings while the sinks load
+    for sink_name in get_sink_names(config):
+        class_path, queue_size, policy = get_sink_config(config, sink_name)
+        async_class_path = ASYNC_SINKS.get(class_path)
+
+        if async_class_path is not None:
+            sink_queue = AsyncSinkQueue(sink_name, queue_size, policy)
+        else:
+            sink_queue = SinkQueue(sink_name, queue_size, policy)
+
+        sink_queues.append(sink_queue)
+        sink_configs.append((sink_name, class_path, async_class_path, sink_queue))
+        register_sink_metrics(sink_queue)
+
+    def create_sinks():
+        # on an executor thread, importing and constructing the sinks would otherwise stall the sampler's loop
+        for sink_name, class_path, async_class_path, sink_queue in sink_configs:
+            if async_class_path is not None:
+                async_sinks.append(create_sink(async_class_path, sig_event, sink_queue, config))
+            else:
+                sink = create_sink(class_path, sig_event, sink_queue, config)
+                sink.start()
+                thread_sinks.append(sink)
+
+            logger.info("Started sink {} ({}, queue_size:{} overflow_policy:{})".format(
+                sink_name, async_class_path or class_path, sink_queue.capacity, sink_queue.policy))
+
+    fan_out = SinkFanOut(sink_queues)
+    sampler = AsyncSerialPortReadWriter(fan_out, sig_event, config)
+
+    # the reloaded config is handed over on the watcher's thread, the components only swap attributes
+    config_watcher.subscribe(sampler.apply_config)
+    config_watcher.subscribe(lambda new_config: apply_sink_config(async_sinks + thread_sinks, new_config))
+
+    sampler_task = loop.create_task(sampler.run_async())
+    stats_task = loop.create_task(
+        log_sink_stats_every(sink_queues, config.getint('SINKS', 'stats_interval', fallback=60000)))
+    sink_tasks = []
+
+    try:
+        await loop.run_in_executor(None, create_sinks)
+        sink_tasks = [loop.create_task(sink.run_async()) for sink in async_sinks]
+        mark_startup('sinks')
+
+        # run until we're asked to stop, or the sampler or a sink dies on us
+        shutdown_task = loop.create_task(shutdown.wait())
+        await asyncio.wait([shutdown_task, sampler_task] + sink_tasks, return_when=asyncio.FIRST_COMPLETED)
+        shutdown_task.cancel()
+
+    finally:
+        sig_event.set()
+        sampler_task.cancel()
+        stats_task.cancel()
+        await asyncio.gather(sampler_task, stats_task, return_exceptions=True)
+
+        # closing the queues lets the sinks finish up and exit
+        fan_out.close()
+        await asyncio.gather(*sink_tasks, return_exceptions=True)
+        for sink in thread_sinks:
+            await loop.run_in_executor(None, sink.join)
+
+        for task in [sampler_task] + sink_tasks:
+            if (task.cancelled() is False) and (task.exception() is not None):
+                logger.error("Task failed:{}".format(task.exception()), exc_info=task.exception())
+
+    print("Exiting {}".format(__name__))
@@ -1,59 +1,156 @@
+import sys
 from threading import Event
 from queue import Queue
-import configparser
 import logging
-from logging.handlers import RotatingFileHandler
+import time
+from queue import Full
+from app_config import AppConfig, ConfigWatcher
+from log_utils import setup_logging, set_log_level
 from message_harvester import MessageHarvester
+from metrics import REGISTRY, MetricsServer, mark_startup
 from serial_port_read_writer import SerialPortReadWriter
-from XDM1041Python.xdm1041main import *
-
-# An example of using logging.basicConfig rather than logging.fileHandler()
-logging.basicConfig(level=logging.DEBUG,
-                    handlers=[
-                        RotatingFileHandler("PowerMonitorMiddleware.log", maxBytes=50000000, backupCount=5)
-                    ],
-                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 logger = logging.getLogger(__name__)
 
+
+def start_metrics_server(config: AppConfig):
+    if config.getboolean('METRICS', 'metrics_enable', fallback=True) is False:
+        return None
+    try:
+        metrics_server = MetricsServer(config.get('METRICS', 'metrics_host', fallback='127.0.0.1'),
+                                       config.getint('METRICS', 'metrics_port', fallback=9101))
+        metrics_server.start()
+        return metrics_server
+    except OSError as e:
+        logger.error("Could not start the metrics endpoint:{}".format(e))
+        return None
+
+
 if __name__ == "__main__":
     import signal
 
-    # read in the global app config
-    config = configparser.ConfigParser()
-    config.read('config.cfg')
+    # the sampler's modules are loaded, the sinks' (requests, redis, the Aretas API...) are only
+    # imported once the sampler is running
+    mark_startup('imports')
+
+    # read in the global app config, once, every component gets this copy
+    try:
+        config = AppConfig.load()
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    # "threads" runs the sampler, harvester and sinks as threads, "asyncio" runs them on one event loop,
+    # "processes" runs the sampler and the rest in two supervised processes
+    runtime = config.runtime
+
+    log_queue = None
+    if runtime == 'processes':
+        from process_runtime import CONTEXT, run_process_daemon
+
+        # the child processes log through the same writer thread, they're handed the queue when started
+        log_queue = CONTEXT.Queue(maxsize=10000)
+
+    # all the threads log through a queue, the file is written by a background thread
+    log_listener = setup_logging(config.get('LOGGING', 'log_file', fallback='PowerMonitorMiddleware.log'),
+                                 config.get('LOGGING', 'log_level', fallback='INFO'),
+                                 config.getint('LOGGING', 'log_max_bytes', fallback=50000000),
+                                 config.getint('LOGGING', 'log_backup_count', fallback=5),
+                                 config.getfloat('LOGGING', 'log_rate_limit_interval', fallback=60.0),
+                                 log_queue=log_queue)
+    mark_startup('config')
+
+    if runtime == 'processes':
+        # the children run their own config watcher and metrics endpoint
+        logger.info("Starting the processes runtime")
+        run_process_daemon(config, log_queue)
+        log_listener.stop()
+        sys.exit(0)
 
     # this is a shared event handler among all the threads
     thread_sig_event = Event()
 
+    # SIGHUP or a change to the file applies the reloadable settings to the running components
+    config_watcher = ConfigWatcher(config, thread_sig_event)
+    config_watcher.subscribe(lambda new_config: set_log_level(new_config.get('LOGGING', 'log_level', fallback='INFO')))
+    config_watcher.start()
 
-    def signal_handler(sig, frame):
-        import sys
-        print('You pressed Ctrl+C!')
-        thread_sig_event.set()
-        sys.exit(0)
+    start_time = time.time()
+
+    if runtime == 'asyncio':
+        import asyncio
+        from async_runtime import run_async_daemon
+
+        metrics_server = start_metrics_server(config)
+        logger.info("Starting the asyncio runtime")
+        asyncio.run(run_async_daemon(thread_sig_event, config, config_watcher))
+
+    else:
+        # this is the shared message queue for the serial port and message harvester threads
+        # it's bounded so memory stays bounded even if the harvester stalls behind a sink with the block policy
+        mq_payload_queue: Queue = Queue(maxsize=config.getint('DEFAULT', 'payload_queue_size', fallback=10000))
+
+        message_harvester_thread = None
+
+        def signal_handler(sig, frame):
+            print('You pressed Ctrl+C!')
+            # every thread blocks on either the event or a queue, the event wakes the timed waits
+            # and the None wakes the harvester, which in turn wakes its sinks
+            thread_sig_event.set()
+            try:
+                mq_payload_queue.put_nowait(None)
+            except Full:
+                # the harvester has plenty to wake up for and will see the event
+                pass
+            # the harvester may be blocked in a sink queue's put() (block policy), closing the queues releases it
+            if message_harvester_thread is not None:
+                message_harvester_thread.close_sink_queues()
+
+        # define the signal handler for SIGINT and SIGTERM (systemd stop)
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+        # and SIGHUP (systemd reload) to reload the config
+        signal.signal(signal.SIGHUP, config_watcher.request_reload)
+
+        REGISTRY.gauge("pmm_payload_queue_depth",
+                       "Readings waiting between the sampler and the harvester").set_function(mq_payload_queue.qsize)
+
+        logger.info("Serial port monitor thread starting:")
+        serial_port_thread = SerialPortReadWriter(mq_payload_queue,
+                                                  thread_sig_event,
+                                                  config)
+        config_watcher.subscribe(serial_port_thread.apply_config)
+        serial_port_thread.start()
+        logger.info("Serial port monitor thread started.")
+
+        # the endpoint (and http.server) after the sampler, so the first sample doesn't wait for it
+        metrics_server = start_metrics_server(config)
+
+        logger.info("Message harvester thread starting:")
+        message_harvester_thread = MessageHarvester(mq_payload_queue,
+                                                    thread_sig_event,
+                                                    config)
+        config_watcher.subscribe(message_harvester_thread.apply_config)
+        message_harvester_thread.start()
+        logger.info("Message harvester thread started.")
 
-    # define the signal handler for SIGINT
-    signal.signal(signal.SIGINT, signal_handler)
+        # Test setting the termination event
+        # print("Setting thread_sig_event")
+        # thread_sig_event.set()
 
-    # this is the shared message queue for the serial port and message harvester threads
-    mq_payload_queue: Queue = Queue()
+        serial_port_thread.join()
+        message_harvester_thread.join()
 
-    logger.info("Serial port monitor thread starting:")
-    serial_port_thread = SerialPortReadWriter(mq_payload_queue,
-                                              thread_sig_event)
-    serial_port_thread.start()
-    logger.info("Serial port monitor thread started.")
+    config_watcher.stop()
 
-    logger.info("Message harvester thread starting:")
-    message_harvester_thread = MessageHarvester(mq_payload_queue,
-                                                thread_sig_event)
-    message_harvester_thread.start()
-    logger.info("Message harvester thread started.")
+    if metrics_server is not None:
+        metrics_server.stop()
 
-    # Test setting the termination event
-    # print("Setting thread_sig_event")
-    # thread_sig_event.set()
+    # the idle CPU measurement, the worker threads should all be blocked between samples and reports
+    wall_time = time.time() - start_time
+    cpu_time = time.process_time()
+    logger.info("Used {:.2f}s of CPU in {:.2f}s ({:.2f}%)".format(
+        cpu_time, wall_time, 100.0 * cpu_time / max(wall_time, 0.001)))
 
-    serial_port_thread.join()
-    message_harvester_thread.join()
+    # flush whatever is still queued
+    log_listener.stop()
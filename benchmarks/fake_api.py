@@ -0,0 +1,116 @@
+import gzip
+import json
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+
+class FakeAPI(Thread):
+    """
+    A local stand in for the Aretas API for the benchmarks
+     * GET on any path answers with a token, which is all authentication needs
+     * POST on any path is taken as an ingest batch (JSON, optionally gzipped), the latency from each
+       datum's capture timestamp to its arrival here is recorded
+    failure_rate makes that fraction of the batches fail with a 503, to exercise the retries and the spool
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, failure_rate: float = 0.0):
+        super(FakeAPI, self).__init__(name="FakeAPI", daemon=True)
+
+        self.logger = logging.getLogger(__name__)
+        self.failure_rate = failure_rate
+
+        self._lock = Lock()
+        self.requests = 0
+        self.failed_requests = 0
+        self.datums = 0
+        self.bytes_received = 0
+        self.macs = set()
+        self.latencies = []
+        self._failure_debt = 0.0
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.reply(200, b"benchmark-token")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not api.accept_batch():
+                    self.reply(503, b"")
+                    return
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                api.record_batch(json.loads(body), len(body))
+                self.reply(200, b"")
+
+            def reply(self, status: int, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+
+    def accept_batch(self) -> bool:
+        # fail a steady fraction of the batches, so runs are comparable
+        with self._lock:
+            self.requests += 1
+            self._failure_debt += self.failure_rate
+            if self._failure_debt >= 1.0:
+                self._failure_debt -= 1.0
+                self.failed_requests += 1
+                return False
+        return True
+
+    def record_batch(self, datums: list[dict], n_bytes: int):
+        now_ = time.time() * 1000
+        with self._lock:
+            self.datums += len(datums)
+            self.bytes_received += n_bytes
+            for datum in datums:
+                self.macs.add(datum['mac'])
+                self.latencies.append((now_ - datum['timestamp']) / 1000)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                'requests': self.requests,
+                'failed_requests': self.failed_requests,
+                'datums': self.datums,
+                'bytes': self.bytes_received,
+                'macs': len(self.macs)
+            }
+
+        for percentile in (50, 95, 99):
+            key = 'latency_p{}'.format(percentile)
+            stats[key] = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)] \
+                if len(latencies) > 0 else None
+
+        return stats
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    fake_api = FakeAPI(port=18080)
+    print("Fake API listening on http://127.0.0.1:{}/".format(fake_api.port))
+    fake_api.start()
+    try:
+        while True:
+            time.sleep(10)
+            print(fake_api.get_stats())
+    except KeyboardInterrupt:
+        fake_api.stop()
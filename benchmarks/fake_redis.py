@@ -0,0 +1,117 @@
+import logging
+import socketserver
+import time
+from threading import Lock, Thread
+
+
+class FakeRedis(Thread):
+    """
+    A minimal RESP2 server standing in for Redis in the benchmarks, it speaks just enough of the protocol for the sink:
+     * HSET keeps the latest value per (key, field)
+     * XADD counts the entries per stream and answers with an id, the trimming options are ignored
+     * PING, and anything else (AUTH, SELECT, CLIENT...) answers +OK
+    Every command is counted by name
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        super(FakeRedis, self).__init__(name="FakeRedis", daemon=True)
+
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = Lock()
+        self.commands = dict()
+        self.hashes = dict()
+        self.stream_lengths = dict()
+        self._last_id = (0, 0)
+
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        command = fake.read_command(self.rfile)
+                    except (ConnectionError, ValueError):
+                        return
+                    if command is None:
+                        return
+                    self.wfile.write(fake.execute(command))
+                    self.wfile.flush()
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    @staticmethod
+    def read_command(rfile) -> list:
+        """
+        @return: the next command as a list of strings, or None once the client hangs up
+        """
+        line = rfile.readline()
+        if not line:
+            return None
+
+        if not line.startswith(b"*"):
+            # an inline command
+            return line.decode().split()
+
+        command = []
+        for _ in range(int(line[1:])):
+            size = int(rfile.readline()[1:])
+            command.append(rfile.read(size + 2)[:-2].decode())
+        return command
+
+    def execute(self, command: list) -> bytes:
+        name = command[0].upper()
+
+        with self._lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+            if name == "PING":
+                return b"+PONG\r\n"
+
+            if name == "HSET":
+                fields = self.hashes.setdefault(command[1], dict())
+                added = 0
+                for n in range(2, len(command) - 1, 2):
+                    added += 0 if command[n] in fields else 1
+                    fields[command[n]] = command[n + 1]
+                return ":{}\r\n".format(added).encode()
+
+            if name == "XADD":
+                self.stream_lengths[command[1]] = self.stream_lengths.get(command[1], 0) + 1
+                now_ = int(time.time() * 1000)
+                seq = self._last_id[1] + 1 if now_ <= self._last_id[0] else 0
+                self._last_id = (max(now_, self._last_id[0]), seq)
+                entry_id = "{}-{}".format(*self._last_id)
+                return "${}\r\n{}\r\n".format(len(entry_id), entry_id).encode()
+
+        return b"+OK\r\n"
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'commands': dict(self.commands),
+                'hashes': len(self.hashes),
+                'streams': len(self.stream_lengths),
+                'stream_entries': sum(self.stream_lengths.values())
+            }
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    fake_redis = FakeRedis(port=16379)
+    print("Fake Redis listening on 127.0.0.1:{}".format(fake_redis.port))
+    fake_redis.start()
+    try:
+        while True:
+            time.sleep(10)
+            print(fake_redis.get_stats())
+    except KeyboardInterrupt:
+        fake_redis.stop()
@@ -0,0 +1,348 @@
+"""
+End to end throughput benchmark
+
+Runs backend_daemon.py with simulated meters against a local fake API and a local Redis stand in, then reports:
+ * samples/s, readings/s delivered to Redis and datums/s delivered to the API
+ * the capture to API latency percentiles
+ * CPU and RSS of the daemon (and its child processes)
+The results are saved as JSON under benchmarks/results so runs can be compared with --compare
+
+e.g. python3 benchmarks/run_benchmark.py --channels 8 --sample-interval 100 --runtime asyncio --label asyncio-8ch
+"""
+import argparse
+import configparser
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from fake_api import FakeAPI
+from fake_redis import FakeRedis
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+# the metrics we pull from the daemon's /metrics endpoint, summed over their labels
+SCRAPED_METRICS = ("pmm_samples_total", "pmm_payload_dropped_total", "pmm_sample_overruns_total",
+                   "pmm_sample_jitter_seconds_sum", "pmm_sample_jitter_seconds_count", "pmm_meter_read_errors_total",
+                   "pmm_sink_dropped_total", "pmm_upload_retries_total", "pmm_upload_failures_total",
+                   "pmm_meter_reconnects_total")
+
+# with the processes runtime these are only kept by the acquisition process, on its own port
+ACQUISITION_METRICS = ("pmm_sample_jitter_seconds_sum", "pmm_sample_jitter_seconds_count",
+                       "pmm_meter_read_errors_total", "pmm_meter_reconnects_total")
+
+# the results compared by --compare, and whether higher is better
+COMPARED_RESULTS = (("samples_per_second", True), ("readings_per_second", True), ("datums_per_second", True),
+                    ("api_requests", False), ("api_bytes", False), ("latency_p50", False), ("latency_p95", False),
+                    ("latency_p99", False), ("jitter_mean", False), ("cpu_percent", False), ("rss_max_kb", False),
+                    ("threads", False))
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def build_config(args, api_port: int, redis_port: int, metrics_port: int,
+                 acquisition_metrics_port: int) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+
+    config['DEFAULT'] = {
+        'self_mac': 'benchmark',
+        'API_URL': "http://127.0.0.1:{}/rest/".format(api_port),
+        'API_USERNAME': 'benchmark',
+        'API_PASSWORD': 'benchmark',
+        'runtime': args.runtime
+    }
+    config['LOGGING'] = {'log_file': 'benchmark.log', 'log_level': 'INFO'}
+    config['METRICS'] = {'metrics_enable': 'True', 'metrics_host': '127.0.0.1', 'metrics_port': str(metrics_port)}
+    config['PROCESSES'] = {'acquisition_metrics_port': str(acquisition_metrics_port)}
+    config['SINKS'] = {'sinks': 'api, redis'}
+    config['API'] = {'report_interval': str(args.report_interval), 'upload_engine': 'pooled'}
+    config['SPOOL'] = {'spool_enable': str(args.spool), 'spool_dir': 'spool'}
+    config['SERIAL'] = {
+        'sample_interval': str(args.sample_interval),
+        'high_rate_mode': str(args.high_rate),
+        'meter_backend': 'simulated'
+    }
+    config['SIMULATOR'] = {
+        'sim_latency': str(args.sim_latency),
+        'sim_latency_jitter': str(args.sim_latency_jitter),
+        'sim_fault_rate': str(args.sim_fault_rate),
+        'sim_stall_rate': str(args.sim_stall_rate),
+        'sim_stall_time': str(args.sim_stall_time),
+        'sim_disconnect_rate': str(args.sim_disconnect_rate),
+        'sim_current_noise': '0.05',
+        'sim_voltage_noise': '0.01'
+    }
+    config['ENERGY'] = {'energy_enable': 'True'}
+    config['REDIS'] = {'redis_host': '127.0.0.1', 'redis_port': str(redis_port), 'redis_authpw': 'benchmark'}
+
+    for n in range(args.channels):
+        config['CHANNEL:bench{}'.format(n)] = {
+            'mac': "benchmark{:04d}".format(n),
+            'xdm_current_enable': 'True',
+            'xdm_current_port': "/dev/sim{}".format(2 * n),
+            'xdm_shunt_resistance': '0.0006667',
+            'xdm_voltage_enable': 'True',
+            'xdm_voltage_port': "/dev/sim{}".format(2 * n + 1)
+        }
+
+    # extra sections, e.g. [REPORT:<type>] policies, layered over the generated config
+    if args.extra_config is not None:
+        config.read(args.extra_config)
+
+    return config
+
+
+def get_process_tree(pid: int) -> list[int]:
+    """
+    @return: the pid and the pids of all its descendants
+    """
+    ret = [pid]
+    try:
+        with open("/proc/{}/task/{}/children".format(pid, pid)) as f:
+            for child in f.read().split():
+                ret.extend(get_process_tree(int(child)))
+    except OSError:
+        pass
+    return ret
+
+
+def read_process_tree(pid: int) -> dict:
+    """
+    @return: the CPU seconds, RSS and thread count summed over a process and its children
+    """
+    ret = {'cpu_seconds': 0.0, 'rss_kb': 0, 'threads': 0}
+    for tree_pid in get_process_tree(pid):
+        try:
+            process = read_process(tree_pid)
+        except OSError:
+            # it exited in between
+            continue
+        for key in ret:
+            ret[key] += process[key]
+    return ret
+
+
+def read_process(pid: int) -> dict:
+    """
+    @return: the CPU seconds, RSS (in kB) and thread count of a process, from /proc
+    """
+    with open("/proc/{}/stat".format(pid)) as f:
+        # the fields after the command name, which is in parentheses and may contain spaces
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    status = dict()
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            status[key] = value.strip()
+
+    return {
+        'cpu_seconds': cpu_seconds,
+        'rss_kb': int(status.get('VmRSS', '0 kB').split()[0]),
+        'threads': int(status.get('Threads', '0'))
+    }
+
+
+def scrape_metrics(metrics_port: int) -> dict:
+    ret = dict.fromkeys(SCRAPED_METRICS, 0.0)
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(metrics_port), timeout=5) as response:
+            text = response.read().decode()
+    except OSError as e:
+        print("Could not scrape the daemon's metrics:{}".format(e))
+        return ret
+
+    for line in text.splitlines():
+        if line.startswith("#") or (line.strip() == ""):
+            continue
+        name_labels, _, value = line.rpartition(" ")
+        name = name_labels.split("{", 1)[0]
+        if name in ret:
+            ret[name] += float(value)
+
+    return ret
+
+
+def scrape_all_metrics(args, metrics_port: int, acquisition_metrics_port: int) -> dict:
+    ret = scrape_metrics(metrics_port)
+    if args.runtime == 'processes':
+        acquisition = scrape_metrics(acquisition_metrics_port)
+        for name in ACQUISITION_METRICS:
+            ret[name] = acquisition[name]
+    return ret
+
+
+def run_benchmark(args) -> dict:
+    fake_api = FakeAPI(failure_rate=args.api_failure_rate)
+    fake_redis = FakeRedis()
+    fake_api.start()
+    fake_redis.start()
+
+    metrics_port = get_free_port()
+    acquisition_metrics_port = get_free_port()
+    work_dir = tempfile.mkdtemp(prefix="pmm-benchmark-")
+
+    with open(os.path.join(work_dir, "config.cfg"), "w") as f:
+        build_config(args, fake_api.port, fake_redis.port, metrics_port, acquisition_metrics_port).write(f)
+
+    print("Running {} channels at {}ms for {}s ({} runtime) in {}".format(
+        args.channels, args.sample_interval, args.duration, args.runtime, work_dir))
+
+    daemon = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "backend_daemon.py")], cwd=work_dir,
+                              stdout=subprocess.DEVNULL)
+
+    start = time.monotonic()
+    rss_max = 0
+    threads = 0
+
+    try:
+        time.sleep(args.warmup)
+        baseline = read_process_tree(daemon.pid)
+        metrics_start = scrape_all_metrics(args, metrics_port, acquisition_metrics_port)
+        api_start = fake_api.get_stats()
+        redis_start = fake_redis.get_stats()
+        measure_start = time.monotonic()
+
+        while (time.monotonic() - measure_start) < args.duration:
+            if daemon.poll() is not None:
+                raise RuntimeError("The daemon exited early with code {}, see {}/benchmark.log".format(
+                    daemon.returncode, work_dir))
+            process = read_process_tree(daemon.pid)
+            rss_max = max(rss_max, process['rss_kb'])
+            threads = max(threads, process['threads'])
+            time.sleep(0.5)
+
+        process = read_process_tree(daemon.pid)
+        metrics_end = scrape_all_metrics(args, metrics_port, acquisition_metrics_port)
+        api_end = fake_api.get_stats()
+        redis_end = fake_redis.get_stats()
+        elapsed = time.monotonic() - measure_start
+
+    finally:
+        if daemon.poll() is None:
+            daemon.send_signal(signal.SIGTERM)
+        shutdown_start = time.monotonic()
+        daemon.wait(timeout=60)
+        shutdown_time = time.monotonic() - shutdown_start
+        fake_api.stop()
+        fake_redis.stop()
+
+    def delta(end: dict, begin: dict, key: str) -> float:
+        return end[key] - begin[key]
+
+    jitter_count = delta(metrics_end, metrics_start, 'pmm_sample_jitter_seconds_count')
+    redis_entries = redis_end['stream_entries'] - redis_start['stream_entries']
+
+    results = {
+        'label': args.label,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('compare', 'no_save')},
+        'elapsed': elapsed,
+        'samples_per_second': delta(metrics_end, metrics_start, 'pmm_samples_total') / elapsed,
+        'readings_per_second': redis_entries / elapsed,
+        'datums_per_second': (api_end['datums'] - api_start['datums']) / elapsed,
+        'api_requests': api_end['requests'] - api_start['requests'],
+        'api_bytes': api_end['bytes'] - api_start['bytes'],
+        'api_macs': api_end['macs'],
+        'latency_p50': api_end['latency_p50'],
+        'latency_p95': api_end['latency_p95'],
+        'latency_p99': api_end['latency_p99'],
+        'jitter_mean': delta(metrics_end, metrics_start, 'pmm_sample_jitter_seconds_sum') / max(jitter_count, 1),
+        'overruns': delta(metrics_end, metrics_start, 'pmm_sample_overruns_total'),
+        'read_errors': delta(metrics_end, metrics_start, 'pmm_meter_read_errors_total'),
+        'reconnects': delta(metrics_end, metrics_start, 'pmm_meter_reconnects_total'),
+        'payload_dropped': delta(metrics_end, metrics_start, 'pmm_payload_dropped_total'),
+        'sink_dropped': delta(metrics_end, metrics_start, 'pmm_sink_dropped_total'),
+        'upload_retries': delta(metrics_end, metrics_start, 'pmm_upload_retries_total'),
+        'cpu_percent': 100.0 * (process['cpu_seconds'] - baseline['cpu_seconds']) / elapsed,
+        'rss_max_kb': rss_max,
+        'threads': threads,
+        'shutdown_seconds': shutdown_time,
+        'total_seconds': time.monotonic() - start
+    }
+
+    return results
+
+
+def print_results(results: dict):
+    for key, value in results.items():
+        if key == 'settings':
+            continue
+        if isinstance(value, float):
+            value = "{:.4f}".format(value)
+        print("{:>20}: {}".format(key, value))
+
+
+def compare_results(results: dict, previous_file: str, compared: tuple = COMPARED_RESULTS):
+    with open(previous_file) as f:
+        previous = json.load(f)
+
+    print("\nCompared with {} ({}):".format(previous.get('label'), previous_file))
+    for key, higher_is_better in compared:
+        old = previous.get(key)
+        new = results.get(key)
+        if (old is None) or (new is None):
+            continue
+        change = 100.0 * (new - old) / old if old != 0 else 0.0
+        better = (change > 0) == higher_is_better
+        print("{:>20}: {:>12.4f} -> {:>12.4f} ({:+.1f}%{})".format(
+            key, old, new, change, "" if abs(change) < 1.0 else (" better" if better else " worse")))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Run the whole pipeline against simulated meters and local fakes")
+    parser.add_argument("--label", default="benchmark", help="a name for this run, used in the results file name")
+    parser.add_argument("--runtime", default="threads", choices=("threads", "asyncio", "processes"))
+    parser.add_argument("--channels", type=int, default=1, help="the number of channels (2 meters each)")
+    parser.add_argument("--sample-interval", type=int, default=100, help="milliseconds between samples")
+    parser.add_argument("--report-interval", type=int, default=1000, help="milliseconds between API reports")
+    parser.add_argument("--high-rate", action="store_true", help="run the sampler in high rate mode")
+    parser.add_argument("--no-spool", dest="spool", action="store_false", help="disable the API spool")
+    parser.add_argument("--sim-latency", type=float, default=20.0, help="milliseconds per simulated meter read")
+    parser.add_argument("--sim-latency-jitter", type=float, default=2.0)
+    parser.add_argument("--sim-fault-rate", type=float, default=0.0, help="fraction of garbled meter reads")
+    parser.add_argument("--sim-stall-rate", type=float, default=0.0, help="fraction of meter reads that hang")
+    parser.add_argument("--sim-stall-time", type=float, default=10000.0, help="milliseconds a hung read takes")
+    parser.add_argument("--sim-disconnect-rate", type=float, default=0.0,
+                        help="fraction of meter reads that unplug the meter until it's reconnected")
+    parser.add_argument("--api-failure-rate", type=float, default=0.0, help="fraction of uploads answered with a 503")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to measure for")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds to run before measuring")
+    parser.add_argument("--extra-config", help="a config file layered over the generated config")
+    parser.add_argument("--compare", help="a previous results file to compare this run with")
+    parser.add_argument("--no-save", action="store_true", help="don't save the results")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    results = run_benchmark(args)
+    print_results(results)
+
+    if args.no_save is False:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        results_file = os.path.join(RESULTS_DIR, "{}-{}.json".format(time.strftime("%Y%m%d-%H%M%S"), args.label))
+        with open(results_file, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved {}".format(results_file))
+
+    if args.compare is not None:
+        compare_results(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Startup benchmark
+
+Measures how quickly the daemon gets going after a (re)start, which is data lost on every systemd restart:
+ * an import time breakdown (python -X importtime) of the sampler's modules and of the sinks' modules
+ * the time from the process start to each startup stage (the daemon's pmm_startup_seconds metric):
+   imports, config, sampler, first_sample, sinks and api_token, as the median over --runs restarts
+The pipeline is the same as run_benchmark.py's (simulated meters, local fake API and Redis) and takes the same
+settings, the results are saved under benchmarks/results and can be compared with --compare
+
+e.g. python3 benchmarks/startup_benchmark.py --runs 5 --label startup
+"""
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from fake_api import FakeAPI
+from fake_redis import FakeRedis
+from run_benchmark import REPO_DIR, RESULTS_DIR, build_config, build_parser, compare_results, get_free_port
+
+STAGES = ("imports", "config", "sampler", "first_sample", "sinks", "api_token")
+
+# the modules loaded before the first sample, and the ones the sinks load afterwards
+SAMPLER_MODULES = ("backend_daemon",)
+SINK_MODULES = ("api_message_writer", "redis_message_processor", "local_store_writer")
+
+
+def measure_imports(modules: tuple) -> dict:
+    """
+    Import the modules, in order, in a fresh interpreter with -X importtime, so each module is only
+    charged for what the ones before it hadn't already loaded
+    @return: the cumulative time (ms) of each module and its slowest direct imports
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             "; ".join("import {}".format(module) for module in modules)],
+                            cwd=REPO_DIR, capture_output=True, text=True, env=os.environ.copy())
+    if result.returncode != 0:
+        raise RuntimeError("Importing {} failed:\n{}".format(modules, result.stderr))
+
+    ret = dict()
+    # a module's line comes after the lines of everything it imported, the indentation is the depth
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or ("cumulative" in line):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        ms = int(cumulative) / 1000
+
+        if name.startswith("   ") and not name.startswith("    "):
+            children.append((name.strip(), ms))
+        elif not name.startswith("  "):
+            if name.strip() in modules:
+                slowest = sorted(children, key=lambda child: child[1], reverse=True)[:8]
+                ret[name.strip()] = {'ms': ms, 'slowest': [{'module': child, 'ms': child_ms}
+                                                           for child, child_ms in slowest]}
+            children = []
+
+    return ret
+
+
+def scrape_stages(ports: list[int]) -> dict:
+    stages = dict()
+    for port in ports:
+        try:
+            with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(port), timeout=1) as response:
+                text = response.read().decode()
+        except OSError:
+            continue
+
+        for line in text.splitlines():
+            if line.startswith("pmm_startup_seconds{"):
+                name_labels, _, value = line.rpartition(" ")
+                stage = name_labels.split('stage="', 1)[1].split('"', 1)[0]
+                stages[stage] = float(value)
+
+    return stages
+
+
+def measure_startup(args, fake_api: FakeAPI, fake_redis: FakeRedis) -> dict:
+    """
+    Start the daemon once and wait for every stage
+    @return: the seconds from the process start to each stage that was reached
+    """
+    metrics_port = get_free_port()
+    acquisition_metrics_port = get_free_port()
+    work_dir = tempfile.mkdtemp(prefix="pmm-startup-")
+
+    with open(os.path.join(work_dir, "config.cfg"), "w") as f:
+        build_config(args, fake_api.port, fake_redis.port, metrics_port, acquisition_metrics_port).write(f)
+
+    daemon = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "backend_daemon.py")], cwd=work_dir,
+                              stdout=subprocess.DEVNULL)
+
+    stages = dict()
+    try:
+        deadline = time.monotonic() + args.timeout
+        while (time.monotonic() < deadline) and (not all(stage in stages for stage in STAGES)):
+            if daemon.poll() is not None:
+                raise RuntimeError("The daemon exited early with code {}, see {}/benchmark.log".format(
+                    daemon.returncode, work_dir))
+            time.sleep(0.05)
+            stages = scrape_stages([metrics_port, acquisition_metrics_port])
+    finally:
+        if daemon.poll() is None:
+            daemon.send_signal(signal.SIGTERM)
+        daemon.wait(timeout=60)
+
+    return stages
+
+
+def run_startup_benchmark(args) -> dict:
+    print("Measuring the imports")
+    results = {
+        'label': args.label,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('compare', 'no_save')},
+        'import_times': measure_imports(SAMPLER_MODULES + SINK_MODULES)
+    }
+
+    fake_api = FakeAPI()
+    fake_redis = FakeRedis()
+    fake_api.start()
+    fake_redis.start()
+
+    runs = []
+    try:
+        for n in range(args.runs):
+            print("Startup run {} of {} ({} runtime)".format(n + 1, args.runs, args.runtime))
+            runs.append(measure_startup(args, fake_api, fake_redis))
+    finally:
+        fake_api.stop()
+        fake_redis.stop()
+
+    for stage in STAGES:
+        values = [run[stage] for run in runs if stage in run]
+        results[stage] = statistics.median(values) if len(values) > 0 else None
+
+    results['runs'] = runs
+    return results
+
+
+def print_results(results: dict):
+    for module, imports in results['import_times'].items():
+        print("{:>24}: {:.1f}ms".format("import " + module, imports['ms']))
+        for entry in imports['slowest']:
+            print("{:>24}  {:>8.1f}ms {}".format("", entry['ms'], entry['module']))
+
+    for stage in STAGES:
+        value = results[stage]
+        print("{:>24}: {}".format(stage, "not reached" if value is None else "{:.3f}s".format(value)))
+
+
+def main():
+    parser = build_parser()
+    parser.description = "Measure the import times and the time from a (re)start to the first sample"
+    parser.set_defaults(label="startup")
+    parser.add_argument("--runs", type=int, default=5, help="the number of restarts to take the median of")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for every stage")
+    args = parser.parse_args()
+
+    results = run_startup_benchmark(args)
+    print_results(results)
+
+    if args.no_save is False:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        results_file = os.path.join(RESULTS_DIR, "{}-{}.json".format(time.strftime("%Y%m%d-%H%M%S"), args.label))
+        with open(results_file, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved {}".format(results_file))
+
+    if args.compare is not None:
+        compare_results(results, args.compare, tuple((stage, False) for stage in STAGES))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import logging
+import time
+from threading import Event
+from metrics import REGISTRY
+
+OVERRUN_SKIP = "skip"
+OVERRUN_CATCH_UP = "catch_up"
+
+OVERRUN_POLICIES = (OVERRUN_SKIP, OVERRUN_CATCH_UP)
+
+TICK_JITTER = REGISTRY.histogram("pmm_sample_jitter_seconds", "How late a sample tick fired after its deadline",
+                                 buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+TICK_OVERRUNS = REGISTRY.counter("pmm_sample_overruns_total", "Sample ticks that fired after the next deadline")
+TICKS_SKIPPED = REGISTRY.counter("pmm_sample_ticks_skipped_total", "Sample ticks skipped after an overrun")
+
+
+class DeadlineScheduler:
+    """
+    Fires at absolute deadlines t0 + k * interval on the monotonic clock, so the time spent
+    sampling never pushes the following samples back and the period doesn't drift
+    When a tick fires after the following deadline has already passed (an overrun) the policy decides:
+     * skip: the missed ticks are dropped and we carry on at the next deadline in the future, a tick that only
+       wakes after the following deadline is dropped too rather than fire off the grid
+     * catch_up: the missed ticks fire back to back, up to max_catch_up of them, the rest are skipped
+    With align set, t0 is a multiple of the interval in wall clock time, so every meter group
+    and every unit with the same interval samples at the same instants
+    """
+
+    def __init__(self, interval_ms: int, overrun_policy: str = OVERRUN_SKIP, align: bool = False,
+                 max_catch_up: int = 3):
+
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError("Unknown overrun policy {}, expected one of {}".format(overrun_policy, OVERRUN_POLICIES))
+
+        self.logger = logging.getLogger(__name__)
+
+        self.interval = interval_ms / 1000.0
+        self.overrun_policy = overrun_policy
+        self.align = align
+        self.max_catch_up = max_catch_up
+
+        self._t0 = None
+        self._tick = 0
+        self._pending_catch_up = 0
+        # a new interval from set_interval(), applied by the next tick
+        self._pending_interval = None
+
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.last_jitter = 0.0
+
+    def _start(self):
+        now = time.monotonic()
+        if self.align is True:
+            # the offset from now to the next wall clock multiple of the interval
+            wall = time.time()
+            self._t0 = now + (self.interval - (wall % self.interval)) % self.interval
+        else:
+            self._t0 = now
+        self._tick = 0
+
+    def get_deadline(self) -> float:
+        """
+        @return: the monotonic time of the next tick
+        """
+        if self._t0 is None:
+            self._start()
+        return self._t0 + (self._tick * self.interval)
+
+    def get_wait_time(self) -> float:
+        """
+        @return: the seconds until the next tick is due, 0 when a missed tick is waiting to be caught up
+        """
+        if self._pending_catch_up > 0:
+            return 0.0
+        return max(0.0, self.get_deadline() - time.monotonic())
+
+    def wait_next(self, sig_event: Event) -> bool:
+        """
+        Block until the next tick fires
+        @return: False if sig_event was set while waiting (i.e. we're shutting down)
+        """
+        while True:
+            remaining = self.get_wait_time()
+            if (remaining > 0) and sig_event.wait(remaining):
+                return False
+
+            if sig_event.is_set():
+                return False
+
+            if self.tick() is True:
+                return True
+
+    def tick(self) -> bool:
+        """
+        Account for the tick that's firing now, call it once get_wait_time() has elapsed
+        (wait_next() does this, the asyncio runtime sleeps on the event loop instead)
+        @return: False if the tick was dropped (skip policy, see _skip_late_tick), wait for the next one
+        """
+        deadline = self.get_deadline()
+
+        if self._skip_late_tick(deadline) is True:
+            return False
+
+        catching_up = self._pending_catch_up > 0
+        if catching_up:
+            # a missed tick, it fires straight away
+            self._pending_catch_up -= 1
+
+        now = time.monotonic()
+        jitter = max(0.0, now - deadline)
+
+        self.ticks += 1
+        self.last_jitter = jitter
+        self.jitter_sum += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        TICK_JITTER.observe(jitter)
+
+        self._tick += 1
+
+        if self._pending_interval is not None:
+            self._reschedule(deadline)
+            return True
+
+        if catching_up:
+            return True
+
+        # did we fire after the next deadline had already passed?
+        missed = int((now - self.get_deadline()) // self.interval) + 1
+        if missed > 0:
+            self.overruns += 1
+            TICK_OVERRUNS.inc()
+
+            if self.overrun_policy == OVERRUN_CATCH_UP:
+                catch_up = min(missed, self.max_catch_up)
+                self._pending_catch_up = catch_up
+                skip = missed - catch_up
+            else:
+                skip = missed
+
+            if skip > 0:
+                # jump over the deadlines we won't fire, keeping the same phase
+                self._tick += skip
+                self.skipped += skip
+                TICKS_SKIPPED.inc(skip)
+
+        return True
+
+    def _skip_late_tick(self, deadline: float) -> bool:
+        """
+        With the skip policy, a tick woken after the following deadline (e.g. the previous sample ran long, or the
+        wait overslept) would fire off the grid, so it's dropped along with every deadline that has passed
+        @return: True if the tick was dropped
+        """
+        if (self.overrun_policy != OVERRUN_SKIP) or (self._pending_interval is not None):
+            return False
+
+        now = time.monotonic()
+        if now < deadline + self.interval:
+            return False
+
+        missed = int((now - deadline) // self.interval) + 1
+        self._tick += missed
+        self.overruns += 1
+        TICK_OVERRUNS.inc()
+        self.skipped += missed
+        TICKS_SKIPPED.inc(missed)
+        return True
+
+    def set_interval(self, interval_ms: int):
+        """
+        Change the interval, it takes effect from the next tick, which then restarts the schedule from its
+        own deadline (or from the next aligned instant with align)
+        Only the attribute is set here, so it's safe to call from another thread
+        """
+        self._pending_interval = interval_ms / 1000.0
+
+    def _reschedule(self, deadline: float):
+        self.interval = self._pending_interval
+        self._pending_interval = None
+        self._pending_catch_up = 0
+        if self.align is True:
+            self._t0 = None
+        else:
+            self._t0 = deadline
+            self._tick = 1
+        self.logger.info("Sampling every {:.3f}s from now on".format(self.interval))
+
+    def get_stats(self) -> dict:
+        return {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'jitter_mean': self.jitter_sum / self.ticks if self.ticks > 0 else 0.0,
+            'jitter_max': self.jitter_max,
+            'last_jitter': self.last_jitter
+        }
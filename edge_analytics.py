@@ -0,0 +1,323 @@
+import configparser
+import logging
+import math
+import struct
+from array import array
+from energy_integrator import MS_PER_HOUR, split_trapezoid, write_checkpoint, read_checkpoint
+from sensor_message_item import SensorMessageItem
+
+# the derived sensor types carry on from the aggregates (see sample_aggregator), e.g. current (531) produces
+# 5316 (EWMA), 5317 (rolling mean), 5318 (rolling standard deviation) and 5319 (anomaly flag)
+DERIVED_EWMA = 6
+DERIVED_MEAN = 7
+DERIVED_STDDEV = 8
+DERIVED_ANOMALY = 9
+
+# the state of charge of the battery on a channel, in percent
+STATE_OF_CHARGE = 538
+
+# the base types we can analyse: current, voltage and kW
+ANALYTICS_TYPES = (531, 532, 533)
+
+# magic, version, state of charge
+_SOC_CHECKPOINT_FORMAT = "<4sHd"
+_SOC_CHECKPOINT_MAGIC = b"PMSC"
+_SOC_CHECKPOINT_VERSION = 1
+
+
+def derived_type(base_type: int, derived: int) -> int:
+    return (base_type * 10) + derived
+
+
+def get_analytics_types(config: configparser.ConfigParser) -> list[int]:
+    """
+    @return: the base types listed in analytics_types
+    """
+    ret = [int(t) for t in config.get('ANALYTICS', 'analytics_types', fallback='531, 532, 533').split(',')
+           if t.strip() != '']
+    for base_type in ret:
+        if base_type not in ANALYTICS_TYPES:
+            raise ValueError("can't analyse sensor type {}, expected one of {}".format(base_type, ANALYTICS_TYPES))
+    return ret
+
+
+class Ewma:
+    """
+    An exponentially weighted moving average over the real sample timestamps: a sample dt milliseconds after
+    the previous one gets a weight of 1 - exp(-dt / time_constant), so an irregular sample rate doesn't skew it
+    """
+
+    def __init__(self, time_constant: int):
+        self.time_constant = time_constant
+        self.value = None
+        self._last_ts = -1
+
+    def update(self, value: float, timestamp: int) -> float:
+        if self.value is None:
+            self.value = value
+        elif timestamp > self._last_ts:
+            alpha = 1.0 - math.exp(-(timestamp - self._last_ts) / self.time_constant)
+            self.value += alpha * (value - self.value)
+        self._last_ts = max(timestamp, self._last_ts)
+        return self.value
+
+
+class RollingStats:
+    """
+    The mean and variance of the last window samples, updated in O(1) per sample
+    The samples are kept in a preallocated ring and the variance is maintained with Welford's update,
+    extended to remove the sample falling out of the window, which doesn't drift the way running sums do
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self._values = array('d', bytes(8 * window))
+        self.count = 0
+        self._next = 0
+        self.mean = 0.0
+        # the sum of the squared differences from the mean
+        self._m2 = 0.0
+
+    def update(self, value: float):
+        if self.count < self.window:
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self._m2 += delta * (value - self.mean)
+        else:
+            old = self._values[self._next]
+            old_mean = self.mean
+            self.mean += (value - old) / self.window
+            self._m2 += (value - old) * ((value - self.mean) + (old - old_mean))
+            # rounding can take it a hair below zero for a constant signal
+            self._m2 = max(self._m2, 0.0)
+
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.window
+
+    def get_variance(self) -> float:
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def get_stddev(self) -> float:
+        return math.sqrt(self.get_variance())
+
+
+class SeriesAnalytics:
+    """
+    The analytics of one sensor type on one channel: the EWMA, the rolling mean and standard deviation and
+    an anomaly flag, raised when a sample is more than z_threshold standard deviations from the rolling mean
+    (checked before the sample joins the window, so an outlier can't hide itself) or outside
+    threshold_low/threshold_high
+    """
+
+    def __init__(self, base_type: int, ewma_time_constant: int, window: int, z_threshold: float,
+                 min_samples: int, threshold_low: float, threshold_high: float):
+        self.base_type = base_type
+        self.ewma = Ewma(ewma_time_constant)
+        self.rolling = RollingStats(window)
+        self.z_threshold = z_threshold
+        self.min_samples = min_samples
+        self.threshold_low = threshold_low
+        self.threshold_high = threshold_high
+
+        self._last_ts = -1
+        # anomalous samples since the messages were last taken
+        self.anomalies = 0
+
+    @staticmethod
+    def from_config(config: configparser.ConfigParser, base_type: int) -> 'SeriesAnalytics':
+        """
+        The [ANALYTICS] settings, overridden by an [ANALYTICS:<type>] section if there is one
+        """
+        section = "ANALYTICS:{}".format(base_type)
+        if not config.has_section(section):
+            section = 'ANALYTICS'
+
+        return SeriesAnalytics(base_type,
+                               config.getint(section, 'ewma_time_constant', fallback=10000),
+                               config.getint(section, 'rolling_window', fallback=600),
+                               config.getfloat(section, 'anomaly_z_threshold', fallback=4.0),
+                               config.getint(section, 'anomaly_min_samples', fallback=30),
+                               config.getfloat(section, 'anomaly_threshold_low', fallback=-math.inf),
+                               config.getfloat(section, 'anomaly_threshold_high', fallback=math.inf))
+
+    def is_anomalous(self, value: float) -> bool:
+        if (value < self.threshold_low) or (value > self.threshold_high):
+            return True
+
+        if (self.z_threshold <= 0) or (self.rolling.count < self.min_samples):
+            return False
+
+        stddev = self.rolling.get_stddev()
+        return (stddev > 0.0) and (abs(value - self.rolling.mean) / stddev) > self.z_threshold
+
+    def update(self, value: float, timestamp: int):
+        if self.is_anomalous(value):
+            self.anomalies += 1
+
+        self.ewma.update(value, timestamp)
+        self.rolling.update(value)
+        self._last_ts = timestamp
+
+    def get_messages(self, mac) -> list[SensorMessageItem]:
+        """
+        @return: the latest values, the anomaly flag is 1 if any sample since the last call was anomalous
+        """
+        if self._last_ts < 0:
+            return []
+
+        ret = [
+            SensorMessageItem(mac, derived_type(self.base_type, DERIVED_EWMA), self.ewma.value, self._last_ts),
+            SensorMessageItem(mac, derived_type(self.base_type, DERIVED_MEAN), self.rolling.mean, self._last_ts),
+            SensorMessageItem(mac, derived_type(self.base_type, DERIVED_STDDEV), self.rolling.get_stddev(),
+                              self._last_ts),
+            SensorMessageItem(mac, derived_type(self.base_type, DERIVED_ANOMALY), 1.0 if self.anomalies > 0 else 0.0,
+                              self._last_ts)
+        ]
+        self.anomalies = 0
+
+        return ret
+
+
+class StateOfCharge:
+    """
+    Coulomb counting: the battery's state of charge (in percent) follows the charge going in (times
+    charge_efficiency) and out, integrated like the energy counters (see EnergyIntegrator)
+    Counting drifts, so the estimate is reset to 100% whenever the battery is seen full: at or above
+    full_voltage with the charge current down to full_current
+    The estimate is checkpointed like the energy counters
+    """
+
+    def __init__(self, capacity_ah: float, charge_efficiency: float, full_voltage: float, full_current: float,
+                 initial_soc: float, checkpoint_file: str, checkpoint_interval: int, max_gap: int):
+        self.logger = logging.getLogger(__name__)
+
+        self.capacity_ah = capacity_ah
+        self.charge_efficiency = charge_efficiency
+        self.full_voltage = full_voltage
+        self.full_current = full_current
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.max_gap = max_gap
+
+        self.soc = initial_soc
+        self._last_ts = -1
+        self._last_current = None
+        self._last_checkpoint_ts = 0
+        self._full = False
+        # see EnergyIntegrator.write_checkpoint
+        self.write_checkpoint = write_checkpoint
+
+        self.restore()
+
+    def add_sample(self, current: float, voltage, timestamp: int):
+        """
+        @param voltage: voltage in V, or None if we don't have one for this sample
+        """
+        if timestamp <= self._last_ts:
+            return
+
+        if (self._last_current is not None) and ((timestamp - self._last_ts) <= self.max_gap):
+            charge, discharge = split_trapezoid(self._last_current, current,
+                                                (timestamp - self._last_ts) / MS_PER_HOUR)
+            self.soc += 100.0 * ((charge * self.charge_efficiency) - discharge) / self.capacity_ah
+            self.soc = min(max(self.soc, 0.0), 100.0)
+
+        full = (self.full_voltage > 0) and (voltage is not None) and (voltage >= self.full_voltage) and \
+            (0.0 <= current <= self.full_current)
+        if full is True:
+            if self._full is False:
+                self.logger.info("Battery full, resetting the state of charge from {:.1f}%".format(self.soc))
+            self.soc = 100.0
+        self._full = full
+
+        self._last_ts = timestamp
+        self._last_current = current
+
+        if (timestamp - self._last_checkpoint_ts) >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def get_messages(self, mac) -> list[SensorMessageItem]:
+        if self._last_ts < 0:
+            return []
+        return [SensorMessageItem(mac, STATE_OF_CHARGE, self.soc, self._last_ts)]
+
+    def checkpoint(self):
+        try:
+            self.write_checkpoint(self.checkpoint_file,
+                                  struct.pack(_SOC_CHECKPOINT_FORMAT, _SOC_CHECKPOINT_MAGIC, _SOC_CHECKPOINT_VERSION,
+                                              self.soc))
+            self._last_checkpoint_ts = self._last_ts
+        except OSError as e:
+            self.logger.error("Error writing state of charge checkpoint {}:{}".format(self.checkpoint_file, e))
+
+    def restore(self):
+        try:
+            record = read_checkpoint(self.checkpoint_file, struct.calcsize(_SOC_CHECKPOINT_FORMAT))
+        except (OSError, ValueError) as e:
+            self.logger.error("Error reading state of charge checkpoint {}:{}, ignoring it".format(
+                self.checkpoint_file, e))
+            return
+
+        if record is None:
+            self.logger.info("No state of charge checkpoint found, starting at {:.1f}%".format(self.soc))
+            return
+
+        magic, version, soc = struct.unpack(_SOC_CHECKPOINT_FORMAT, record)
+        if (magic != _SOC_CHECKPOINT_MAGIC) or (version != _SOC_CHECKPOINT_VERSION):
+            self.logger.error("Unknown state of charge checkpoint format, ignoring it")
+            return
+
+        self.soc = soc
+        self.logger.info("Restored the state of charge: {:.1f}%".format(soc))
+
+
+class EdgeAnalytics:
+    """
+    The streaming analytics stage of a channel, fed every sample (at the full rate in high rate mode too)
+    next to the energy integrator: a SeriesAnalytics per analysed type and, if the channel has a
+    battery_capacity_ah, a StateOfCharge estimate
+    """
+
+    def __init__(self, config: configparser.ConfigParser, section: str, checkpoint_file: str):
+        self.series = {base_type: SeriesAnalytics.from_config(config, base_type)
+                       for base_type in get_analytics_types(config)}
+
+        self.state_of_charge = None
+        capacity_ah = config.getfloat(section, 'battery_capacity_ah', fallback=0.0)
+        if capacity_ah > 0:
+            self.state_of_charge = StateOfCharge(
+                capacity_ah,
+                config.getfloat(section, 'battery_charge_efficiency', fallback=0.99),
+                config.getfloat(section, 'battery_full_voltage', fallback=0.0),
+                config.getfloat(section, 'battery_full_current', fallback=0.0),
+                config.getfloat(section, 'battery_initial_soc', fallback=100.0),
+                checkpoint_file,
+                config.getint('ENERGY', 'energy_checkpoint_interval', fallback=60000),
+                config.getint('ENERGY', 'energy_max_gap', fallback=60000))
+
+    def add_sample(self, current, current_ts: int, voltage, voltage_ts: int, power):
+        """
+        @param power: a (kW, timestamp) tuple or None
+        """
+        if (current is not None) and (531 in self.series):
+            self.series[531].update(current, current_ts)
+        if (voltage is not None) and (532 in self.series):
+            self.series[532].update(voltage, voltage_ts)
+        if (power is not None) and (533 in self.series):
+            self.series[533].update(power[0], power[1])
+
+        if (self.state_of_charge is not None) and (current is not None):
+            self.state_of_charge.add_sample(current, voltage, current_ts)
+
+    def get_messages(self, mac) -> list[SensorMessageItem]:
+        ret = []
+        for series in self.series.values():
+            ret.extend(series.get_messages(mac))
+        if self.state_of_charge is not None:
+            ret.extend(self.state_of_charge.get_messages(mac))
+        return ret
+
+    def checkpoint(self):
+        if self.state_of_charge is not None:
+            self.state_of_charge.checkpoint()
@@ -0,0 +1,234 @@
+import logging
+import os
+import struct
+import zlib
+from sensor_message_item import SensorMessageItem
+
+# sensor types for the accumulated counters
+ENERGY_IMPORT_KWH = 534
+ENERGY_EXPORT_KWH = 535
+CHARGE_AH = 536
+DISCHARGE_AH = 537
+
+MS_PER_HOUR = 3600000.0
+
+# magic, version, import Wh, export Wh, charge Ah, discharge Ah, timestamp of the last integrated sample
+_CHECKPOINT_FORMAT = "<4sHddddq"
+_CHECKPOINT_MAGIC = b"PMEI"
+_CHECKPOINT_VERSION = 1
+_CRC_FORMAT = "<I"
+
+
+def split_trapezoid(y0: float, y1: float, dt: float) -> tuple:
+    """
+    Trapezoidal area under a linear segment from y0 to y1 over dt,
+    split into the positive and negative parts at the zero crossing
+    @return: a (positive_area, negative_area) tuple, both >= 0
+    """
+    if (y0 >= 0.0) and (y1 >= 0.0):
+        return (y0 + y1) * dt / 2.0, 0.0
+
+    if (y0 <= 0.0) and (y1 <= 0.0):
+        return 0.0, -(y0 + y1) * dt / 2.0
+
+    # the segment crosses zero at fraction f of dt
+    f = y0 / (y0 - y1)
+    first = abs(y0) * f * dt / 2.0
+    second = abs(y1) * (1.0 - f) * dt / 2.0
+
+    if y0 > 0.0:
+        return first, second
+    else:
+        return second, first
+
+
+def write_checkpoint(path: str, record: bytes):
+    """
+    Append a CRC to the record, write it to a temporary file, fsync it and atomically swap it in
+    @raise OSError: if the checkpoint couldn't be written
+    """
+    record += struct.pack(_CRC_FORMAT, zlib.crc32(record))
+
+    tmp_file = path + ".tmp"
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, record)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    os.replace(tmp_file, path)
+
+
+def read_checkpoint(path: str, record_size: int):
+    """
+    Read back a record written by write_checkpoint
+    @return: the record without its CRC, None if there is no checkpoint
+    @raise ValueError: if the checkpoint has the wrong size or is corrupt
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    if len(data) != record_size + struct.calcsize(_CRC_FORMAT):
+        raise ValueError("wrong size")
+
+    record = data[:record_size]
+    (crc,) = struct.unpack(_CRC_FORMAT, data[record_size:])
+    if crc != zlib.crc32(record):
+        raise ValueError("bad CRC")
+
+    return record
+
+
+class EnergyIntegrator:
+    """
+    Integrates power and current over the real sample timestamps into
+    import/export energy (kWh) and charge/discharge (Ah) counters
+    Positive current is charging (import), the sign is already set by xdm_current_reverse_polarity
+    The counters are checkpointed to a small fixed-size file so they survive restarts
+    """
+
+    def __init__(self, checkpoint_file: str, checkpoint_interval: int, max_gap: int):
+        self.logger = logging.getLogger(__name__)
+
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        # don't interpolate across outages longer than this (in milliseconds)
+        self.max_gap = max_gap
+
+        self.import_wh = 0.0
+        self.export_wh = 0.0
+        self.charge_ah = 0.0
+        self.discharge_ah = 0.0
+
+        self._last_ts = -1
+        # the previous sample, None until we have a baseline to integrate from
+        self._last_current = None
+        # the previous sample with a voltage, samples without one don't replace it so the energy is integrated
+        # over the whole span to the next one with a voltage
+        self._last_power = None
+        self._last_power_ts = -1
+        self._last_checkpoint_ts = 0
+        # the asyncio runtime hands the fsync'ed writes to a worker thread (see MeterChannel.set_checkpoint_writer)
+        self.write_checkpoint = write_checkpoint
+
+        self.dropped_samples = 0
+
+        self.restore()
+
+    def add_sample(self, current: float, voltage, timestamp: int):
+        """
+        Integrate one sample
+        @param current: current in A
+        @param voltage: voltage in V, or None if only the Ah counters should be updated, the energy is then
+        integrated from the last sample with a voltage once the next one comes in
+        @param timestamp: the capture time of the sample in milliseconds
+        """
+        power = None
+        if voltage is not None:
+            power = current * voltage
+
+        if timestamp <= self._last_ts:
+            # a late or duplicate sample, integrating it would double count
+            self.dropped_samples += 1
+            return
+
+        if self._last_current is not None:
+            dt = timestamp - self._last_ts
+
+            if dt <= self.max_gap:
+                dt_hours = dt / MS_PER_HOUR
+
+                charge, discharge = split_trapezoid(self._last_current, current, dt_hours)
+                self.charge_ah += charge
+                self.discharge_ah += discharge
+            else:
+                self.logger.warning("{}ms gap between samples, not integrating across it".format(dt))
+
+        if power is not None:
+            if self._last_power is not None:
+                dt = timestamp - self._last_power_ts
+
+                if dt <= self.max_gap:
+                    energy_in, energy_out = split_trapezoid(self._last_power, power, dt / MS_PER_HOUR)
+                    self.import_wh += energy_in
+                    self.export_wh += energy_out
+                else:
+                    self.logger.warning("{}ms gap between voltage samples, not integrating energy across it"
+                                        .format(dt))
+
+            self._last_power = power
+            self._last_power_ts = timestamp
+
+        self._last_ts = timestamp
+        self._last_current = current
+
+        if (timestamp - self._last_checkpoint_ts) >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def get_messages(self, mac) -> list[SensorMessageItem]:
+        """
+        @return: the current counter values as SensorMessageItems stamped at the last integrated sample
+        """
+        if self._last_ts < 0:
+            return []
+
+        return [
+            SensorMessageItem(mac, ENERGY_IMPORT_KWH, self.import_wh / 1000.0, self._last_ts),
+            SensorMessageItem(mac, ENERGY_EXPORT_KWH, self.export_wh / 1000.0, self._last_ts),
+            SensorMessageItem(mac, CHARGE_AH, self.charge_ah, self._last_ts),
+            SensorMessageItem(mac, DISCHARGE_AH, self.discharge_ah, self._last_ts)
+        ]
+
+    def checkpoint(self):
+        """
+        Write the counters out (see write_checkpoint)
+        The record is a few dozen bytes so this is cheap even on SD cards
+        """
+        record = struct.pack(_CHECKPOINT_FORMAT,
+                             _CHECKPOINT_MAGIC,
+                             _CHECKPOINT_VERSION,
+                             self.import_wh,
+                             self.export_wh,
+                             self.charge_ah,
+                             self.discharge_ah,
+                             self._last_ts)
+
+        try:
+            self.write_checkpoint(self.checkpoint_file, record)
+            self._last_checkpoint_ts = self._last_ts
+        except OSError as e:
+            self.logger.error("Error writing energy checkpoint {}:{}".format(self.checkpoint_file, e))
+
+    def restore(self):
+        """
+        Load the counters from the last checkpoint, if there is a valid one
+        """
+        try:
+            record = read_checkpoint(self.checkpoint_file, struct.calcsize(_CHECKPOINT_FORMAT))
+        except (OSError, ValueError) as e:
+            self.logger.error("Error reading energy checkpoint {}:{}, ignoring it".format(self.checkpoint_file, e))
+            return
+
+        if record is None:
+            self.logger.info("No energy checkpoint found, starting counters at zero")
+            return
+
+        magic, version, import_wh, export_wh, charge_ah, discharge_ah, last_ts = struct.unpack(
+            _CHECKPOINT_FORMAT, record)
+
+        if (magic != _CHECKPOINT_MAGIC) or (version != _CHECKPOINT_VERSION):
+            self.logger.error("Unknown energy checkpoint format, ignoring it")
+            return
+
+        self.import_wh = import_wh
+        self.export_wh = export_wh
+        self.charge_ah = charge_ah
+        self.discharge_ah = discharge_ah
+        # we never integrate across a restart, the next sample just becomes the new baseline
+
+        self.logger.info("Restored energy counters: import {:.3f}kWh export {:.3f}kWh".format(
+            import_wh / 1000.0, export_wh / 1000.0))
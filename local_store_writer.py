@@ -0,0 +1,93 @@
+import logging
+import time
+from multiprocessing import Event
+from threading import Thread
+from app_config import AppConfig
+from log_utils import RATE_LIMITED
+from sample_store import SampleStore
+from sensor_message_item import SensorMessageItem
+from sink_queue import SinkQueue
+from store_query_server import StoreQueryServer
+
+
+class LocalStoreWriter(Thread):
+    """
+    The "store" sink: records every reading in the local SampleStore and serves it with the StoreQueryServer
+    Readings are buffered and written out every store_flush_interval milliseconds, old partitions are
+    deleted once they fall out of store_retention
+    """
+
+    def __init__(self, sig_event: Event, sink_queue: SinkQueue, config: AppConfig = None):
+        super(LocalStoreWriter, self).__init__()
+
+        self.logger = logging.getLogger(__name__)
+
+        if config is None:
+            config = AppConfig.load()
+
+        self.sig_event = sig_event
+        self.sink_queue = sink_queue
+
+        self.store = SampleStore(config.get('STORE', 'store_dir', fallback='store'),
+                                 config.getint('STORE', 'store_partition_interval', fallback=86400000),
+                                 config.getint('STORE', 'store_rollup_interval', fallback=60000),
+                                 config.getint('STORE', 'store_retention', fallback=2678400000))
+
+        self.flush_interval = config.getint('STORE', 'store_flush_interval', fallback=1000)
+        # how often (in milliseconds) we look for partitions to delete
+        self.retention_check_interval = 3600000
+
+        self.query_server = None
+        if config.getboolean('STORE', 'query_enable', fallback=True) is True:
+            self.query_server = StoreQueryServer(self.store,
+                                                 config.get('STORE', 'query_host', fallback='127.0.0.1'),
+                                                 config.getint('STORE', 'query_port', fallback=9102),
+                                                 config.getint('STORE', 'query_max_points', fallback=100000))
+
+    def apply_config(self, config: AppConfig):
+        """
+        Pick up the reloadable settings (see ConfigWatcher)
+        """
+        self.flush_interval = config.getint('STORE', 'store_flush_interval', fallback=1000)
+        self.store.retention = config.getint('STORE', 'store_retention', fallback=2678400000)
+
+    def store_messages(self, messages: list[SensorMessageItem]):
+        for message in messages:
+            self.store.append(message.get_mac(), message.get_type(), message.get_timestamp(), message.get_data())
+
+    def run(self):
+        if self.query_server is not None:
+            self.query_server.start()
+
+        self.store.enforce_retention()
+
+        now_ = time.monotonic()
+        next_flush = now_ + (self.flush_interval / 1000)
+        next_retention_check = now_ + (self.retention_check_interval / 1000)
+
+        while True:
+            # block until there's a message or the flush is due, we get None once the queue is closed and empty
+            message = self.sink_queue.get(max(next_flush - time.monotonic(), 0))
+
+            if message is not None:
+                batch = [message]
+                batch.extend(self.sink_queue.drain(self.sink_queue.capacity))
+                self.store_messages(batch)
+            elif self.sink_queue.is_closed():
+                break
+
+            now_ = time.monotonic()
+            if now_ >= next_flush:
+                next_flush = now_ + (self.flush_interval / 1000)
+                self.store.flush()
+                self.logger.info("Stored {} readings ({} out of order)".format(
+                    self.store.written, self.store.out_of_order), extra=RATE_LIMITED)
+
+            if now_ >= next_retention_check:
+                next_retention_check = now_ + (self.retention_check_interval / 1000)
+                self.store.enforce_retention()
+
+        self.logger.info("Exiting {}".format(self.__class__.__name__))
+        self.store.close()
+        if self.query_server is not None:
+            self.query_server.stop()
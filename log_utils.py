@@ -0,0 +1,107 @@
+import logging
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Queue, Full
+from threading import Lock
+
+# pass this as extra= on log calls that fire every cycle, they're let through at most once per interval
+RATE_LIMITED = {'rate_limited': True}
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets a rate limited call site (see RATE_LIMITED) log at most once per interval seconds,
+    the next record that gets through says how many were suppressed in between
+    Warnings and errors are never suppressed
+    """
+
+    def __init__(self, interval: float):
+        super(RateLimitFilter, self).__init__()
+        self.interval = interval
+        # (pathname, lineno) -> [time of the last record let through, suppressed count]
+        self._call_sites = dict()
+        self._lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if (getattr(record, 'rate_limited', False) is False) or (record.levelno >= logging.WARNING):
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+
+        with self._lock:
+            state = self._call_sites.get(key)
+            if state is None:
+                self._call_sites[key] = [now, 0]
+                return True
+
+            if (now - state[0]) < self.interval:
+                state[1] += 1
+                return False
+
+            suppressed = state[1]
+            state[0] = now
+            state[1] = 0
+
+        if suppressed > 0:
+            record.msg = "{} ({} similar messages suppressed)".format(record.getMessage(), suppressed)
+            record.args = None
+
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    A QueueHandler on a bounded queue that drops records rather than blocking the caller when the
+    writer thread can't keep up (e.g. a stalled SD card)
+    """
+
+    def __init__(self, log_queue: Queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def set_log_level(level: str):
+    logging.getLogger().setLevel(getattr(logging, level.upper(), logging.INFO))
+
+
+def setup_queue_logging(log_queue: Queue, level: str, rate_limit_interval: float):
+    """
+    Send all logging to log_queue, for the writer thread started by setup_logging
+    The processes runtime's children call this with the supervisor's queue
+    """
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate_limit_interval))
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    set_log_level(level)
+
+
+def setup_logging(log_file: str, level: str, max_bytes: int, backup_count: int,
+                  rate_limit_interval: float, queue_size: int = 10000, log_queue: Queue = None) -> QueueListener:
+    """
+    Route all logging through a queue to a background writer thread, so no worker thread
+    ever waits on file I/O
+    @param log_queue: the queue to use, a multiprocessing queue lets child processes log through the same writer
+    @return: the started QueueListener, stop() it on shutdown to flush the remaining records
+    """
+    file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+
+    if log_queue is None:
+        log_queue = Queue(maxsize=queue_size)
+    setup_queue_logging(log_queue, level, rate_limit_interval)
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+
+    return listener
@@ -1,61 +1,180 @@
+import importlib
+import inspect
 import logging
+import time
 from multiprocessing import Event
-from queue import Queue, Empty
+from queue import Queue
 from threading import Thread
 import configparser
-from api_message_writer import APIMessageWriter
-import time
 
-from redis_message_processor import RedisQueueReader
+from app_config import AppConfig
+from metrics import REGISTRY, mark_startup
+from sink_queue import SinkQueue
+
+# the sinks we know about, any other sink has to name its class in its [SINK:<name>] section
+# name: (class path, default queue size, default overflow policy)
+# the api sink doesn't coalesce by default, its report policies have to see every reading to catch threshold crossings
+BUILTIN_SINKS = {
+    'api': ('api_message_writer.APIMessageWriter', 1000, 'drop_oldest'),
+    'redis': ('redis_message_processor.RedisQueueReader', 10000, 'drop_oldest'),
+    'store': ('local_store_writer.LocalStoreWriter', 10000, 'drop_oldest')
+}
+
+
+SINK_QUEUE_DEPTH = REGISTRY.gauge("pmm_sink_queue_depth", "Readings waiting in a sink's queue", ("sink",))
+SINK_QUEUE_LAG = REGISTRY.gauge("pmm_sink_queue_lag_seconds", "Age of the oldest reading in a sink's queue", ("sink",))
+SINK_DROPPED = REGISTRY.counter("pmm_sink_dropped_total", "Readings dropped by a sink's overflow policy", ("sink",))
+SINK_COALESCED = REGISTRY.counter("pmm_sink_coalesced_total", "Readings replaced by a newer one for the same "
+                                                              "(mac, type) in a sink's queue", ("sink",))
+
+
+def load_sink_class(class_path: str):
+    """
+    Resolve a "module.ClassName" path to the sink class
+    """
+    module_name, _, class_name = class_path.rpartition('.')
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+def get_sink_names(config: configparser.ConfigParser) -> list[str]:
+    if config.has_option('SINKS', 'sinks'):
+        return [name.strip() for name in config.get('SINKS', 'sinks').split(',') if name.strip() != '']
+
+    # no [SINKS] section, fall back to the original behaviour
+    sink_names = ['api']
+    if config.getboolean('REDIS', 'redis_enable', fallback=False) is True:
+        sink_names.append('redis')
+    return sink_names
+
+
+def get_sink_config(config: configparser.ConfigParser, sink_name: str) -> tuple:
+    """
+    @return: the (class path, queue size, overflow policy) of a sink, from its [SINK:<name>] section
+    """
+    section = "SINK:{}".format(sink_name)
+    class_path, queue_size, policy = BUILTIN_SINKS.get(sink_name, (None, 1000, 'drop_oldest'))
+
+    class_path = config.get(section, 'class', fallback=class_path)
+    if class_path is None:
+        raise ValueError("Sink {} needs a class in the [{}] section".format(sink_name, section))
+
+    queue_size = config.getint(section, 'queue_size', fallback=queue_size)
+    policy = config.get(section, 'overflow_policy', fallback=policy)
+
+    return class_path, queue_size, policy
+
+
+def create_sink(class_path: str, sig_event: Event, sink_queue: SinkQueue, config: AppConfig):
+    """
+    Instantiate a sink, sinks whose constructor takes a config argument are handed the shared AppConfig
+    """
+    sink_class = load_sink_class(class_path)
+    if 'config' in inspect.signature(sink_class).parameters:
+        return sink_class(sig_event, sink_queue, config=config)
+    return sink_class(sig_event, sink_queue)
+
+
+def apply_sink_config(sinks: list, config: AppConfig):
+    """
+    Hand a reloaded config to the sinks that can pick it up (those with an apply_config method)
+    """
+    for sink in sinks:
+        if hasattr(sink, 'apply_config'):
+            sink.apply_config(config)
+
+
+def register_sink_metrics(sink_queue: SinkQueue):
+    sink_name = sink_queue.name
+    SINK_QUEUE_DEPTH.labels(sink_name).set_function(sink_queue.__len__)
+    SINK_QUEUE_LAG.labels(sink_name).set_function(sink_queue.get_lag)
+    SINK_DROPPED.labels(sink_name).set_function(lambda: sink_queue.dropped)
+    SINK_COALESCED.labels(sink_name).set_function(lambda: sink_queue.coalesced)
+
+
+def log_sink_stats(logger: logging.Logger, sink_queues: list[SinkQueue]):
+    for sink_queue in sink_queues:
+        stats = sink_queue.get_stats()
+        logger.info("Sink {}: depth:{} lag:{:.3f}s dropped:{} coalesced:{} high_watermark:{}".format(
+            sink_queue.name, stats['depth'], stats['lag'], stats['dropped'], stats['coalesced'],
+            stats['high_watermark']))
 
 
 class MessageHarvester(Thread):
     """
     The thread to manage the consumption of the payload queue from the serial port reader
+    Every message is fanned out to a bounded SinkQueue per sink, the sinks are threads that
+    consume their own queue so a stalled sink can only ever fill its own queue
+    Sinks are listed in the [SINKS] section and each one is configured in a [SINK:<name>] section:
+     * class = module.ClassName, the constructor takes (sig_event, sink_queue) and optionally config
+     * queue_size = the capacity of the sink's queue
+     * overflow_policy = block, drop_oldest or coalesce (see SinkQueue)
     """
 
-    def __init__(self, payload_queue: Queue, sig_event: Event):
+    def __init__(self, payload_queue: Queue, sig_event: Event, config: AppConfig):
         super(MessageHarvester, self).__init__()
 
-        # read in the global app config
-        config = configparser.ConfigParser()
-        config.read('config.cfg')
-
         self.logger = logging.getLogger(__name__)
         self.logger.info("Init MessageHarvester")
         self.sig_event = sig_event
 
         self.payload_queue = payload_queue
 
-        self.thread_sleep = config.getboolean('DEFAULT', 'thread_sleep')
-        self.thread_sleep_time = config.getfloat('DEFAULT', 'thread_sleep_time')
+        # how often (in milliseconds) we log the per sink queue statistics
+        self.stats_interval = config.getint('SINKS', 'stats_interval', fallback=60000)
+        self.last_stats_time = time.monotonic()
+
+        self.sinks: list[Thread] = []
+        self.sink_queues: list[SinkQueue] = []
+
+        for sink_name in get_sink_names(config):
+            self.add_sink(config, sink_name)
+        mark_startup('sinks')
+
+    def add_sink(self, config: AppConfig, sink_name: str):
+        class_path, queue_size, policy = get_sink_config(config, sink_name)
+
+        sink_queue = SinkQueue(sink_name, queue_size, policy)
+        sink = create_sink(class_path, self.sig_event, sink_queue, config)
+        sink.start()
 
-        self.enable_redis = config.getboolean('REDIS', 'redis_enable', fallback=False)
+        self.logger.info("Started sink {} ({}, queue_size:{} overflow_policy:{})".format(
+            sink_name, class_path, queue_size, policy))
 
-        self.api_sender = APIMessageWriter(sig_event)
-        self.api_sender.start()
+        self.sinks.append(sink)
+        self.sink_queues.append(sink_queue)
 
-        self.redis_processor = None
+        register_sink_metrics(sink_queue)
 
-        if self.enable_redis is True:
-            self.redis_processor = RedisQueueReader(sig_event)
-            self.redis_processor.start()
+    def apply_config(self, config: AppConfig):
+        apply_sink_config(self.sinks, config)
+
+    def close_sink_queues(self):
+        """
+        Close every sink's queue, this wakes the sinks and a put() blocked on a full queue (block policy)
+        Called from the shutdown path, so the harvester can't be left waiting on a sink that has already exited
+        """
+        for sink_queue in self.sink_queues:
+            sink_queue.close()
 
     def run(self):
         self.logger.info("Enter MessageHarvester run()")
         while True:
+            # block until there's something to do, a None is put on the queue to wake us on shutdown
+            sensor_message_item = self.payload_queue.get()
 
-            if self.sig_event.is_set():
+            if (sensor_message_item is None) or self.sig_event.is_set():
                 print("Exiting {}".format(self.__class__.__name__))
-                self.api_sender.join(1000)
+                # closing the queues wakes the sinks
+                self.close_sink_queues()
+                for sink in self.sinks:
+                    sink.join()
                 break
 
-            sensor_message_item = self.payload_queue.get()
-
-            self.api_sender.enqueue_msg(sensor_message_item)
-
-            if self.enable_redis is True:
-                self.redis_processor.inject_message(sensor_message_item)
+            for sink_queue in self.sink_queues:
+                sink_queue.put(sensor_message_item)
 
-            if self.thread_sleep is True:
-                time.sleep(self.thread_sleep_time)
+            now = time.monotonic()
+            if (now - self.last_stats_time) * 1000 >= self.stats_interval:
+                self.last_stats_time = now
+                log_sink_stats(self.logger, self.sink_queues)
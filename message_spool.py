@@ -0,0 +1,467 @@
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from functools import wraps
+from threading import RLock
+from sensor_message_batch import SensorMessageBatch
+
+# every record is a length + crc32 header followed by a JSON encoded batch
+_RECORD_HEADER = "<II"
+_RECORD_HEADER_SIZE = struct.calcsize(_RECORD_HEADER)
+# the cursor file holds the segment id and offset of the oldest record that hasn't been delivered
+_CURSOR_FORMAT = "<QQ"
+_CURSOR_FILE = "cursor"
+_SEGMENT_SUFFIX = ".seg"
+# batches acked ahead of the cursor are recorded in a per segment ack file, as the offsets of their records
+_ACK_FORMAT = "<Q"
+_ACK_SUFFIX = ".ack"
+
+
+def _locked(method):
+    """
+    The uploads complete on worker threads, so every public method holds the spool lock
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class SpoolRecord:
+    """
+    The in-memory index entry for one spooled batch
+    """
+    __slots__ = ("seq", "segment_id", "offset", "end", "n_datums", "acked")
+
+    def __init__(self, seq: int, segment_id: int, offset: int, end: int, n_datums: int):
+        self.seq = seq
+        self.segment_id = segment_id
+        self.offset = offset
+        self.end = end
+        self.n_datums = n_datums
+        self.acked = False
+
+
+class MessageSpool:
+    """
+    An append-only, segmented write-ahead log for the outgoing API batches
+    Every batch is appended to the active segment before it's sent and acknowledged once delivered
+    Undelivered batches stay in the spool and are replayed by read_backlog() once the API is reachable again
+    Records are never rewritten, delivery progress is a (segment, offset) cursor kept in a tiny separate file
+    plus, for batches delivered ahead of the cursor, their offsets in the segment's ack file, so a restart
+    doesn't re-send them. Whole segments (and their ack files) are deleted once they're behind the cursor or
+    fall out of the size / age retention
+    """
+
+    def __init__(self, spool_dir: str, segment_size: int, max_bytes: int, max_age: int,
+                 fsync: bool = True, cursor_sync_interval: int = 5000):
+
+        self.logger = logging.getLogger(__name__)
+
+        self.spool_dir = spool_dir
+        self.segment_size = segment_size
+        # retention, 0 disables the limit
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        # how often (in milliseconds) we persist the cursor, a crash in between only causes re-delivery
+        self.cursor_sync_interval = cursor_sync_interval
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        self._lock = RLock()
+
+        # records between the cursor and the end of the spool, oldest first
+        self._pending: deque[SpoolRecord] = deque()
+        # the same records by sequence number, so acks don't have to walk the backlog
+        self._by_seq: dict[int, SpoolRecord] = dict()
+        # the number of datums in records that haven't been delivered
+        self._backlog_datums = 0
+        self._next_seq = 0
+
+        self._cursor_segment = 0
+        self._cursor_offset = 0
+        self._cursor_dirty = False
+        self._last_cursor_sync = 0
+
+        self._active_segment_id = 0
+        self._active_file = None
+        self._active_size = 0
+
+        self.dropped_datums = 0
+
+        self._recover()
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.spool_dir, "{:016d}{}".format(segment_id, _SEGMENT_SUFFIX))
+
+    def _ack_path(self, segment_id: int) -> str:
+        return os.path.join(self.spool_dir, "{:016d}{}".format(segment_id, _ACK_SUFFIX))
+
+    def _remove_segment(self, segment_id: int):
+        os.remove(self._segment_path(segment_id))
+        try:
+            os.remove(self._ack_path(segment_id))
+        except FileNotFoundError:
+            pass
+
+    def _read_acks(self, segment_id: int) -> set:
+        """
+        @return: the offsets of the segment's records that were acked ahead of the cursor
+        """
+        try:
+            with open(self._ack_path(segment_id), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return set()
+
+        # a torn trailing entry (crash mid-write) is ignored, that batch is just re-sent
+        size = struct.calcsize(_ACK_FORMAT)
+        return {offset for (offset,) in struct.iter_unpack(_ACK_FORMAT, data[:len(data) - (len(data) % size)])}
+
+    def _write_acks(self, records: list[SpoolRecord]):
+        """
+        Persist the acks of records still ahead of the cursor, a crash before they're written only causes re-delivery
+        """
+        by_segment = dict()
+        for record in records:
+            by_segment.setdefault(record.segment_id, []).append(record.offset)
+
+        for segment_id, offsets in by_segment.items():
+            try:
+                with open(self._ack_path(segment_id), 'ab') as f:
+                    f.write(b"".join(struct.pack(_ACK_FORMAT, offset) for offset in offsets))
+                    f.flush()
+                    if self.fsync is True:
+                        os.fsync(f.fileno())
+            except OSError as e:
+                self.logger.error("Error writing spool acks for segment {}:{}".format(segment_id, e))
+
+    def _list_segments(self) -> list[int]:
+        segment_ids = []
+        for name in os.listdir(self.spool_dir):
+            if name.endswith(_SEGMENT_SUFFIX):
+                try:
+                    segment_ids.append(int(name[:-len(_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(segment_ids)
+
+    def _recover(self):
+        """
+        Rebuild the pending index by scanning the segments from the persisted cursor
+        A torn record at the end of the last segment (crash mid-append) is truncated away
+        """
+        cursor_path = os.path.join(self.spool_dir, _CURSOR_FILE)
+        try:
+            with open(cursor_path, 'rb') as f:
+                self._cursor_segment, self._cursor_offset = struct.unpack(_CURSOR_FORMAT, f.read())
+        except (OSError, struct.error):
+            self._cursor_segment, self._cursor_offset = 0, 0
+
+        segment_ids = self._list_segments()
+
+        for segment_id in segment_ids:
+            if segment_id < self._cursor_segment:
+                # fully delivered, it just didn't get cleaned up
+                self._remove_segment(segment_id)
+                continue
+
+            start = self._cursor_offset if segment_id == self._cursor_segment else 0
+            self._scan_segment(segment_id, start)
+
+        if len(segment_ids) > 0:
+            self._active_segment_id = segment_ids[-1] + 1
+        else:
+            self._active_segment_id = max(self._cursor_segment, 0)
+
+        # ack files whose segment is gone (a crash between the two deletes)
+        for name in os.listdir(self.spool_dir):
+            if name.endswith(_ACK_SUFFIX) and not os.path.exists(
+                    os.path.join(self.spool_dir, name[:-len(_ACK_SUFFIX)] + _SEGMENT_SUFFIX)):
+                os.remove(os.path.join(self.spool_dir, name))
+
+        # batches acked ahead of the cursor before the restart may now be at the head
+        if self._advance_cursor() is True:
+            self._delete_consumed_segments()
+            self.sync_cursor(force=True)
+
+        if len(self._pending) > 0:
+            self.logger.info("Recovered {} undelivered batches from the spool".format(self._count_unacked()))
+
+    def _scan_segment(self, segment_id: int, start: int):
+        path = self._segment_path(segment_id)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        acked = self._read_acks(segment_id)
+
+        offset = start
+        while offset + _RECORD_HEADER_SIZE <= len(data):
+            length, crc = struct.unpack_from(_RECORD_HEADER, data, offset)
+            payload_start = offset + _RECORD_HEADER_SIZE
+            payload = data[payload_start:payload_start + length]
+
+            if (len(payload) < length) or (zlib.crc32(payload) != crc):
+                break
+
+            end = payload_start + length
+            n_datums = len(json.loads(payload))
+            record = SpoolRecord(self._next_seq, segment_id, offset, end, n_datums)
+            record.acked = offset in acked
+            self._add_record(record)
+            self._next_seq += 1
+            offset = end
+
+        if offset < len(data):
+            self.logger.warning("Truncating {} bytes of torn records from {}".format(len(data) - offset, path))
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+
+    def _add_record(self, record: SpoolRecord):
+        self._pending.append(record)
+        self._by_seq[record.seq] = record
+        if record.acked is False:
+            self._backlog_datums += record.n_datums
+
+    def _count_unacked(self) -> int:
+        return sum(1 for record in self._pending if record.acked is False)
+
+    def _advance_cursor(self) -> bool:
+        """
+        Move the cursor past every delivered batch at the head of the spool
+        @return: True if it moved
+        """
+        advanced = False
+        while (len(self._pending) > 0) and (self._pending[0].acked is True):
+            record = self._pop_record()
+            self._cursor_segment = record.segment_id
+            self._cursor_offset = record.end
+            advanced = True
+
+        if advanced is True:
+            self._cursor_dirty = True
+        return advanced
+
+    def _pop_record(self) -> SpoolRecord:
+        record = self._pending.popleft()
+        del self._by_seq[record.seq]
+        if record.acked is False:
+            self._backlog_datums -= record.n_datums
+        return record
+
+    def _open_active(self):
+        self._active_file = open(self._segment_path(self._active_segment_id), 'ab')
+        self._active_size = self._active_file.tell()
+
+    def _roll(self):
+        """
+        Close the active segment and start a new one, then apply the retention limits
+        """
+        if self._active_file is not None:
+            self._active_file.close()
+            self._active_file = None
+        self._active_segment_id += 1
+        self.enforce_retention()
+
+    @_locked
+    def append(self, batch: SensorMessageBatch) -> int:
+        """
+        Append a batch to the spool
+        @return: the sequence number of the batch, to be passed to ack() once delivered
+        """
+        payload = batch.to_json().encode('utf-8')
+        record = struct.pack(_RECORD_HEADER, len(payload), zlib.crc32(payload)) + payload
+
+        if (self._active_file is not None) and (self._active_size + len(record) > self.segment_size):
+            self._roll()
+
+        if self._active_file is None:
+            self._open_active()
+
+        offset = self._active_size
+        self._active_file.write(record)
+        self._active_file.flush()
+        if self.fsync is True:
+            os.fsync(self._active_file.fileno())
+        self._active_size += len(record)
+
+        seq = self._next_seq
+        self._next_seq += 1
+        self._add_record(SpoolRecord(seq, self._active_segment_id, offset, self._active_size, len(batch)))
+
+        return seq
+
+    @_locked
+    def ack(self, seqs: list[int]):
+        """
+        Mark batches as delivered and move the cursor past every delivered batch at the head of the spool
+        The batches left ahead of the cursor are recorded in their segment's ack file
+        """
+        acked = []
+        for seq in seqs:
+            record = self._by_seq.get(seq)
+            if (record is not None) and (record.acked is False):
+                record.acked = True
+                self._backlog_datums -= record.n_datums
+                acked.append(record)
+
+        previous_segment = self._cursor_segment
+        if self._advance_cursor() is True:
+            if self._cursor_segment != previous_segment:
+                self._delete_consumed_segments()
+            self.sync_cursor(force=False)
+
+        # the ones the cursor didn't get past
+        ahead = [record for record in acked if record.seq in self._by_seq]
+        if len(ahead) > 0:
+            self._write_acks(ahead)
+
+    @_locked
+    def has_backlog(self) -> bool:
+        return self._backlog_datums > 0
+
+    @_locked
+    def get_backlog_size(self) -> int:
+        """
+        @return: the number of undelivered datums in the spool
+        """
+        return self._backlog_datums
+
+    @_locked
+    def read_backlog(self, max_datums: int, exclude: set = None) -> tuple:
+        """
+        Read the oldest undelivered batches, merged into one large batch
+        @param max_datums: stop adding batches once we have this many datums (at least one batch is returned)
+        @param exclude: sequence numbers not to return (e.g. the live batch that's being sent right now)
+        @return: a (seqs, datums) tuple
+        """
+        seqs = []
+        datums = []
+
+        open_files = dict()
+
+        try:
+            for record in self._pending:
+                if (record.acked is True) or ((exclude is not None) and (record.seq in exclude)):
+                    continue
+
+                if (len(datums) > 0) and (len(datums) + record.n_datums > max_datums):
+                    break
+
+                f = open_files.get(record.segment_id)
+                if f is None:
+                    f = open(self._segment_path(record.segment_id), 'rb')
+                    open_files[record.segment_id] = f
+
+                f.seek(record.offset + _RECORD_HEADER_SIZE)
+                payload = f.read(record.end - record.offset - _RECORD_HEADER_SIZE)
+
+                seqs.append(record.seq)
+                datums.extend(json.loads(payload))
+
+        finally:
+            for f in open_files.values():
+                f.close()
+
+        return seqs, datums
+
+    def _delete_consumed_segments(self):
+        for segment_id in self._list_segments():
+            if (segment_id < self._cursor_segment) and (segment_id != self._active_segment_id):
+                try:
+                    self._remove_segment(segment_id)
+                except OSError as e:
+                    self.logger.error("Error deleting spool segment {}:{}".format(segment_id, e))
+
+    @_locked
+    def enforce_retention(self):
+        """
+        Drop the oldest closed segments while the spool is over its size limit or they're older than max_age
+        """
+        segment_ids = [s for s in self._list_segments() if s != self._active_segment_id]
+
+        sizes = dict()
+        total = 0
+        for segment_id in segment_ids + [self._active_segment_id]:
+            try:
+                sizes[segment_id] = os.path.getsize(self._segment_path(segment_id))
+            except OSError:
+                sizes[segment_id] = 0
+            total += sizes[segment_id]
+
+        now = time.time()
+
+        for segment_id in segment_ids:
+            over_size = (self.max_bytes > 0) and (total > self.max_bytes)
+            over_age = False
+            if self.max_age > 0:
+                try:
+                    age_ms = (now - os.path.getmtime(self._segment_path(segment_id))) * 1000
+                    over_age = age_ms > self.max_age
+                except OSError:
+                    pass
+
+            if not (over_size or over_age):
+                break
+
+            dropped = 0
+            while (len(self._pending) > 0) and (self._pending[0].segment_id <= segment_id):
+                record = self._pop_record()
+                if record.acked is False:
+                    dropped += record.n_datums
+
+            self.dropped_datums += dropped
+            if dropped > 0:
+                self.logger.warning("Spool retention dropped {} undelivered datums".format(dropped))
+
+            self._remove_segment(segment_id)
+            total -= sizes[segment_id]
+
+            if segment_id >= self._cursor_segment:
+                self._cursor_segment = segment_id + 1
+                self._cursor_offset = 0
+            self._cursor_dirty = True
+
+        self.sync_cursor(force=True)
+
+    @_locked
+    def sync_cursor(self, force: bool = True):
+        """
+        Persist the cursor (16 bytes) if it moved
+        """
+        if self._cursor_dirty is False:
+            return
+
+        now_ms = int(time.time() * 1000)
+        if (force is False) and ((now_ms - self._last_cursor_sync) < self.cursor_sync_interval):
+            return
+
+        cursor_path = os.path.join(self.spool_dir, _CURSOR_FILE)
+        tmp_path = cursor_path + ".tmp"
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(struct.pack(_CURSOR_FORMAT, self._cursor_segment, self._cursor_offset))
+                f.flush()
+                if self.fsync is True:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, cursor_path)
+
+            self._cursor_dirty = False
+            self._last_cursor_sync = now_ms
+
+        except OSError as e:
+            self.logger.error("Error writing spool cursor:{}".format(e))
+
+    @_locked
+    def close(self):
+        self.sync_cursor(force=True)
+        if self._active_file is not None:
+            self._active_file.close()
+            self._active_file = None
@@ -0,0 +1,177 @@
+import configparser
+import math
+import random
+import time
+import serial
+
+METER_CURRENT = "current"
+METER_VOLTAGE = "voltage"
+
+BACKEND_XDM1041 = "xdm1041"
+BACKEND_SIMULATED = "simulated"
+
+WAVEFORMS = ("dc", "sine", "square", "sawtooth", "random_walk")
+
+
+class MeterBackend:
+    """
+    What a MeterReader needs from a meter, the XDM1041 driver already provides it
+     * test_conn() returns something to log once the meter is set up
+     * read_val1_raw() performs one (blocking) reading and returns the value, as a number or a numeric string
+       it raises ValueError on a garbled reading and SerialTimeoutException when the meter doesn't answer
+     * close() releases the serial port, optional (see MeterConnection)
+     * set_timeout(seconds) bounds every read, optional, otherwise the timeout is set on the driver's serial port
+    """
+
+    def test_conn(self):
+        raise NotImplementedError
+
+    def read_val1_raw(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SimulatedMeter(MeterBackend):
+    """
+    An in-process stand in for an XDM1041, for running the pipeline (and the benchmarks) without meters
+    The reading follows a waveform of offset + amplitude over period milliseconds, plus gaussian noise,
+    and is multiplied by scale (the shunt resistance for a current meter, so the waveform is in amps)
+    Each read takes latency +/- latency_jitter milliseconds and can fail at random:
+     * fault_rate: the reading is garbled (ValueError)
+     * timeout_rate: the meter doesn't answer (SerialTimeoutException)
+     * stall_rate: the read hangs for stall_time milliseconds, to exercise the read timeouts
+     * disconnect_rate: the meter is unplugged, every read fails (SerialException) until it's closed and
+       reopened, to exercise the reconnects
+    """
+
+    def __init__(self, name: str, waveform: str = "dc", offset: float = 0.0, amplitude: float = 0.0,
+                 period: float = 60000.0, noise: float = 0.0, scale: float = 1.0, latency: float = 50.0,
+                 latency_jitter: float = 0.0, fault_rate: float = 0.0, timeout_rate: float = 0.0,
+                 stall_rate: float = 0.0, stall_time: float = 10000.0, disconnect_rate: float = 0.0):
+
+        if waveform not in WAVEFORMS:
+            raise ValueError("Unknown waveform {}, expected one of {}".format(waveform, WAVEFORMS))
+
+        self.name = name
+        self.waveform = waveform
+        self.offset = offset
+        self.amplitude = amplitude
+        self.period = period
+        self.noise = noise
+        self.scale = scale
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.fault_rate = fault_rate
+        self.timeout_rate = timeout_rate
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.disconnect_rate = disconnect_rate
+
+        # the read timeout, like pyserial's a read that stalls past it fails rather than hang (None waits forever)
+        self.timeout = None
+
+        self._unplugged = False
+        self._random = random.Random()
+        self._walk = 0.0
+        self._start = time.monotonic()
+
+    def set_timeout(self, timeout: float):
+        self.timeout = timeout
+
+    def test_conn(self):
+        return "Simulated meter {} ({} waveform)".format(self.name, self.waveform)
+
+    def get_value(self, elapsed_ms: float) -> float:
+        """
+        @return: the noiseless waveform value elapsed_ms after the start
+        """
+        phase = (elapsed_ms % self.period) / self.period
+
+        if self.waveform == "sine":
+            return self.offset + self.amplitude * math.sin(2.0 * math.pi * phase)
+        if self.waveform == "square":
+            return self.offset + (self.amplitude if phase < 0.5 else -self.amplitude)
+        if self.waveform == "sawtooth":
+            return self.offset + self.amplitude * (2.0 * phase - 1.0)
+        if self.waveform == "random_walk":
+            # a walk bounded to +/- amplitude
+            step = self._random.gauss(0.0, 0.01 * self.amplitude)
+            self._walk = max(-self.amplitude, min(self.amplitude, self._walk + step))
+            return self.offset + self._walk
+
+        return self.offset
+
+    def read_val1_raw(self):
+        if self._unplugged or (self._random.random() < self.disconnect_rate):
+            self._unplugged = True
+            raise serial.SerialException("Simulated disconnect of {}".format(self.name))
+
+        latency = max(0.0, self.latency + self._random.uniform(-self.latency_jitter, self.latency_jitter))
+
+        roll = self._random.random()
+        if roll < self.stall_rate:
+            if (self.timeout is not None) and (self.stall_time / 1000 > self.timeout):
+                time.sleep(self.timeout)
+                raise serial.serialutil.SerialTimeoutException("Simulated stall past the timeout on {}".format(
+                    self.name))
+            time.sleep(self.stall_time / 1000)
+        time.sleep(latency / 1000)
+
+        roll = self._random.random()
+        if roll < self.timeout_rate:
+            raise serial.serialutil.SerialTimeoutException("Simulated timeout on {}".format(self.name))
+        if roll < (self.timeout_rate + self.fault_rate):
+            raise ValueError("could not convert string to float: '#OVLD' (simulated fault on {})".format(self.name))
+
+        value = self.get_value((time.monotonic() - self._start) * 1000) + self._random.gauss(0.0, self.noise)
+        return "{:.7f}".format(value * self.scale)
+
+
+def create_meter(config: configparser.ConfigParser, section: str, kind: str, port: str, shunt_resistance: float = 1.0):
+    """
+    Create the meter for a channel, the backend is chosen by meter_backend in the channel's section
+    (or in [SERIAL]), the simulated meters take their sim_* settings from the channel's section or [SIMULATOR]
+    @param kind: METER_CURRENT (measuring the voltage across the shunt) or METER_VOLTAGE
+    """
+    backend = config.get(section, 'meter_backend', fallback=config.get('SERIAL', 'meter_backend',
+                                                                        fallback=BACKEND_XDM1041))
+
+    if backend == BACKEND_XDM1041:
+        # only needed with real meters
+        from XDM1041Python.xdm1041main import XDM1041, XDM1041Mode
+
+        # both meters are in voltage mode, the current is measured as the voltage across the shunt
+        if kind == METER_CURRENT:
+            return XDM1041(XDM1041Mode.MODE_VOLTAGE_DC, 1, port)
+        return XDM1041(XDM1041Mode.MODE_VOLTAGE_DC, 5, port)
+
+    if backend != BACKEND_SIMULATED:
+        raise ValueError("Unknown meter backend {}, expected {} or {}".format(
+            backend, BACKEND_XDM1041, BACKEND_SIMULATED))
+
+    def get_sim(key: str, fallback):
+        value = config.get(section, key, fallback=config.get('SIMULATOR', key, fallback=None))
+        if value is None:
+            return fallback
+        return type(fallback)(value)
+
+    # a sensible battery string by default: a 48V nominal pack with a slow 20A charge/discharge swing
+    default_offset = 0.0 if kind == METER_CURRENT else 52.0
+    default_amplitude = 20.0 if kind == METER_CURRENT else 1.5
+
+    return SimulatedMeter("{}:{}".format(port, kind),
+                          waveform=get_sim("sim_{}_waveform".format(kind), "sine"),
+                          offset=get_sim("sim_{}_offset".format(kind), default_offset),
+                          amplitude=get_sim("sim_{}_amplitude".format(kind), default_amplitude),
+                          period=get_sim("sim_{}_period".format(kind), 600000.0),
+                          noise=get_sim("sim_{}_noise".format(kind), 0.0),
+                          scale=shunt_resistance if kind == METER_CURRENT else 1.0,
+                          latency=get_sim("sim_latency", 50.0),
+                          latency_jitter=get_sim("sim_latency_jitter", 5.0),
+                          fault_rate=get_sim("sim_fault_rate", 0.0),
+                          timeout_rate=get_sim("sim_timeout_rate", 0.0),
+                          stall_rate=get_sim("sim_stall_rate", 0.0),
+                          stall_time=get_sim("sim_stall_time", 10000.0),
+                          disconnect_rate=get_sim("sim_disconnect_rate", 0.0))
@@ -0,0 +1,461 @@
+import logging
+import os
+import time
+from threading import Event
+from app_config import AppConfig
+from edge_analytics import EdgeAnalytics
+from energy_integrator import EnergyIntegrator
+from AretasPythonAPI.utils import Utils as AretasUtils
+from meter_backend import create_meter, METER_CURRENT, METER_VOLTAGE
+from meter_connection import MeterConnection, MeterUnavailable
+from meter_reader import MeterReader, METER_READINGS, READING_OK, READING_MISSING, READING_DISCONNECTED, \
+    READING_STATUS_NAMES
+from report_policy import ThresholdMonitor, load_report_policies, THRESHOLD_NONE
+from sample_aggregator import SampleAggregator
+from sensor_message_item import SensorMessageItem
+
+CHANNEL_SECTION_PREFIX = "CHANNEL:"
+
+# the channel made from the [XDM] section when there are no [CHANNEL:<name>] sections
+DEFAULT_CHANNEL_NAME = "main"
+
+# the reading status of a meter is published under its type with a 0 appended, 5310 for current and 5320 for
+# voltage (see meter_reader for the values)
+DERIVED_STATUS = 0
+
+
+def get_reconnect_settings(config: AppConfig) -> tuple:
+    """
+    @return: the (reconnect_after, backoff_min, backoff_max, read_timeout) of the MeterConnections
+    """
+    return (config.getint('SERIAL', 'reconnect_after', fallback=3),
+            config.getfloat('SERIAL', 'reconnect_backoff_min', fallback=1.0),
+            config.getfloat('SERIAL', 'reconnect_backoff_max', fallback=30.0),
+            config.read_timeout)
+
+
+def load_channels(config: AppConfig, sig_event: Event) -> list:
+    """
+    Build a MeterChannel for each [CHANNEL:<name>] section, or a single one from [XDM] and self_mac if there are none
+    """
+    sections = [section for section in config.sections() if section.startswith(CHANNEL_SECTION_PREFIX)]
+
+    channels = []
+
+    if len(sections) == 0:
+        channels.append(MeterChannel(DEFAULT_CHANNEL_NAME, config, "XDM", config['DEFAULT']['self_mac'], sig_event,
+                                     config.get('ENERGY', 'energy_checkpoint_file', fallback='energy_state.bin')))
+
+    for section in sections:
+        name = section[len(CHANNEL_SECTION_PREFIX):]
+
+        # every channel gets its own energy checkpoint unless it names one
+        root, ext = os.path.splitext(config.get('ENERGY', 'energy_checkpoint_file', fallback='energy_state.bin'))
+        checkpoint_file = config.get(section, 'energy_checkpoint_file', fallback="{}_{}{}".format(root, name, ext))
+
+        channels.append(MeterChannel(name, config, section, config.get(section, 'mac'), sig_event, checkpoint_file))
+
+    check_ports(channels)
+
+    return channels
+
+
+def check_ports(channels: list):
+    """
+    Two meters talking over the same port would garble each other's reads, they're compared by what's configured
+    and by the tty it resolves to, so a usb_serial and a /dev/ttyUSBn (or a by-id link) naming the same adapter
+    are caught too, within a channel (e.g. the current and voltage meters of [XDM]) as well as across channels
+    @raise ValueError: if two meters share a port
+    """
+    ports = dict()
+
+    for channel in channels:
+        for connection in channel.get_connections():
+            for port in {connection.get_id(), connection.get_device_path()} - {None}:
+                other = ports.get(port)
+                if other is channel:
+                    raise ValueError("The meters of channel {} both use port {}".format(channel.name, port))
+                if other is not None:
+                    raise ValueError("Channels {} and {} both use port {}".format(other.name, channel.name, port))
+                ports[port] = channel
+
+
+class MeterChannel:
+    """
+    A channel group: the current (via shunt) and/or voltage meter of one battery string, reported under its own MAC
+    All the channels are sampled on the same tick by the SerialPortReadWriter, each one keeps its own
+    high rate aggregates and energy counters
+    The meter settings come from a [CHANNEL:<name>] section, using the same keys as [XDM],
+    meter_backend = simulated swaps the meters for SimulatedMeters
+    Each meter is behind a MeterConnection, so a meter that goes away is reconnected while the
+    channel keeps sampling, its readings are reported missing (or stale) in the meantime
+    """
+
+    def __init__(self, name: str, config: AppConfig, section: str, mac, sig_event: Event,
+                 checkpoint_file: str):
+
+        self.logger = logging.getLogger(__name__)
+
+        self.name = name
+        self.section = section
+        self.mac = mac
+
+        # the maximum capture time difference between a current and voltage reading for them to be
+        # considered a pair for the kW computation (in milliseconds)
+        self.max_pair_skew = config.max_pair_skew
+
+        # in high rate mode every sample goes into a preallocated ring buffer per sensor type and
+        # only the per report window aggregates are enqueued
+        self.aggregator = None
+        if config.high_rate_mode is True:
+            self.aggregator = SampleAggregator(config.getint('SERIAL', 'ring_buffer_size', fallback=4096))
+
+        # only the aggregates leave the channel in high rate mode, so the [REPORT:<type>] thresholds are checked
+        # here on every sample and a sample that crosses one (or comes back) is published straight away
+        self.thresholds = None
+        self.threshold_policies = dict()
+        if config.high_rate_mode is True:
+            self.thresholds = ThresholdMonitor()
+            self.load_threshold_policies(config)
+
+        # the kWh / Ah integration stage, fed by every sample
+        self.integrator = None
+        if config.getboolean('ENERGY', 'energy_enable', fallback=True) is True:
+            self.integrator = EnergyIntegrator(
+                checkpoint_file,
+                config.getint('ENERGY', 'energy_checkpoint_interval', fallback=60000),
+                config.getint('ENERGY', 'energy_max_gap', fallback=60000))
+
+        # the rolling statistics / anomaly flags / state of charge stage, also fed by every sample
+        self.analytics = None
+        if config.getboolean('ANALYTICS', 'analytics_enable', fallback=False) is True:
+            root, ext = os.path.splitext(checkpoint_file)
+            self.analytics = EdgeAnalytics(config, section, "{}_soc{}".format(root, ext))
+
+        # one acquisition worker per enabled meter
+        self.current_reader = None
+        self.voltage_reader = None
+
+        # the status of each meter's readings since the statuses were last published, and as last published
+        self._status = dict()
+        self._published_status = dict()
+
+        # current measurement via XDM
+        self._xdm_current_connection = None
+        self._xdm_current_enabled = config.getboolean(section, "xdm_current_enable", fallback=False)
+        self._xdm_shunt_resistance = None
+        self._xdm_reverse_current_polarity = config.getboolean(section, "xdm_current_reverse_polarity",
+                                                               fallback=False)
+
+        if self._xdm_current_enabled:
+            self._xdm_shunt_resistance = config.getfloat(section, "xdm_shunt_resistance")
+            # initialize the XDM device to use voltage mode since we're measuring the voltage across the shunt
+            # (see create_meter for the meter backends)
+            self.logger.info("Initializing XDM Meter for Current Measurement on channel {}".format(name))
+            self._xdm_current_connection = self.create_connection(config, METER_CURRENT, self._xdm_shunt_resistance)
+            self.current_reader = MeterReader("{}-current".format(name), self._xdm_current_connection, sig_event)
+            self._status[531] = READING_OK
+            self._published_status[531] = READING_OK
+
+        # voltage measurement via XDM
+        self._xdm_voltage_connection = None
+        self._xdm_voltage_enabled = config.getboolean(section, "xdm_voltage_enable", fallback=False)
+
+        if self._xdm_voltage_enabled:
+            self.logger.info("Initializing XDM Meter for Voltage Measurement on channel {}".format(name))
+            self._xdm_voltage_connection = self.create_connection(config, METER_VOLTAGE)
+            self.voltage_reader = MeterReader("{}-voltage".format(name), self._xdm_voltage_connection, sig_event)
+            self._status[532] = READING_OK
+            self._published_status[532] = READING_OK
+
+    def create_connection(self, config: AppConfig, kind: str, shunt_resistance: float = 1.0) -> MeterConnection:
+        """
+        The meter is found by xdm_<kind>_usb_serial if it's set, xdm_<kind>_port otherwise
+        A meter that isn't there at startup doesn't stop the daemon, it's connected once it shows up
+        """
+        section = self.section
+
+        def open_meter(port: str):
+            return create_meter(config, section, kind, port, shunt_resistance)
+
+        # the port is only required without a USB serial
+        usb_serial = config.get(section, "xdm_{}_usb_serial".format(kind), fallback=None)
+        if usb_serial:
+            port = config.get(section, "xdm_{}_port".format(kind), fallback=None)
+        else:
+            port = config.get(section, "xdm_{}_port".format(kind))
+
+        connection = MeterConnection("{}-{}".format(self.name, kind), open_meter, port, usb_serial,
+                                     *get_reconnect_settings(config))
+        try:
+            connection.connect()
+        except MeterUnavailable:
+            # the connection logged it, the reader keeps trying
+            pass
+
+        return connection
+
+    def apply_config(self, config: AppConfig):
+        """
+        Pick up the reloadable settings, the meters and their ports are left alone
+        """
+        self.max_pair_skew = config.max_pair_skew
+        if self.thresholds is not None:
+            self.load_threshold_policies(config)
+        if self._xdm_current_enabled and config.has_section(self.section):
+            self._xdm_shunt_resistance = config.getfloat(self.section, "xdm_shunt_resistance")
+            self._xdm_reverse_current_polarity = config.getboolean(self.section, "xdm_current_reverse_polarity",
+                                                                   fallback=False)
+
+        for connection in self.get_connections():
+            connection.apply_config(*get_reconnect_settings(config))
+
+    def load_threshold_policies(self, config: AppConfig):
+        """
+        High rate mode: the report policies with thresholds for the types we sample
+        """
+        default_policy, policies = load_report_policies(config)
+        self.threshold_policies = dict()
+        for sensor_type in (531, 532, 533):
+            policy = policies.get(sensor_type, default_policy)
+            if policy.has_thresholds():
+                self.threshold_policies[sensor_type] = policy
+
+    def get_meter_readers(self) -> list[MeterReader]:
+        return [reader for reader in (self.current_reader, self.voltage_reader) if reader is not None]
+
+    def get_connections(self) -> list[MeterConnection]:
+        return [connection for connection in (self._xdm_current_connection, self._xdm_voltage_connection)
+                if connection is not None]
+
+    def get_ports(self) -> list[str]:
+        return [connection.get_id() for connection in self.get_connections()]
+
+    def trigger(self):
+        """
+        Kick off a reading on every meter of the channel, returns immediately
+        """
+        for reader in self.get_meter_readers():
+            reader.trigger()
+
+    def wait_sample(self, deadline: float) -> tuple:
+        """
+        Wait for the readings started by trigger()
+        @param deadline: when (on the time.monotonic() clock) the sample's read budget is up
+        @return: a (current, current_ts, voltage, voltage_ts) tuple, the values are None if not available
+        """
+        current_reading = None
+        voltage_reading = None
+
+        if self.current_reader is not None:
+            current_reading = self.current_reader.wait_reading(max(deadline - time.monotonic(), 0.0))
+
+        if self.voltage_reader is not None:
+            voltage_reading = self.voltage_reader.wait_reading(max(deadline - time.monotonic(), 0.0))
+
+        return self.convert_readings(current_reading, voltage_reading)
+
+    def update_status(self, sensor_type: int, reader: MeterReader, reading):
+        if reading is not None:
+            status = reading[2]
+        elif reader.connection.is_connected():
+            status = READING_MISSING
+        else:
+            status = READING_DISCONNECTED
+
+        METER_READINGS.labels(reader.meter_name, READING_STATUS_NAMES[status]).inc()
+        # the worst since the statuses were last published
+        self._status[sensor_type] = max(self._status[sensor_type], status)
+
+    def get_status_messages(self) -> list[SensorMessageItem]:
+        """
+        The status of each meter's readings since the last call, only while it isn't READING_OK
+        and once more when it's back to it
+        """
+        ret = []
+        now_ms = AretasUtils.now_ms()
+        for sensor_type, status in self._status.items():
+            if (status != READING_OK) or (self._published_status[sensor_type] != READING_OK):
+                ret.append(SensorMessageItem(self.mac, (sensor_type * 10) + DERIVED_STATUS, float(status), now_ms))
+            self._published_status[sensor_type] = status
+            self._status[sensor_type] = READING_OK
+        return ret
+
+    def convert_readings(self, current_reading, voltage_reading) -> tuple:
+        """
+        Turn the raw (value, timestamp_ms, status) meter readings into the acquired sample
+        A reading that's None is missing, it's recorded in the meter's status
+        @return: a (current, current_ts, voltage, voltage_ts) tuple, the values are None if not available
+        """
+        if self.current_reader is not None:
+            self.update_status(531, self.current_reader, current_reading)
+        if self.voltage_reader is not None:
+            self.update_status(532, self.voltage_reader, voltage_reading)
+
+        xdm_current_meas = None
+        xdm_voltage_meas = None
+        current_ts = -1
+        voltage_ts = -1
+
+        # several of these checks below are obnoxious and a remnant from the previous repo
+        # where we had the BMS params and wanted to support optional XDM1041s
+        # I'm going to keep things similar though so we can still have the flexibility of
+        # supporting one, both or none :D
+        if self._xdm_current_enabled and (current_reading is not None):
+            xdm_voltage, current_ts, _ = current_reading
+            # apply I = V / R
+            xdm_current_meas = xdm_voltage / self._xdm_shunt_resistance
+            if self._xdm_reverse_current_polarity:
+                xdm_current_meas = xdm_current_meas * -1.0
+
+        if self._xdm_voltage_enabled and (voltage_reading is not None):
+            xdm_voltage_meas, voltage_ts, _ = voltage_reading
+
+        return xdm_current_meas, current_ts, xdm_voltage_meas, voltage_ts
+
+    def compute_kw(self, current, current_ts: int, voltage, voltage_ts: int):
+        """
+        Compute power from a time aligned current/voltage pair
+        @return: a (kW, timestamp) tuple stamped at the midpoint of the pair, or None
+        """
+        if (current is None) or (voltage is None):
+            return None
+
+        skew = abs(voltage_ts - current_ts)
+        if skew > self.max_pair_skew:
+            self.logger.warning("Current and voltage readings on channel {} are {}ms apart, skipping kW".format(
+                self.name, skew))
+            return None
+
+        kw = (float(voltage) * float(current)) / 1000
+        return kw, (voltage_ts + current_ts) // 2
+
+    def integrate(self, current, current_ts: int, voltage, power):
+        """
+        Feed a sample to the energy integrator
+        Energy is only integrated for time aligned pairs (i.e. when we have a kW value), Ah for every current reading,
+        a sample without a pair doesn't reset the energy, it's integrated from the last pair to the next one
+        """
+        if (self.integrator is None) or (current is None):
+            return
+
+        if power is not None:
+            self.integrator.add_sample(current, voltage, power[1])
+        else:
+            self.integrator.add_sample(current, None, current_ts)
+
+    def check_thresholds(self, sensor_type: int, value: float, timestamp: int, crossings: list):
+        """
+        High rate mode: add the reading to crossings if it crossed one of its type's thresholds or came back
+        """
+        policy = self.threshold_policies.get(sensor_type)
+        if policy is None:
+            return
+        if self.thresholds.update((self.mac, sensor_type), policy, value) != THRESHOLD_NONE:
+            crossings.append(SensorMessageItem(self.mac, sensor_type, float(value), timestamp))
+
+    def record_sample(self, sample: tuple) -> list[SensorMessageItem]:
+        """
+        High rate mode: write a sample straight into the ring buffers,
+        no SensorMessageItems are allocated per reading, except for the threshold crossings
+        @return: the readings that crossed a threshold or came back, to publish now (usually none)
+        """
+        current, current_ts, voltage, voltage_ts = sample
+        crossings = []
+
+        if voltage is not None:
+            self.aggregator.record(532, voltage, voltage_ts)
+            self.check_thresholds(532, voltage, voltage_ts, crossings)
+
+        if current is not None:
+            self.aggregator.record(531, current, current_ts)
+            self.check_thresholds(531, current, current_ts, crossings)
+
+        power = self.compute_kw(current, current_ts, voltage, voltage_ts)
+        if power is not None:
+            self.aggregator.record(533, power[0], power[1])
+            self.check_thresholds(533, power[0], power[1], crossings)
+
+        self.integrate(current, current_ts, voltage, power)
+
+        if self.analytics is not None:
+            self.analytics.add_sample(current, current_ts, voltage, voltage_ts, power)
+
+        return crossings
+
+    def flush_aggregates(self) -> list[SensorMessageItem]:
+        """
+        High rate mode: the last/min/max/mean/RMS/count of the samples recorded since the last flush
+        """
+        payload_items = self.aggregator.flush(self.mac)
+        payload_items.extend(self.get_status_messages())
+
+        # the energy counters are cumulative so we just publish their latest values
+        if self.integrator is not None:
+            payload_items.extend(self.integrator.get_messages(self.mac))
+
+        if self.analytics is not None:
+            payload_items.extend(self.analytics.get_messages(self.mac))
+
+        return payload_items
+
+    def get_messages(self, sample: tuple) -> list[SensorMessageItem]:
+        """
+        Turn a sample into messages
+        Each message is stamped with the capture time of its own reading
+        if both are enabled, also return kW
+        if the energy integrator is enabled, also return the kWh and Ah counters
+        if the analytics are enabled, also return the derived values (see EdgeAnalytics)
+        and the reading status of any meter that didn't deliver a fresh reading
+        @return: a list of SensorMessageItems
+        """
+        xdm_current_meas, current_ts, xdm_voltage_meas, voltage_ts = sample
+
+        ret = list()
+
+        try:
+
+            if xdm_voltage_meas is not None:
+                msg_voltage = SensorMessageItem(self.mac, 532, float(xdm_voltage_meas), voltage_ts)
+                ret.append(msg_voltage)
+
+            if xdm_current_meas is not None:
+                msg_current = SensorMessageItem(self.mac, 531, float(xdm_current_meas), current_ts)
+                ret.append(msg_current)
+
+            # compute power for energy consumption calculations
+            power = self.compute_kw(xdm_current_meas, current_ts, xdm_voltage_meas, voltage_ts)
+            if power is not None:
+                msg_kw = SensorMessageItem(self.mac, 533, power[0], power[1])
+                ret.append(msg_kw)
+
+            if self.integrator is not None:
+                self.integrate(xdm_current_meas, current_ts, xdm_voltage_meas, power)
+                ret.extend(self.integrator.get_messages(self.mac))
+
+            if self.analytics is not None:
+                self.analytics.add_sample(xdm_current_meas, current_ts, xdm_voltage_meas, voltage_ts, power)
+                ret.extend(self.analytics.get_messages(self.mac))
+
+            ret.extend(self.get_status_messages())
+
+        except Exception as e:
+
+            self.logger.error("Unknown exception trying to decode BMS params:{}".format(e))
+
+        return ret
+
+    def set_checkpoint_writer(self, writer):
+        """
+        Write the energy and state of charge checkpoints with writer(path, record) instead of write_checkpoint
+        """
+        if self.integrator is not None:
+            self.integrator.write_checkpoint = writer
+        if (self.analytics is not None) and (self.analytics.state_of_charge is not None):
+            self.analytics.state_of_charge.write_checkpoint = writer
+
+    def checkpoint(self):
+        if self.integrator is not None:
+            self.integrator.checkpoint()
+        if self.analytics is not None:
+            self.analytics.checkpoint()
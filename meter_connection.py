@@ -0,0 +1,223 @@
+import glob
+import logging
+import os
+import re
+import time
+import serial
+from metrics import REGISTRY
+
+# where udev links every USB serial adapter under a name carrying its serial number, e.g.
+# /dev/serial/by-id/usb-1a86_USB_Serial_5A7B012345-if00-port0 -> ../../ttyUSB1
+SERIAL_BY_ID_DIR = "/dev/serial/by-id"
+
+METER_CONNECTED = REGISTRY.gauge("pmm_meter_connected", "Whether the meter's serial port is open (1) or not (0)",
+                                 ("meter",))
+METER_RECONNECTS = REGISTRY.counter("pmm_meter_reconnects_total",
+                                    "Times a meter's serial port was reopened after a fault", ("meter",))
+
+
+class MeterUnavailable(Exception):
+    """
+    The meter isn't connected and we're waiting out its backoff before trying again
+    """
+    pass
+
+
+def find_port_by_serial(usb_serial: str, by_id_dir: str = SERIAL_BY_ID_DIR):
+    """
+    Look up the tty of a USB serial adapter from its serial number, through the udev by-id links
+    The serial has to be a whole "_" / "-" delimited part of the link name, so 12345 doesn't match 5A7B012345
+    @return: the device path (e.g. /dev/ttyUSB1), or None if no adapter with that serial is plugged in
+    """
+    pattern = re.compile(r"(?:^|[_-]){}(?:[_-]|$)".format(re.escape(usb_serial)))
+    matches = sorted(path for path in glob.glob(os.path.join(by_id_dir, "*"))
+                     if pattern.search(os.path.basename(path)) is not None)
+    if len(matches) == 0:
+        return None
+    return os.path.realpath(matches[0])
+
+
+def set_meter_timeout(device, timeout: float):
+    """
+    Bound the blocking reads and writes on the meter's serial port to timeout seconds, so a meter that stops
+    answering fails the read instead of pinning its reader
+    """
+    set_timeout = getattr(device, 'set_timeout', None)
+    if callable(set_timeout):
+        set_timeout(timeout)
+        return
+
+    for value in vars(device).values():
+        if isinstance(value, serial.SerialBase):
+            value.timeout = timeout
+            value.write_timeout = timeout
+
+
+def close_meter(device):
+    """
+    Close the meter's serial port, if we can find it, so a reopen doesn't fight the stale handle
+    """
+    close = getattr(device, 'close', None)
+    if callable(close):
+        close()
+        return
+
+    for value in vars(device).values():
+        if isinstance(value, serial.SerialBase):
+            value.close()
+
+
+class MeterConnection:
+    """
+    Owns the connection to one meter and gets it back when the meter goes away
+    (unplugged, re-enumerated as another ttyUSB, power cycled...)
+    The meter is opened with open_meter(port), see create_meter, with read_timeout set on its serial port,
+    after reconnect_after consecutive failed reads the port is closed and reopened, with an exponential backoff
+    between backoff_min and backoff_max seconds until a read succeeds again
+    A read that takes longer than read_timeout (e.g. a meter trickling bytes) counts as a failed read too
+    Reads in between fail straight away with MeterUnavailable, without touching the port
+    With a usb_serial the port is looked up through the udev by-id links on every (re)connect, so the meter
+    is found whichever tty it comes back on
+    """
+
+    def __init__(self, name: str, open_meter, port: str, usb_serial: str = None, reconnect_after: int = 3,
+                 backoff_min: float = 1.0, backoff_max: float = 30.0, read_timeout: float = 5.0):
+
+        self.logger = logging.getLogger(__name__)
+
+        self.name = name
+        self.open_meter = open_meter
+        self.port = port
+        self.usb_serial = usb_serial
+        self.reconnect_after = reconnect_after
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.read_timeout = read_timeout
+
+        self.device = None
+        # the read timeout set on the open port, it's (re)applied by the reader before its next read
+        self._device_timeout = None
+        self.failures = 0
+        self._connected_once = False
+        self._backoff = backoff_min
+        self._retry_at = 0.0
+
+        self._connected = METER_CONNECTED.labels(name)
+        self._reconnects = METER_RECONNECTS.labels(name)
+
+    def get_id(self) -> str:
+        """
+        @return: what identifies the meter's port, the USB serial if there is one
+        """
+        return "usb:{}".format(self.usb_serial) if self.usb_serial else self.port
+
+    def get_device_path(self):
+        """
+        @return: the tty the meter is on right now with any symlinks resolved, None if its adapter isn't plugged in
+        """
+        if self.usb_serial:
+            return find_port_by_serial(self.usb_serial)
+        return os.path.realpath(self.port)
+
+    def is_connected(self) -> bool:
+        return self.device is not None
+
+    def apply_config(self, reconnect_after: int, backoff_min: float, backoff_max: float, read_timeout: float):
+        self.reconnect_after = reconnect_after
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.read_timeout = read_timeout
+
+    def resolve_port(self) -> str:
+        if not self.usb_serial:
+            return self.port
+
+        port = find_port_by_serial(self.usb_serial)
+        if port is None:
+            raise MeterUnavailable("no USB serial adapter {} in {}".format(self.usb_serial, SERIAL_BY_ID_DIR))
+        return port
+
+    def connect(self):
+        """
+        Open the meter, on failure the next attempt is pushed back by the backoff
+        @raise MeterUnavailable: if the meter couldn't be opened
+        """
+        try:
+            port = self.resolve_port()
+            device = self.open_meter(port)
+            set_meter_timeout(device, self.read_timeout)
+            info = device.test_conn()
+        except Exception as e:
+            self._retry_at = time.monotonic() + self._backoff
+            self.logger.error("Could not connect to meter {} ({}), retrying in {:.1f}s:{}".format(
+                self.name, self.get_id(), self._backoff, e))
+            self._backoff = min(self._backoff * 2, self.backoff_max)
+            raise MeterUnavailable("could not connect: {}".format(e)) from e
+
+        if self._connected_once is True:
+            self._reconnects.inc()
+        self._connected_once = True
+
+        self.device = device
+        self._device_timeout = self.read_timeout
+        self.failures = 0
+        self._connected.set(1)
+        self.logger.info("Connected to meter {} on {}: {}".format(self.name, port, info))
+
+    def disconnect(self):
+        if self.device is None:
+            return
+
+        try:
+            close_meter(self.device)
+        except Exception as e:
+            self.logger.error("Error closing meter {}:{}".format(self.name, e))
+
+        self.device = None
+        self._connected.set(0)
+        # a meter that keeps dropping out right after reconnecting backs off too
+        self._retry_at = time.monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, self.backoff_max)
+
+    def read(self):
+        """
+        One reading, (re)connecting first if the meter isn't connected and its backoff is up
+        @return: the value, see MeterBackend.read_val1_raw
+        @raise MeterUnavailable: if the meter isn't connected
+        """
+        if self.device is None:
+            if time.monotonic() < self._retry_at:
+                raise MeterUnavailable("waiting {:.1f}s to reconnect".format(self._retry_at - time.monotonic()))
+            self.connect()
+
+        start = time.monotonic()
+        try:
+            if self._device_timeout != self.read_timeout:
+                set_meter_timeout(self.device, self.read_timeout)
+                self._device_timeout = self.read_timeout
+            value = float(self.device.read_val1_raw())
+        except (ValueError, serial.SerialException, OSError):
+            self.record_failure()
+            raise
+
+        elapsed = time.monotonic() - start
+        if elapsed > self.read_timeout:
+            # the reading is still good, but a meter this slow is as good as gone if it keeps it up
+            self.logger.warning("Meter {} took {:.1f}s to read, over the {:.1f}s read_timeout".format(
+                self.name, elapsed, self.read_timeout))
+            self.record_failure()
+            return value
+
+        self.failures = 0
+        self._backoff = self.backoff_min
+        return value
+
+    def record_failure(self):
+        """
+        Count a failed read, the port is closed for a reconnect after reconnect_after of them in a row
+        """
+        self.failures += 1
+        if self.failures >= self.reconnect_after:
+            self.logger.error("Meter {} failed {} reads in a row, reconnecting in {:.1f}s".format(
+                self.name, self.failures, self._backoff))
+            self.disconnect()
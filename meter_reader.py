@@ -0,0 +1,155 @@
+import logging
+import time
+from threading import Thread, Event, Lock
+import serial
+from AretasPythonAPI.utils import Utils as AretasUtils
+from log_utils import RATE_LIMITED
+from meter_connection import MeterConnection, MeterUnavailable
+from metrics import REGISTRY
+
+# the status of a meter's reading in a sample, published by the channel (see MeterChannel.get_status_messages)
+READING_OK = 0
+# captured for an earlier sample but only completed after that sample's read budget
+READING_STALE = 1
+# the read failed or didn't complete in time
+READING_MISSING = 2
+# the meter isn't connected, its connection is waiting to reconnect
+READING_DISCONNECTED = 3
+
+READING_STATUS_NAMES = {READING_OK: "ok", READING_STALE: "stale", READING_MISSING: "missing",
+                        READING_DISCONNECTED: "disconnected"}
+
+METER_READ_SECONDS = REGISTRY.histogram("pmm_meter_read_seconds",
+                                        "Duration of a single serial meter read", ("meter",))
+METER_READ_ERRORS = REGISTRY.counter("pmm_meter_read_errors_total",
+                                     "Serial meter reads that failed", ("meter",))
+METER_READINGS = REGISTRY.counter("pmm_meter_readings_total",
+                                  "Meter readings by status (ok, stale, missing, disconnected), one per sample",
+                                  ("meter", "status"))
+
+
+class MeterReader(Thread):
+    """
+    One acquisition worker per configured meter
+    The owner calls trigger() on every worker first and then wait_reading() on each of them,
+    so the serial round-trips to the meters overlap instead of running back to back
+    Each reading carries its own capture timestamp (the midpoint of the serial transaction)
+    A read that runs past the wait isn't abandoned: it's the meter's next reading, marked stale, and the
+    meter isn't triggered again until it's done, so a slow meter never holds up the sample or gets talked over
+    """
+
+    def __init__(self, meter_name: str, connection: MeterConnection, sig_event: Event):
+        super(MeterReader, self).__init__(name="MeterReader-{}".format(meter_name), daemon=True)
+
+        self.logger = logging.getLogger(__name__)
+        self.meter_name = meter_name
+        self.connection = connection
+        self.sig_event = sig_event
+
+        self._trigger = Event()
+        self._done = Event()
+        self._done.set()
+
+        # the triggers are numbered, a reading is only fresh if it was started by the latest one
+        self._lock = Lock()
+        self._busy = False
+        self._generation = 0
+        self._read_generation = 0
+        self._reading = None
+        self._reading_generation = 0
+
+        self._read_seconds = METER_READ_SECONDS.labels(meter_name)
+        self._read_errors = METER_READ_ERRORS.labels(meter_name)
+
+    def trigger(self):
+        """
+        Ask the worker to take a reading, returns immediately
+        If the previous read is still running it's left to finish instead
+        """
+        with self._lock:
+            self._generation += 1
+            if self._busy is True:
+                return
+            self._busy = True
+            self._read_generation = self._generation
+            self._done.clear()
+        self._trigger.set()
+
+    def wait_reading(self, timeout: float = None):
+        """
+        Block until the triggered reading is complete
+        @param timeout: seconds to wait, None waits forever
+        @return: a (value, timestamp_ms, status) tuple, status being READING_OK or READING_STALE,
+        or None if the read failed or timed out
+        """
+        if not self._done.wait(timeout):
+            self.logger.info("Timed out waiting for meter {}".format(self.meter_name), extra=RATE_LIMITED)
+
+        with self._lock:
+            reading = self._reading
+            self._reading = None
+            fresh = self._reading_generation == self._generation
+
+        if reading is None:
+            return None
+
+        return reading[0], reading[1], READING_OK if fresh else READING_STALE
+
+    def stop(self):
+        """
+        Wake the worker so it can observe the shutdown event
+        """
+        self._trigger.set()
+
+    def run(self):
+        while True:
+            self._trigger.wait()
+            self._trigger.clear()
+
+            if self.sig_event.is_set():
+                self.logger.info("Exiting {} {}".format(self.__class__.__name__, self.meter_name))
+                self._done.set()
+                break
+
+            generation = self._read_generation
+            reading = self.read_meter()
+            with self._lock:
+                # a failed read leaves the last late reading, if nobody took it yet
+                if reading is not None:
+                    self._reading = reading
+                    self._reading_generation = generation
+                self._busy = False
+                self._done.set()
+
+    def read_meter(self):
+        """
+        Perform one serial transaction against the meter and stamp it
+        This is also called directly (on a per meter executor) by the asyncio runtime
+        @return: a (value, timestamp_ms) tuple, or None if the read failed
+        """
+        start = time.monotonic()
+        reading = None
+
+        try:
+            start_ms = AretasUtils.now_ms()
+            value = self.connection.read()
+            end_ms = AretasUtils.now_ms()
+
+            reading = (value, (start_ms + end_ms) // 2)
+
+        except MeterUnavailable as mu:
+            # the connection already logged why, this fires every sample until it's back
+            self.logger.info("XDM {} unavailable:{}".format(self.meter_name, mu), extra=RATE_LIMITED)
+            return None
+        except ValueError as ve:
+            self.logger.error("Error reading XDM {} device:{}".format(self.meter_name, ve))
+        except serial.serialutil.SerialTimeoutException as ste:
+            self.logger.error("Error on XDM {} serial port:{}".format(self.meter_name, ste))
+        except Exception as e:
+            self.logger.error("Unknown exception reading XDM {} device:{}".format(self.meter_name, e))
+
+        self._read_seconds.observe(time.monotonic() - start)
+        if reading is None:
+            self._read_errors.inc()
+
+        return reading
@@ -0,0 +1,340 @@
+import logging
+import math
+import os
+import time
+from bisect import bisect_left
+from threading import Lock, Thread
+
+# latency buckets (in seconds), from a fast serial read up to a slow upload
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    """
+    A metric family, the children hold the values for each combination of label values
+    """
+    metric_type = None
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = dict()
+        self._lock = Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *label_values):
+        """
+        @return: the child for these label values, cache it in the hot path rather than calling this every time
+        """
+        key = tuple(str(value) for value in label_values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        return self.labels()
+
+    def collect(self) -> list[str]:
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        for key, child in list(self._children.items()):
+            lines.extend(child.expose(self.name, self.label_names, key))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("_value", "_lock", "_function")
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = Lock()
+        self._function = None
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def set_function(self, function):
+        """
+        Sample the value from function() at scrape time instead, for counters another object already keeps
+        """
+        self._function = function
+
+    def get(self) -> float:
+        if self._function is not None:
+            try:
+                return float(self._function())
+            except Exception:
+                return math.nan
+        return self._value
+
+    def expose(self, name: str, label_names: tuple, label_values: tuple) -> list[str]:
+        return ["{}{} {}".format(name, _format_labels(label_names, label_values), _format_value(self.get()))]
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class _GaugeChild:
+    __slots__ = ("_value", "_function")
+
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value: float):
+        self._value = value
+
+    def set_function(self, function):
+        """
+        Sample the value from function() at scrape time instead, e.g. a queue depth
+        """
+        self._function = function
+
+    def get(self) -> float:
+        if self._function is not None:
+            try:
+                return float(self._function())
+            except Exception:
+                return math.nan
+        return self._value
+
+    def expose(self, name: str, label_names: tuple, label_values: tuple) -> list[str]:
+        return ["{}{} {}".format(name, _format_labels(label_names, label_values), _format_value(self.get()))]
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class _HistogramChild:
+    __slots__ = ("_bounds", "_counts", "_sum", "_lock")
+
+    def __init__(self, bounds: tuple):
+        self._bounds = bounds
+        # one count per bucket plus the +Inf bucket, cumulated at scrape time
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        idx = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+
+    def expose(self, name: str, label_names: tuple, label_values: tuple) -> list[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total_sum = self._sum
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._bounds + (math.inf,), counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(
+                name, _format_labels(label_names, label_values, 'le="{}"'.format(_format_value(bound))), cumulative))
+        lines.append("{}_sum{} {}".format(name, _format_labels(label_names, label_values), _format_value(total_sum)))
+        lines.append("{}_count{} {}".format(name, _format_labels(label_names, label_values), cumulative))
+        return lines
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+
+class MetricsRegistry:
+    """
+    The in-process registry, metrics are created on first use and shared by name
+    """
+
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = Lock()
+
+    def _get_or_create(self, metric_class, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric {} is already registered as a {}".format(name, metric.metric_type))
+            return metric
+
+    def counter(self, name: str, documentation: str, label_names: tuple = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, label_names)
+
+    def gauge(self, name: str, documentation: str, label_names: tuple = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, label_names)
+
+    def histogram(self, name: str, documentation: str, label_names: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, label_names, buckets=buckets)
+
+    def expose(self) -> str:
+        """
+        @return: every metric in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+# the process wide registry
+REGISTRY = MetricsRegistry()
+
+
+def _get_process_start() -> float:
+    """
+    @return: when this process was started, on the time.monotonic() clock, from /proc
+    (or when this module was imported if /proc isn't there)
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # the fields after the command name, starttime is the 22nd field of the line
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.monotonic() - (uptime - (start_ticks / os.sysconf("SC_CLK_TCK")))
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+
+# when the daemon started, the processes runtime's children are handed the supervisor's (see set_process_start)
+PROCESS_START = _get_process_start()
+
+STARTUP_SECONDS = REGISTRY.gauge("pmm_startup_seconds", "Time from the daemon's start to each startup stage",
+                                 ("stage",))
+_startup_stages = set()
+
+
+def set_process_start(process_start: float):
+    """
+    Count the startup stages from process_start (a time.monotonic()) rather than from this process' own start
+    """
+    global PROCESS_START
+    PROCESS_START = process_start
+
+
+def mark_startup(stage: str):
+    """
+    Record (and log) how long after the daemon started a startup stage was first reached,
+    e.g. "first_sample" (see the startup benchmark)
+    """
+    if stage in _startup_stages:
+        return
+    _startup_stages.add(stage)
+
+    elapsed = time.monotonic() - PROCESS_START
+    STARTUP_SECONDS.labels(stage).set(elapsed)
+    logging.getLogger(__name__).info("Startup: {} after {:.3f}s".format(stage, elapsed))
+
+
+def _get_handler_class():
+    """
+    The request handler, http.server is only imported once a metrics endpoint is started since it costs
+    tens of milliseconds at startup
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+
+            body = REGISTRY.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes would otherwise end up on stderr
+            pass
+
+    return _MetricsHandler
+
+
+class MetricsServer(Thread):
+    """
+    Serves the registry on http://host:port/metrics for Prometheus to scrape
+    """
+
+    def __init__(self, host: str, port: int):
+        super(MetricsServer, self).__init__(name="MetricsServer", daemon=True)
+        from http.server import ThreadingHTTPServer
+
+        self.logger = logging.getLogger(__name__)
+        self.server = ThreadingHTTPServer((host, port), _get_handler_class())
+        self.server.daemon_threads = True
+
+    def run(self):
+        self.logger.info("Serving metrics on {}:{}".format(*self.server.server_address))
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,288 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from threading import Event
+import metrics
+from app_config import AppConfig, ConfigWatcher
+from deadline_scheduler import TICK_OVERRUNS
+from log_utils import set_log_level, setup_queue_logging
+from message_harvester import MessageHarvester
+from metrics import REGISTRY, MetricsServer
+from sample_ring import SampleRing, H_ACQUISITION_RESTARTS, H_PUBLISHER_RESTARTS
+from serial_port_read_writer import SerialPortReadWriter, SAMPLES_TAKEN
+
+# forkserver, not fork: the supervisor has threads running (the log writer, the log queue's feeder) by the time it
+# starts or restarts a child, and a child forked from it could inherit one of their locks held
+# the children get the config, the ring and the log queue as pickled arguments, the forkserver has the daemon's
+# modules imported already so they still start quickly
+CONTEXT = multiprocessing.get_context('forkserver')
+CONTEXT.set_forkserver_preload(['__main__', 'process_runtime'])
+
+ACQUISITION = 'acquisition'
+PUBLISHER = 'publisher'
+
+logger = logging.getLogger(__name__)
+
+
+def start_metrics_server(config: AppConfig, port: int):
+    if (config.getboolean('METRICS', 'metrics_enable', fallback=True) is False) or (port == 0):
+        return None
+    try:
+        metrics_server = MetricsServer(config.get('METRICS', 'metrics_host', fallback='127.0.0.1'), port)
+        metrics_server.start()
+        return metrics_server
+    except OSError as e:
+        logger.error("Could not start the metrics endpoint:{}".format(e))
+        return None
+
+
+def setup_child(config: AppConfig, log_queue, process_start: float):
+    """
+    Log through the supervisor's writer and count the startup stages from the daemon's start, a child
+    doesn't inherit either from the supervisor
+    """
+    metrics.set_process_start(process_start)
+    setup_queue_logging(log_queue, config.get('LOGGING', 'log_level', fallback='INFO'),
+                        config.getfloat('LOGGING', 'log_rate_limit_interval', fallback=60.0))
+
+
+def supervisor_alive() -> bool:
+    # our parent is the forkserver, the supervisor is the process that started us
+    return multiprocessing.parent_process().is_alive()
+
+
+def start_config_watcher(config: AppConfig, sig_event: Event) -> ConfigWatcher:
+    # every process watches the file itself, the supervisor passes SIGHUP on
+    config_watcher = ConfigWatcher(config, sig_event)
+    config_watcher.subscribe(lambda new_config: set_log_level(new_config.get('LOGGING', 'log_level', fallback='INFO')))
+    signal.signal(signal.SIGHUP, config_watcher.request_reload)
+    config_watcher.start()
+    return config_watcher
+
+
+def run_acquisition(config: AppConfig, ring: SampleRing, log_queue, process_start: float):
+    """
+    The acquisition process: the sampler, writing into the ring, and nothing else
+    The heartbeat in the ring header only moves while the scheduler keeps ticking, so the supervisor can
+    tell a hung sampler from a live one
+    The supervisor stops us with SIGTERM, a multiprocessing Event would deadlock it if we'd been killed
+    while waiting on it
+    """
+    stop_event = Event()
+
+    # the supervisor decides when we stop, Ctrl+C in a terminal goes to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda sig, frame: stop_event.set())
+    setup_child(config, log_queue, process_start)
+
+    config_watcher = start_config_watcher(config, Event())
+
+    sampler = SerialPortReadWriter(ring, stop_event, config)
+    config_watcher.subscribe(sampler.apply_config)
+    sampler.start()
+    metrics_server = start_metrics_server(config, config.getint('PROCESSES', 'acquisition_metrics_port', fallback=0))
+    logger.info("Acquisition process {} started".format(os.getpid()))
+
+    # the counts carry on from the previous acquisition process
+    ring_stats = ring.get_stats()
+    ticks = -1
+    while sampler.is_alive():
+        sampler.join(1.0)
+
+        stats = sampler.scheduler.get_stats()
+        if stats['ticks'] != ticks:
+            ticks = stats['ticks']
+            ring.set_heartbeat(ring_stats['samples'] + ticks, ring_stats['overruns'] + stats['overruns'])
+
+        if not supervisor_alive():
+            logger.error("The supervisor is gone, stopping the acquisition process")
+            stop_event.set()
+
+    config_watcher.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    logger.info("Acquisition process {} exiting".format(os.getpid()))
+
+
+def run_publisher(config: AppConfig, ring: SampleRing, log_queue, process_start: float):
+    """
+    The publisher process: the harvester and every sink, reading from the ring
+    We keep going until the supervisor closes the ring and we've published what's left in it
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup_child(config, log_queue, process_start)
+
+    sig_event = Event()
+    config_watcher = start_config_watcher(config, sig_event)
+    metrics_server = start_metrics_server(config, config.getint('METRICS', 'metrics_port', fallback=9101))
+
+    # the acquisition process serves its own metrics (acquisition_metrics_port), the sample counts are
+    # mirrored here from the ring header so this endpoint still has the whole picture
+    SAMPLES_TAKEN.set_function(lambda: ring.get_stats()['samples'])
+    TICK_OVERRUNS.set_function(lambda: ring.get_stats()['overruns'])
+    REGISTRY.gauge("pmm_payload_queue_depth",
+                   "Readings waiting between the sampler and the harvester").set_function(ring.__len__)
+    REGISTRY.counter("pmm_ring_dropped_total",
+                     "Readings dropped because the sample ring was full").set_function(
+        lambda: ring.get_stats()['dropped'])
+    REGISTRY.gauge("pmm_acquisition_heartbeat_age_seconds",
+                   "Time since the acquisition process last took a sample").set_function(
+        lambda: max(ring.get_heartbeat_age(), 0) / 1000)
+    restarts = REGISTRY.counter("pmm_process_restarts_total", "Times a process was restarted by the supervisor",
+                                ("process",))
+    restarts.labels(ACQUISITION).set_function(lambda: ring.get_stats()['acquisition_restarts'])
+    restarts.labels(PUBLISHER).set_function(lambda: ring.get_stats()['publisher_restarts'])
+
+    harvester = MessageHarvester(ring, sig_event, config)
+    config_watcher.subscribe(harvester.apply_config)
+    harvester.start()
+    logger.info("Publisher process {} started".format(os.getpid()))
+
+    while harvester.is_alive():
+        harvester.join(1.0)
+
+        if (not supervisor_alive()) and (ring.is_closed() is False):
+            logger.error("The supervisor is gone, stopping the publisher process")
+            ring.set_closed()
+
+    config_watcher.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    logger.info("Publisher process {} exiting".format(os.getpid()))
+
+
+class SupervisedProcess:
+    """
+    One of the supervisor's children, restarted with an exponential backoff when it dies
+    The backoff resets once a child has stayed up for restart_backoff_max seconds
+    """
+
+    def __init__(self, name: str, target, args: tuple, restart_counter: int, backoff_max: float):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.restart_counter = restart_counter
+        self.backoff_max = backoff_max
+
+        self.process = None
+        self.started = 0.0
+        self.backoff = 1.0
+        self.restart_at = None
+
+    def start(self):
+        self.process = CONTEXT.Process(target=self.target, args=self.args, name=self.name)
+        self.process.start()
+        self.started = time.monotonic()
+        self.restart_at = None
+
+    def is_alive(self) -> bool:
+        return (self.process is not None) and self.process.is_alive()
+
+    def check(self, ring: SampleRing):
+        """
+        Restart the process if it died and its backoff is up
+        """
+        if self.is_alive():
+            return
+
+        now_ = time.monotonic()
+        if self.restart_at is None:
+            if (now_ - self.started) >= self.backoff_max:
+                self.backoff = 1.0
+            logger.error("The {} process exited with code {}, restarting it in {:.0f}s".format(
+                self.name, self.process.exitcode, self.backoff))
+            self.restart_at = now_ + self.backoff
+            self.backoff = min(self.backoff * 2, self.backoff_max)
+        elif now_ >= self.restart_at:
+            ring.count_restart(self.restart_counter)
+            self.start()
+
+    def kill(self):
+        if self.is_alive():
+            self.process.kill()
+
+    def signal(self, sig: int):
+        if self.is_alive():
+            os.kill(self.process.pid, sig)
+
+    def join(self, timeout: float):
+        if self.process is None:
+            return
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.error("The {} process didn't stop within {}s, killing it".format(self.name, timeout))
+            self.process.kill()
+            self.process.join()
+
+
+def run_process_daemon(config: AppConfig, log_queue):
+    """
+    The "processes" runtime: the sampler runs in an acquisition process and hands its readings to the
+    harvester and sinks in a publisher process through a SampleRing, so uploads can't hold the GIL, or hang,
+    under the sampler, and the two get a core each
+    This (the supervisor) process owns the ring, restarts either child if it dies (or, for the acquisition
+    process, stops taking samples for acquisition_hang_timeout milliseconds) and shuts them down in order:
+    the acquisition process first, then the publisher once it has emptied the ring
+    @param log_queue: the CONTEXT.Queue setup_logging's writer reads, the children log through it
+    """
+    ring = SampleRing.create(config.getint('PROCESSES', 'ring_capacity', fallback=65536))
+    hang_timeout = config.getint('PROCESSES', 'acquisition_hang_timeout',
+                                 fallback=max(30000, 10 * config.sample_interval))
+    backoff_max = config.getfloat('PROCESSES', 'restart_backoff_max', fallback=60.0)
+
+    acquisition = SupervisedProcess(ACQUISITION, run_acquisition, (config, ring, log_queue, metrics.PROCESS_START),
+                                    H_ACQUISITION_RESTARTS, backoff_max)
+    publisher = SupervisedProcess(PUBLISHER, run_publisher, (config, ring, log_queue, metrics.PROCESS_START),
+                                  H_PUBLISHER_RESTARTS, backoff_max)
+
+    stopping = Event()
+
+    def signal_handler(sig, frame):
+        print('You pressed Ctrl+C!')
+        stopping.set()
+
+    def reload_handler(sig, frame):
+        acquisition.signal(signal.SIGHUP)
+        publisher.signal(signal.SIGHUP)
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGHUP, reload_handler)
+
+    # the sampler first, it can fill the ring while the publisher loads the sinks
+    acquisition.start()
+    publisher.start()
+    logger.info("Supervising the acquisition ({}) and publisher ({}) processes".format(
+        acquisition.process.pid, publisher.process.pid))
+
+    while not stopping.wait(1.0):
+        if acquisition.is_alive() and (time.monotonic() - acquisition.started) * 1000 >= hang_timeout:
+            heartbeat_age = ring.get_heartbeat_age()
+            if (heartbeat_age < 0) or (heartbeat_age >= hang_timeout):
+                logger.error("The acquisition process hasn't taken a sample in {}ms, killing it".format(
+                    heartbeat_age))
+                acquisition.kill()
+                acquisition.process.join()
+
+        acquisition.check(ring)
+        publisher.check(ring)
+
+    logger.info("Stopping the acquisition process")
+    acquisition.signal(signal.SIGTERM)
+    acquisition.join(30.0)
+
+    # whatever the sampler managed to put in the ring still gets published
+    logger.info("Stopping the publisher process, {} readings left in the ring".format(len(ring)))
+    ring.set_closed()
+    if not publisher.is_alive():
+        publisher.start()
+    publisher.join(60.0)
+
+    stats = ring.get_stats()
+    logger.info("Processes stopped, {} samples, {} readings dropped by the ring, {} acquisition and {} publisher "
+                "restarts".format(stats['samples'], stats['dropped'], stats['acquisition_restarts'],
+                                  stats['publisher_restarts']))
+    ring.close()
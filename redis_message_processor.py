@@ -1,70 +1,197 @@
-import configparser
-import json
 import logging
-from multiprocessing import Queue, Event
+import time
+from multiprocessing import Event
 from threading import Thread
 import redis
-import time
-import jsonpickle
+from AretasPythonAPI.utils import Utils as AretasUtils
+from app_config import AppConfig
+from log_utils import RATE_LIMITED
+from metrics import REGISTRY
+from sensor_message_batch import SensorMessageBatch
 from sensor_message_item import SensorMessageItem
+from sink_queue import SinkQueue
+
+# the latest value hash entries keep the layout jsonpickle used to produce so existing readers still work
+JSONPICKLE_CLASS_TAG = "sensor_message_item.SensorMessageItem"
+
+REDIS_WRITTEN = REGISTRY.counter("pmm_redis_messages_total", "Messages written to Redis")
+REDIS_ERRORS = REGISTRY.counter("pmm_redis_errors_total", "Failed Redis commands and pipelines")
+REDIS_FLUSH_SECONDS = REGISTRY.histogram("pmm_redis_flush_seconds", "Duration of one Redis pipeline flush")
 
 
 class RedisQueueReader(Thread):
     """
     This class pumps SensorModel messages into redis
     We don't want any thread blocking while waiting for redis to inject messages, timeout, etc.
+    Whatever is queued is drained and written in a single pipeline per flush:
+    the latest value of each type goes into a hash per mac and, if enabled, every message is
+    appended to a stream per (mac, type) trimmed to the configured retention
     """
 
-    def __init__(self, sig_event: Event):
+    def __init__(self, sig_event: Event, sink_queue: SinkQueue, config: AppConfig = None):
         super(RedisQueueReader, self).__init__()
 
         self.logger = logging.getLogger(__name__)
         self.logger.info("Init Redis Queue Reader")
 
-        # read in the global app config
-        config = configparser.ConfigParser()
-        config.read('config.cfg')
+        if config is None:
+            config = AppConfig.load()
 
         redis_host = config.get("REDIS", "redis_host", fallback="localhost")
         redis_port = config.getint("REDIS", "redis_port", fallback=6379)
         redis_pw = config.get("REDIS", "redis_authpw", fallback="FooBar")
 
-        self.r = redis.StrictRedis(redis_host, redis_port, password=redis_pw, decode_responses=True)
+        self.r = self.create_client(redis_host, redis_port, redis_pw)
 
-        self.message_queue = Queue()
-        self.sig_event = sig_event
+        # the time series streams
+        self.ts_enabled = config.getboolean("REDIS", "redis_ts_enable", fallback=True)
+        self.ts_prefix = config.get("REDIS", "redis_ts_prefix", fallback="ts")
+
+        self.apply_config(config)
 
-        self.thread_sleep = config.getboolean('DEFAULT', 'thread_sleep')
-        self.thread_sleep_time = config.getfloat('DEFAULT', 'thread_sleep_time')
+        self.message_queue = sink_queue
+        self.sig_event = sig_event
 
         self.message_count = 0
 
+    def apply_config(self, config: AppConfig):
+        """
+        The batch size and stream retention, also picked up on a reload (see ConfigWatcher)
+        """
+        # the maximum number of messages written in one pipeline
+        self.batch_size = config.getint("REDIS", "redis_batch_size", fallback=1000)
+        # retention, either by entry count or by age (in milliseconds), age wins if both are set
+        self.ts_maxlen = config.getint("REDIS", "redis_ts_maxlen", fallback=100000)
+        self.ts_retention = config.getint("REDIS", "redis_ts_retention", fallback=0)
+
+    def create_client(self, redis_host: str, redis_port: int, redis_pw: str):
+        return redis.StrictRedis(redis_host, redis_port, password=redis_pw, decode_responses=True)
+
     def inject_message(self, message: SensorMessageItem):
-        self.message_queue.put_nowait(message)
+        self.message_queue.put(message)
+
+    def stop(self):
+        """
+        Close the queue, which wakes the thread (blocked on it) so it can exit
+        """
+        self.message_queue.close()
+
+    def get_ts_key(self, mac, sensor_type: int) -> str:
+        return "{}:{}:{}".format(self.ts_prefix, mac, sensor_type)
 
     def process_message(self, message: SensorMessageItem):
-        try:
-            msg_mac = message.get_mac()
-            msg_type = message.get_type()
-            msg_json = jsonpickle.encode(message)
-            self.r.hset(str(msg_mac), str(msg_type), msg_json)
-            self.message_count += 1
+        self.process_messages([message])
 
-            if ((self.message_count % 100) == 0) or (self.message_count == 1):
-                self.logger.info("Processed {} messages".format(self.message_count))
+    def process_messages(self, messages: list[SensorMessageItem]):
+        """
+        Write a batch of messages in a single (non transactional) pipeline
+        """
+        start = time.monotonic()
+
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            self.queue_commands(pipe, messages)
+            results = pipe.execute(raise_on_error=False)
+            self.record_results(messages, results, start)
 
         except Exception as e:
-            self.logger.error("Error submitting message to Redis:{}".format(e))
+            REDIS_ERRORS.inc()
+            self.logger.error("Error submitting messages to Redis:{}".format(e))
+
+    def queue_commands(self, pipe, messages: list[SensorMessageItem]):
+        """
+        Add the latest value hash updates (one per mac and type) and (if enabled) the stream appends (one per
+        message) for a batch to the pipeline
+        """
+        trim_args = dict()
+        if self.ts_retention > 0:
+            # stream ids start with the insertion time in ms, so MINID trims by age
+            trim_args["minid"] = str(AretasUtils.now_ms() - self.ts_retention)
+        elif self.ts_maxlen > 0:
+            trim_args["maxlen"] = self.ts_maxlen
+        trim_args["approximate"] = True
+
+        batch = SensorMessageBatch()
+        for message in messages:
+            batch.append_item(message)
+
+        for mac, sensor_type, latest_json in batch.iter_latest_json(JSONPICKLE_CLASS_TAG):
+            pipe.hset(str(mac), str(sensor_type), latest_json)
+
+        if self.ts_enabled is True:
+            for n in range(len(batch)):
+                pipe.xadd(self.get_ts_key(batch.get_mac(n), batch.get_type(n)),
+                          {"ts": batch.get_timestamp(n), "data": batch.get_data(n)},
+                          **trim_args)
+
+    def record_results(self, messages: list[SensorMessageItem], results: list, start: float):
+        errors = [result for result in results if isinstance(result, Exception)]
+        if len(errors) > 0:
+            REDIS_ERRORS.inc(len(errors))
+            self.logger.error("{} Redis commands failed, first error:{}".format(len(errors), errors[0]))
+
+        REDIS_WRITTEN.inc(len(messages))
+        REDIS_FLUSH_SECONDS.observe(time.monotonic() - start)
+
+        previous_count = self.message_count
+        self.message_count += len(messages)
+
+        if ((self.message_count // 100) != (previous_count // 100)) or (previous_count == 0):
+            self.logger.info("Processed {} messages".format(self.message_count), extra=RATE_LIMITED)
 
     def run(self):
         while True:
-            while not self.message_queue.empty():
-                message: SensorMessageItem = self.message_queue.get()
-                self.process_message(message)
+            # block until there's a message, we get None once the queue is closed and empty
+            message: SensorMessageItem = self.message_queue.get()
 
-            if self.sig_event.is_set():
+            if message is None:
                 print("Exiting {}".format(self.__class__.__name__))
                 break
 
-            if self.thread_sleep is True:
-                time.sleep(self.thread_sleep_time)
+            # then drain whatever else is already queued into the same pipeline
+            batch = [message]
+            batch.extend(self.message_queue.drain(self.batch_size - 1))
+
+            self.process_messages(batch)
+
+
+class AsyncRedisQueueReader(RedisQueueReader):
+    """
+    The Redis sink for the asyncio runtime (see async_runtime), the same pipelines written with the redis.asyncio client
+    """
+
+    def create_client(self, redis_host: str, redis_port: int, redis_pw: str):
+        # only the asyncio runtime needs the async client
+        import redis.asyncio
+        return redis.asyncio.StrictRedis(host=redis_host, port=redis_port, password=redis_pw, decode_responses=True)
+
+    async def process_messages_async(self, messages: list[SensorMessageItem]):
+        start = time.monotonic()
+
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            self.queue_commands(pipe, messages)
+            results = await pipe.execute(raise_on_error=False)
+            self.record_results(messages, results, start)
+
+        except Exception as e:
+            REDIS_ERRORS.inc()
+            self.logger.error("Error submitting messages to Redis:{}".format(e))
+
+    async def run_async(self):
+        try:
+            while True:
+                # wait until there's a message, we get None once the queue is closed and empty
+                message: SensorMessageItem = await self.message_queue.get_async()
+
+                if message is None:
+                    break
+
+                # then drain whatever else is already queued into the same pipeline
+                batch = [message]
+                batch.extend(self.message_queue.drain(self.batch_size - 1))
+
+                await self.process_messages_async(batch)
+        finally:
+            self.logger.info("Exiting {}".format(self.__class__.__name__))
+            await self.r.close()
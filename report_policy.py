@@ -0,0 +1,191 @@
+import configparser
+import logging
+from metrics import REGISTRY
+
+REPORT_SECTION_PREFIX = "REPORT:"
+DEFAULT_POLICY_NAME = "default"
+
+# what to do with a reading
+REPORT_NONE = 0
+REPORT_NEXT = 1
+REPORT_NOW = 2
+
+# how a reading moved relative to its thresholds
+THRESHOLD_NONE = 0
+THRESHOLD_CROSSED = 1
+THRESHOLD_CLEARED = 2
+
+REPORT_SUPPRESSED = REGISTRY.counter("pmm_report_suppressed_total", "Readings within their deadband, not reported")
+REPORT_URGENT = REGISTRY.counter("pmm_report_urgent_total", "Readings reported out of band after crossing a threshold")
+REPORT_HEARTBEATS = REGISTRY.counter("pmm_report_heartbeats_total", "Unchanged readings reported for the heartbeat")
+
+
+class ReportPolicy:
+    """
+    When a sensor type is worth reporting
+     * deadband / deadband_pct: a reading is only reported once it differs from the last reported value by more
+       than deadband, and more than deadband_pct percent of that value (0 disables either, so deadband_pct
+       does the work on large values while deadband keeps the noise around zero out)
+     * heartbeat: the latest reading is reported at least every heartbeat milliseconds, changed or not (0 disables it)
+     * threshold_high / threshold_low: a reading that crosses above / below is reported immediately, it has to come
+       back by threshold_hysteresis before crossing again counts as a new event
+    The default policy reports every new reading at the next report interval, as before
+    """
+
+    def __init__(self, deadband: float = 0.0, deadband_pct: float = 0.0, heartbeat: int = 0,
+                 threshold_high: float = None, threshold_low: float = None, threshold_hysteresis: float = 0.0):
+        self.deadband = deadband
+        self.deadband_pct = deadband_pct
+        self.heartbeat = heartbeat
+        self.threshold_high = threshold_high
+        self.threshold_low = threshold_low
+        self.threshold_hysteresis = threshold_hysteresis
+
+    @staticmethod
+    def from_config(config: configparser.ConfigParser, section: str) -> 'ReportPolicy':
+        def get_optional(key: str):
+            value = config.get(section, key, fallback=None)
+            return None if (value is None) or (value.strip() == "") else float(value)
+
+        return ReportPolicy(config.getfloat(section, 'deadband', fallback=0.0),
+                            config.getfloat(section, 'deadband_pct', fallback=0.0),
+                            config.getint(section, 'heartbeat', fallback=0),
+                            get_optional('threshold_high'),
+                            get_optional('threshold_low'),
+                            config.getfloat(section, 'threshold_hysteresis', fallback=0.0))
+
+    def has_thresholds(self) -> bool:
+        return (self.threshold_high is not None) or (self.threshold_low is not None)
+
+    def is_significant(self, value: float, last_value: float) -> bool:
+        if (self.deadband <= 0) and (self.deadband_pct <= 0):
+            # no deadband, every reading counts
+            return True
+        change = abs(value - last_value)
+        return (change > self.deadband) and (change > (abs(last_value) * self.deadband_pct / 100.0))
+
+    def is_out_of_bounds(self, value: float, slack: float = 0.0) -> bool:
+        """
+        @param slack: how far inside the thresholds still counts as out of bounds (the hysteresis)
+        """
+        if (self.threshold_high is not None) and (value > (self.threshold_high - slack)):
+            return True
+        if (self.threshold_low is not None) and (value < (self.threshold_low + slack)):
+            return True
+        return False
+
+
+def load_report_policies(config: configparser.ConfigParser) -> tuple:
+    """
+    @return: the (default policy, {sensor type: policy}) from the [REPORT:<type>] sections
+    """
+    default_policy = ReportPolicy()
+    policies = dict()
+
+    for section in config.sections():
+        if not section.startswith(REPORT_SECTION_PREFIX):
+            continue
+        name = section[len(REPORT_SECTION_PREFIX):]
+        policy = ReportPolicy.from_config(config, section)
+        if name == DEFAULT_POLICY_NAME:
+            default_policy = policy
+        else:
+            policies[int(name)] = policy
+
+    return default_policy, policies
+
+
+class ThresholdMonitor:
+    """
+    Tracks, per (mac, type), whether the readings are currently beyond their policy's thresholds
+    """
+
+    def __init__(self):
+        # the (mac, type) keys currently beyond a threshold
+        self._out_of_bounds: set = set()
+
+    def update(self, key: tuple, policy: ReportPolicy, value: float) -> int:
+        """
+        @return: THRESHOLD_CROSSED if the reading crossed a threshold, THRESHOLD_CLEARED if it came back by the
+        hysteresis (so the next crossing counts as a new event), otherwise THRESHOLD_NONE
+        """
+        if key in self._out_of_bounds:
+            if not policy.is_out_of_bounds(value, policy.threshold_hysteresis):
+                self._out_of_bounds.discard(key)
+                return THRESHOLD_CLEARED
+        elif policy.is_out_of_bounds(value):
+            self._out_of_bounds.add(key)
+            return THRESHOLD_CROSSED
+        return THRESHOLD_NONE
+
+
+class ReportFilter:
+    """
+    Applies the per sensor type ReportPolicies to every reading going to the API
+    Policies come from [REPORT:<type>] sections, [REPORT:default] applies to the types without their own
+    The filter tracks, per (mac, type), the last value and time it was reported and whether the reading
+    is currently beyond a threshold
+    """
+
+    def __init__(self, config: configparser.ConfigParser):
+        self.logger = logging.getLogger(__name__)
+
+        self.default_policy = ReportPolicy()
+        self.policies: dict[int, ReportPolicy] = dict()
+        self.load_policies(config)
+
+        # (mac, type) -> [last reported value, last reported time]
+        self._reported: dict[tuple, list] = dict()
+        self.thresholds = ThresholdMonitor()
+
+        self.suppressed = 0
+        self.urgent = 0
+        self.heartbeats = 0
+
+    def load_policies(self, config: configparser.ConfigParser):
+        """
+        (Re)load the policies, the last reported values and threshold states are kept
+        """
+        self.default_policy, self.policies = load_report_policies(config)
+
+    def get_policy(self, sensor_type: int) -> ReportPolicy:
+        return self.policies.get(sensor_type, self.default_policy)
+
+    def evaluate(self, mac, sensor_type: int, value: float) -> int:
+        """
+        Decide what to do with a reading, called for every reading
+        @return: REPORT_NOW if it crossed a threshold, REPORT_NEXT if it's changed enough to go in the next report,
+        otherwise REPORT_NONE
+        """
+        key = (mac, sensor_type)
+        policy = self.get_policy(sensor_type)
+
+        if policy.has_thresholds() and (self.thresholds.update(key, policy, value) == THRESHOLD_CROSSED):
+            self.urgent += 1
+            REPORT_URGENT.inc()
+            return REPORT_NOW
+
+        reported = self._reported.get(key)
+        if (reported is None) or policy.is_significant(value, reported[0]):
+            return REPORT_NEXT
+
+        self.suppressed += 1
+        REPORT_SUPPRESSED.inc()
+        return REPORT_NONE
+
+    def is_heartbeat_due(self, mac, sensor_type: int, now_: int) -> bool:
+        """
+        @return: True if the latest reading has to be reported (changed or not) to keep the heartbeat
+        """
+        policy = self.get_policy(sensor_type)
+        if policy.heartbeat <= 0:
+            return False
+
+        reported = self._reported.get((mac, sensor_type))
+        return (reported is None) or ((now_ - reported[1]) >= policy.heartbeat)
+
+    def mark_reported(self, mac, sensor_type: int, value: float, now_: int, heartbeat: bool = False):
+        self._reported[(mac, sensor_type)] = [value, now_]
+        if heartbeat is True:
+            self.heartbeats += 1
+            REPORT_HEARTBEATS.inc()
@@ -0,0 +1,138 @@
+import logging
+import math
+from array import array
+from sensor_message_item import SensorMessageItem
+
+# the aggregate sensor types are derived from the base type by appending a digit,
+# e.g. current (531) produces 5311 (min), 5312 (max), 5313 (mean), 5314 (RMS) and 5315 (sample count)
+# the "last" value of a window is published under the base type itself
+AGG_MIN = 1
+AGG_MAX = 2
+AGG_MEAN = 3
+AGG_RMS = 4
+AGG_COUNT = 5
+
+
+def aggregate_type(base_type: int, aggregate: int) -> int:
+    return (base_type * 10) + aggregate
+
+
+class SampleRingBuffer:
+    """
+    A fixed-size, preallocated ring of (timestamp, value) samples for one sensor type
+    There is a single writer (the sampler) and readers only ever look at slots the writer has published,
+    the write counter is bumped after the slot is filled, so no lock is needed
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._values = array('d', bytes(8 * capacity))
+        self._timestamps = array('q', bytes(8 * capacity))
+        # total number of samples ever written, the slot index is write_count % capacity
+        self._write_count = 0
+
+    def append(self, value: float, timestamp: int):
+        idx = self._write_count % self.capacity
+        self._values[idx] = value
+        self._timestamps[idx] = timestamp
+        # publish the slot only once it's fully written
+        self._write_count += 1
+
+    def get_write_count(self) -> int:
+        return self._write_count
+
+    def window_stats(self, start_count: int, end_count: int):
+        """
+        Compute the statistics of the samples written between two write counts
+        If the writer lapped the reader, only the samples still in the ring are used
+        @return: a (min, max, mean, rms, last, last_timestamp, count, overrun) tuple or None if the window is empty
+        """
+        overrun = 0
+        if (end_count - start_count) > self.capacity:
+            overrun = (end_count - start_count) - self.capacity
+            start_count = end_count - self.capacity
+
+        count = end_count - start_count
+        if count <= 0:
+            return None
+
+        values = self._values
+        capacity = self.capacity
+
+        v_min = math.inf
+        v_max = -math.inf
+        v_sum = 0.0
+        v_sum_sq = 0.0
+
+        for n in range(start_count, end_count):
+            value = values[n % capacity]
+            if value < v_min:
+                v_min = value
+            if value > v_max:
+                v_max = value
+            v_sum += value
+            v_sum_sq += value * value
+
+        last_idx = (end_count - 1) % capacity
+
+        return (v_min,
+                v_max,
+                v_sum / count,
+                math.sqrt(v_sum_sq / count),
+                values[last_idx],
+                self._timestamps[last_idx],
+                count,
+                overrun)
+
+
+class SampleAggregator:
+    """
+    Collects high-rate samples into one SampleRingBuffer per sensor type and
+    reduces each report window to a handful of SensorMessageItems
+    """
+
+    def __init__(self, capacity: int):
+        self.logger = logging.getLogger(__name__)
+        self.capacity = capacity
+        self._buffers: dict[int, SampleRingBuffer] = dict()
+        # the write count of each buffer at the last flush
+        self._flushed: dict[int, int] = dict()
+
+    def record(self, sensor_type: int, value: float, timestamp: int):
+        ring = self._buffers.get(sensor_type)
+        if ring is None:
+            # one-time allocation per sensor type, every later sample goes into the preallocated ring
+            ring = SampleRingBuffer(self.capacity)
+            self._buffers[sensor_type] = ring
+            self._flushed[sensor_type] = 0
+        ring.append(value, timestamp)
+
+    def flush(self, mac) -> list[SensorMessageItem]:
+        """
+        Reduce the samples recorded since the previous flush
+        @return: last, min, max, mean, RMS and sample count for every sensor type with new samples
+        """
+        ret = list()
+
+        for sensor_type, ring in self._buffers.items():
+            end_count = ring.get_write_count()
+            stats = ring.window_stats(self._flushed[sensor_type], end_count)
+            self._flushed[sensor_type] = end_count
+
+            if stats is None:
+                continue
+
+            v_min, v_max, v_mean, v_rms, v_last, last_ts, count, overrun = stats
+
+            if overrun > 0:
+                self.logger.warning("Ring buffer for type {} overran by {} samples, increase ring_buffer_size".format(
+                    sensor_type, overrun))
+
+            ret.append(SensorMessageItem(mac, sensor_type, v_last, last_ts))
+            ret.append(SensorMessageItem(mac, aggregate_type(sensor_type, AGG_MIN), v_min, last_ts))
+            ret.append(SensorMessageItem(mac, aggregate_type(sensor_type, AGG_MAX), v_max, last_ts))
+            ret.append(SensorMessageItem(mac, aggregate_type(sensor_type, AGG_MEAN), v_mean, last_ts))
+            ret.append(SensorMessageItem(mac, aggregate_type(sensor_type, AGG_RMS), v_rms, last_ts))
+            ret.append(SensorMessageItem(mac, aggregate_type(sensor_type, AGG_COUNT), float(count), last_ts))
+
+        return ret
@@ -0,0 +1,220 @@
+import os
+import select
+import struct
+import time
+from multiprocessing import context, reduction, shared_memory
+from queue import Full
+from sensor_message_item import SensorMessageItem, MAX_MAC_LENGTH
+
+# the header is a row of int64 fields, the writer owns head, the reader owns tail
+_HEADER = struct.Struct("=12q")
+H_CAPACITY = 0
+H_HEAD = 1
+H_TAIL = 2
+H_DROPPED = 3
+H_CLOSED = 4
+H_HEARTBEAT = 5
+H_SAMPLES = 6
+H_OVERRUNS = 7
+H_ACQUISITION_RESTARTS = 8
+H_PUBLISHER_RESTARTS = 9
+
+# seq, mac, type, value, timestamp
+_RECORD = struct.Struct("=q{}sqdq".format(MAX_MAC_LENGTH))
+_SEQ = struct.Struct("=q")
+
+
+def monotonic_ms() -> int:
+    # CLOCK_MONOTONIC is system wide, so both processes can compare these
+    return int(time.monotonic() * 1000)
+
+
+class SampleRing:
+    """
+    A single producer / single consumer ring of fixed size reading records in shared memory, it carries the
+    readings from the acquisition process to the publisher process (see process_runtime)
+    The ring is created by the supervisor and outlives both processes, so either one can be restarted
+    without losing what's in the ring, the head and tail counters live in the shared header
+    Every record carries its sequence number, written after the rest of the record, the reader only takes
+    a record once its sequence number is there
+    The writer wakes the reader through a non-blocking pipe rather than a multiprocessing Event, whose set()
+    blocks forever once a process is killed while waiting on it
+    The processes get the ring as a Process argument: it's pickled as the shared memory name and the pipe's
+    file descriptors, which the forkserver passes on to the child (see attach)
+    The writer side mimics a Queue (put_nowait raises Full when the ring is full, the reading is dropped),
+    the reader side mimics a SinkQueue (get/drain)
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, wakeup: tuple, owner: bool = False):
+        self.shm = shm
+        self.buf = shm.buf
+        self.wakeup_read, self.wakeup_write = wakeup
+        self.owner = owner
+        self.capacity = self._get(H_CAPACITY)
+
+    @staticmethod
+    def create(capacity: int) -> 'SampleRing':
+        """
+        Create the ring, in the supervisor
+        """
+        shm = shared_memory.SharedMemory(create=True, size=_HEADER.size + (capacity * _RECORD.size))
+        _HEADER.pack_into(shm.buf, 0, *([0] * 12))
+        struct.pack_into("=q", shm.buf, H_CAPACITY * 8, capacity)
+
+        wakeup = os.pipe()
+        for fd in wakeup:
+            os.set_blocking(fd, False)
+
+        return SampleRing(shm, wakeup, owner=True)
+
+    @staticmethod
+    def attach(name: str, wakeup_read, wakeup_write) -> 'SampleRing':
+        """
+        Open the ring created by the supervisor, in a child process
+        @param wakeup_read: the pipe's read end, as passed on by the forkserver (see __reduce__)
+        """
+        return SampleRing(shared_memory.SharedMemory(name=name), (wakeup_read.detach(), wakeup_write.detach()))
+
+    def __reduce__(self):
+        # only while starting a process, the descriptors are duplicated into the child rather than shared by a thread
+        context.assert_spawning(self)
+        return SampleRing.attach, (self.shm.name, reduction.DupFd(self.wakeup_read),
+                                   reduction.DupFd(self.wakeup_write))
+
+    def _wake_reader(self):
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except BlockingIOError:
+            # the pipe is full of wakeups already
+            pass
+
+    def _get(self, field: int) -> int:
+        return struct.unpack_from("=q", self.buf, field * 8)[0]
+
+    def _set(self, field: int, value: int):
+        struct.pack_into("=q", self.buf, field * 8, value)
+
+    def __len__(self):
+        return self._get(H_HEAD) - self._get(H_TAIL)
+
+    # the writer side
+
+    def put_nowait(self, item: SensorMessageItem):
+        """
+        Append a reading, the None the sampler enqueues on exit is ignored, the supervisor closes the ring
+        """
+        if item is None:
+            return
+
+        head = self._get(H_HEAD)
+        if (head - self._get(H_TAIL)) >= self.capacity:
+            self._set(H_DROPPED, self._get(H_DROPPED) + 1)
+            raise Full()
+
+        mac = str(item.get_mac()).encode('utf-8')
+        if len(mac) > MAX_MAC_LENGTH:
+            raise ValueError("MAC {} is longer than {} bytes".format(item.get_mac(), MAX_MAC_LENGTH))
+
+        offset = _HEADER.size + ((head % self.capacity) * _RECORD.size)
+        # the sequence number goes in last, it's what publishes the record
+        _RECORD.pack_into(self.buf, offset, 0, mac, int(item.get_type()), float(item.get_data()),
+                          int(item.get_timestamp()))
+        _SEQ.pack_into(self.buf, offset, head + 1)
+        self._set(H_HEAD, head + 1)
+        self._wake_reader()
+
+    def set_heartbeat(self, samples: int, overruns: int):
+        self._set(H_SAMPLES, samples)
+        self._set(H_OVERRUNS, overruns)
+        self._set(H_HEARTBEAT, monotonic_ms())
+
+    def get_heartbeat_age(self) -> int:
+        """
+        @return: milliseconds since the acquisition process last made progress, -1 if it never did
+        """
+        heartbeat = self._get(H_HEARTBEAT)
+        return -1 if heartbeat == 0 else monotonic_ms() - heartbeat
+
+    # the reader side
+
+    def _pop(self):
+        tail = self._get(H_TAIL)
+        if tail >= self._get(H_HEAD):
+            return None
+
+        offset = _HEADER.size + ((tail % self.capacity) * _RECORD.size)
+        seq, mac, sensor_type, value, timestamp = _RECORD.unpack_from(self.buf, offset)
+        if seq != (tail + 1):
+            # the head moved but the record isn't all there yet
+            return None
+
+        self._set(H_TAIL, tail + 1)
+        return SensorMessageItem(mac.rstrip(b'\0').decode('utf-8'), sensor_type, value, timestamp)
+
+    def get(self, timeout: float = None):
+        """
+        Block until a reading is available
+        @param timeout: seconds to wait, None waits until a reading arrives or the ring is closed
+        @return: the oldest reading, or None on timeout or once the ring is closed and empty
+        """
+        deadline = None if timeout is None else (time.monotonic() + timeout)
+
+        while True:
+            # empty the pipe before looking, a record published in between writes to it again
+            try:
+                while len(os.read(self.wakeup_read, 4096)) > 0:
+                    pass
+            except BlockingIOError:
+                pass
+
+            item = self._pop()
+            if item is not None:
+                return item
+
+            if self.is_closed():
+                return None
+
+            wait = 0.5 if deadline is None else min(0.5, deadline - time.monotonic())
+            if wait <= 0:
+                return None
+            select.select([self.wakeup_read], [], [], wait)
+
+    def drain(self, max_items: int) -> list[SensorMessageItem]:
+        ret = []
+        while len(ret) < max_items:
+            item = self._pop()
+            if item is None:
+                break
+            ret.append(item)
+        return ret
+
+    def is_closed(self) -> bool:
+        return self._get(H_CLOSED) != 0
+
+    def set_closed(self):
+        """
+        No more readings are coming, the reader returns None once it has what's left
+        """
+        self._set(H_CLOSED, 1)
+        self._wake_reader()
+
+    def get_stats(self) -> dict:
+        return {
+            'depth': len(self),
+            'dropped': self._get(H_DROPPED),
+            'samples': self._get(H_SAMPLES),
+            'overruns': self._get(H_OVERRUNS),
+            'acquisition_restarts': self._get(H_ACQUISITION_RESTARTS),
+            'publisher_restarts': self._get(H_PUBLISHER_RESTARTS)
+        }
+
+    def count_restart(self, field: int):
+        self._set(field, self._get(field) + 1)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner is True:
+            self.shm.unlink()
+            os.close(self.wakeup_read)
+            os.close(self.wakeup_write)
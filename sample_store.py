@@ -0,0 +1,426 @@
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from metrics import REGISTRY
+
+# every partition of a series is a pair of column files of native int64 timestamps and float64 values
+# plus a file of per rollup_interval (bucket start, min, max, sum, count) records for fast downsampling
+_TS_SUFFIX = ".ts"
+_VAL_SUFFIX = ".val"
+_ROLLUP_SUFFIX = ".rollup"
+_ROLLUP_RECORD = struct.Struct("=qdddq")
+_ITEM_SIZE = 8
+
+STORE_SAMPLES = REGISTRY.counter("pmm_store_samples_total", "Readings written to the local store")
+STORE_OUT_OF_ORDER = REGISTRY.counter("pmm_store_out_of_order_total", "Readings older than the latest one stored "
+                                                                      "for their series, not stored")
+STORE_FLUSH_SECONDS = REGISTRY.histogram("pmm_store_flush_seconds", "Duration of one local store flush")
+STORE_QUERY_SECONDS = REGISTRY.histogram("pmm_store_query_seconds", "Duration of one local store query")
+
+
+def _merge_bucket(buckets: dict, bucket_start: int, min_: float, max_: float, sum_: float, count: int):
+    bucket = buckets.get(bucket_start)
+    if bucket is None:
+        buckets[bucket_start] = [min_, max_, sum_, count]
+    else:
+        bucket[0] = min(bucket[0], min_)
+        bucket[1] = max(bucket[1], max_)
+        bucket[2] += sum_
+        bucket[3] += count
+
+
+class _SeriesWriter:
+    """
+    The write buffer of one (mac, type) series: the readings of the current partition not flushed yet,
+    the rollup bucket being filled and the rollup records not flushed yet
+    """
+    __slots__ = ("base_dir", "partition_start", "last_ts", "timestamps", "values",
+                 "rollup_start", "rollup_min", "rollup_max", "rollup_sum", "rollup_count", "rollups")
+
+    def __init__(self, base_dir: str, last_ts: int):
+        self.base_dir = base_dir
+        self.partition_start = None
+        self.last_ts = last_ts
+        self.timestamps = array('q')
+        self.values = array('d')
+        self.rollup_start = None
+        self.rollup_min = 0.0
+        self.rollup_max = 0.0
+        self.rollup_sum = 0.0
+        self.rollup_count = 0
+        self.rollups = bytearray()
+
+
+class SampleStore:
+    """
+    An embedded, append-only columnar store for the readings, indexed by (mac, type, time)
+    Each series lives in store_dir/<mac>/<type>/ as one set of files per time partition
+    (partition_interval milliseconds, a day by default), named after the partition's start time:
+     * <start>.ts and <start>.val: the timestamps and values, in time order
+     * <start>.rollup: the min/max/sum/count of every rollup_interval bucket
+    A query only opens the partitions overlapping its range, finds the range in the memory mapped timestamp
+    column with a binary search and reads just that slice of the columns
+    Downsampled queries with buckets that are a multiple of rollup_interval are answered from the rollups
+    (1440 records a day at the default of a minute) and only the tail not rolled up yet is read raw
+    There's a single writer (append() and flush()), queries can run from any thread as the files
+    are only ever appended to, they see the readings up to the last flush
+    """
+
+    def __init__(self, store_dir: str, partition_interval: int = 86400000, rollup_interval: int = 60000,
+                 retention: int = 0):
+
+        if (rollup_interval <= 0) or (partition_interval % rollup_interval != 0):
+            raise ValueError("The store partition interval ({}) has to be a multiple of the rollup interval ({})"
+                             .format(partition_interval, rollup_interval))
+
+        self.logger = logging.getLogger(__name__)
+
+        self.store_dir = store_dir
+        self.partition_interval = partition_interval
+        self.rollup_interval = rollup_interval
+        # milliseconds of data to keep, 0 keeps everything
+        self.retention = retention
+
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        self._series: dict[tuple, _SeriesWriter] = dict()
+
+        self.written = 0
+        self.out_of_order = 0
+
+    def _series_dir(self, mac, sensor_type: int) -> str:
+        return os.path.join(self.store_dir, str(mac).replace(os.sep, "_"), str(sensor_type))
+
+    def _list_partitions(self, series_dir: str) -> list[int]:
+        """
+        @return: the start times of the partitions of a series, oldest first
+        """
+        try:
+            names = os.listdir(series_dir)
+        except FileNotFoundError:
+            return []
+
+        return sorted(int(name[:-len(_TS_SUFFIX)]) for name in names if name.endswith(_TS_SUFFIX))
+
+    @staticmethod
+    def _column_length(base: str) -> int:
+        """
+        @return: the number of complete rows in a partition, a crash may have left one column a little longer
+        """
+        try:
+            return min(os.path.getsize(base + _TS_SUFFIX), os.path.getsize(base + _VAL_SUFFIX)) // _ITEM_SIZE
+        except FileNotFoundError:
+            return 0
+
+    def _get_writer(self, mac, sensor_type: int) -> _SeriesWriter:
+        key = (mac, sensor_type)
+        writer = self._series.get(key)
+        if writer is None:
+            # carry on from the latest reading on disk, so a restart doesn't break the time order
+            series_dir = self._series_dir(mac, sensor_type)
+            writer = _SeriesWriter(series_dir, None)
+            partitions = self._list_partitions(series_dir)
+            if len(partitions) > 0:
+                self._recover_partition(writer, partitions[-1])
+            self._series[key] = writer
+        return writer
+
+    def _recover_partition(self, writer: _SeriesWriter, partition_start: int):
+        """
+        Pick up the latest partition of a series after a restart
+        The rollup records cover the partition's readings in order, so the readings past the sum of their counts
+        are the ones an unclean stop (no close()) left without a record, they're rolled up again here: the whole
+        buckets into records written by the next flush, the last one into the writer's open bucket
+        A crash in the middle of a write may also have left one column, or the rollups, with a partial row,
+        it's cut off so the next flush appends in line
+        """
+        base = os.path.join(writer.base_dir, str(partition_start))
+        n = self._column_length(base)
+        if n == 0:
+            return
+        for suffix in (_TS_SUFFIX, _VAL_SUFFIX):
+            if os.path.getsize(base + suffix) > n * _ITEM_SIZE:
+                os.truncate(base + suffix, n * _ITEM_SIZE)
+
+        rolled_up = 0
+        try:
+            with open(base + _ROLLUP_SUFFIX, "rb") as f:
+                data = f.read()
+            whole = len(data) - (len(data) % _ROLLUP_RECORD.size)
+            if whole < len(data):
+                os.truncate(base + _ROLLUP_SUFFIX, whole)
+            rolled_up = sum(record[4] for record in _ROLLUP_RECORD.iter_unpack(data[:whole]))
+        except FileNotFoundError:
+            pass
+
+        timestamps = array('q')
+        values = array('d')
+        with open(base + _TS_SUFFIX, "rb") as f:
+            f.seek((n - 1) * _ITEM_SIZE)
+            writer.last_ts = array('q', f.read(_ITEM_SIZE))[0]
+            if rolled_up < n:
+                f.seek(rolled_up * _ITEM_SIZE)
+                timestamps.frombytes(f.read((n - rolled_up) * _ITEM_SIZE))
+        if len(timestamps) == 0:
+            return
+        with open(base + _VAL_SUFFIX, "rb") as f:
+            f.seek(rolled_up * _ITEM_SIZE)
+            values.frombytes(f.read(len(timestamps) * _ITEM_SIZE))
+
+        writer.partition_start = partition_start
+        for timestamp, value in zip(timestamps, values):
+            self._add_to_rollup(writer, timestamp, value)
+        self.logger.info("Rolled up {} readings of {} left without a rollup record".format(len(timestamps), base))
+
+    def append(self, mac, sensor_type: int, timestamp: int, value: float):
+        """
+        Buffer a reading, readings older than the latest one of their series are dropped
+        """
+        writer = self._get_writer(mac, sensor_type)
+
+        if (writer.last_ts is not None) and (timestamp < writer.last_ts):
+            self.out_of_order += 1
+            STORE_OUT_OF_ORDER.inc()
+            return
+
+        partition_start = timestamp - (timestamp % self.partition_interval)
+        if partition_start != writer.partition_start:
+            # the last rollup bucket belongs to the partition we're leaving
+            self._close_rollup(writer)
+            self._flush_series(writer)
+            writer.partition_start = partition_start
+
+        self._add_to_rollup(writer, timestamp, value)
+
+        writer.timestamps.append(timestamp)
+        writer.values.append(value)
+        writer.last_ts = timestamp
+
+        self.written += 1
+        STORE_SAMPLES.inc()
+
+    def _add_to_rollup(self, writer: _SeriesWriter, timestamp: int, value: float):
+        rollup_start = timestamp - (timestamp % self.rollup_interval)
+        if rollup_start != writer.rollup_start:
+            self._close_rollup(writer)
+            writer.rollup_start = rollup_start
+            writer.rollup_min = value
+            writer.rollup_max = value
+            writer.rollup_sum = 0.0
+            writer.rollup_count = 0
+
+        writer.rollup_min = min(writer.rollup_min, value)
+        writer.rollup_max = max(writer.rollup_max, value)
+        writer.rollup_sum += value
+        writer.rollup_count += 1
+
+    @staticmethod
+    def _close_rollup(writer: _SeriesWriter):
+        if writer.rollup_count > 0:
+            writer.rollups += _ROLLUP_RECORD.pack(writer.rollup_start, writer.rollup_min, writer.rollup_max,
+                                                  writer.rollup_sum, writer.rollup_count)
+        writer.rollup_count = 0
+
+    def _flush_series(self, writer: _SeriesWriter):
+        if (len(writer.timestamps) == 0) and (len(writer.rollups) == 0):
+            return
+
+        os.makedirs(writer.base_dir, exist_ok=True)
+        base = os.path.join(writer.base_dir, str(writer.partition_start))
+
+        # the values go first, a row only counts once its timestamp is written
+        with open(base + _VAL_SUFFIX, "ab") as f:
+            f.write(writer.values.tobytes())
+        with open(base + _TS_SUFFIX, "ab") as f:
+            f.write(writer.timestamps.tobytes())
+        if len(writer.rollups) > 0:
+            with open(base + _ROLLUP_SUFFIX, "ab") as f:
+                f.write(writer.rollups)
+
+        writer.timestamps = array('q')
+        writer.values = array('d')
+        writer.rollups = bytearray()
+
+    def flush(self):
+        """
+        Write the buffered readings out, they're visible to queries from here on
+        """
+        start = time.monotonic()
+        for writer in self._series.values():
+            self._flush_series(writer)
+        STORE_FLUSH_SECONDS.observe(time.monotonic() - start)
+
+    def close(self):
+        """
+        Close the open rollup buckets and flush, a bucket continued after a restart gets a second record
+        which the queries merge (after an unclean stop the open bucket is rebuilt instead, see _recover_partition)
+        """
+        for writer in self._series.values():
+            self._close_rollup(writer)
+        self.flush()
+
+    def enforce_retention(self, now_: int = None):
+        """
+        Delete the partitions that ended more than retention milliseconds ago
+        """
+        if self.retention <= 0:
+            return
+
+        if now_ is None:
+            now_ = int(time.time() * 1000)
+
+        cutoff = now_ - self.retention
+        for mac, sensor_type in self.get_series():
+            series_dir = self._series_dir(mac, sensor_type)
+            for partition_start in self._list_partitions(series_dir):
+                if (partition_start + self.partition_interval) > cutoff:
+                    break
+                for suffix in (_TS_SUFFIX, _VAL_SUFFIX, _ROLLUP_SUFFIX):
+                    try:
+                        os.remove(os.path.join(series_dir, str(partition_start) + suffix))
+                    except FileNotFoundError:
+                        pass
+                self.logger.info("Deleted store partition {} of {}:{}".format(partition_start, mac, sensor_type))
+
+    def get_series(self) -> list[tuple]:
+        """
+        @return: the (mac, type) of every series in the store
+        """
+        ret = []
+        for mac in sorted(os.listdir(self.store_dir)):
+            mac_dir = os.path.join(self.store_dir, mac)
+            if not os.path.isdir(mac_dir):
+                continue
+            for sensor_type in sorted(os.listdir(mac_dir), key=lambda name: (len(name), name)):
+                if sensor_type.isdigit():
+                    ret.append((mac, int(sensor_type)))
+        return ret
+
+    def _get_partitions(self, mac, sensor_type: int, start: int, end: int) -> list[tuple]:
+        """
+        @return: the (partition start, file base path) of the partitions overlapping [start, end)
+        """
+        series_dir = self._series_dir(mac, sensor_type)
+        return [(partition_start, os.path.join(series_dir, str(partition_start)))
+                for partition_start in self._list_partitions(series_dir)
+                if (partition_start < end) and ((partition_start + self.partition_interval) > start)]
+
+    def _read_range(self, base: str, start: int, end: int, limit: int = None) -> tuple:
+        """
+        Binary search [start, end) in a partition's memory mapped timestamp column and read that slice
+        @return: the (timestamps, values) arrays
+        """
+        timestamps = array('q')
+        values = array('d')
+
+        n = self._column_length(base)
+        if n == 0:
+            return timestamps, values
+
+        with open(base + _TS_SUFFIX, "rb") as f:
+            with mmap.mmap(f.fileno(), n * _ITEM_SIZE, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view, view.cast('q') as column:
+                    lo = bisect_left(column, start)
+                    hi = bisect_left(column, end, lo)
+                if limit is not None:
+                    hi = min(hi, lo + limit)
+                timestamps.frombytes(mm[lo * _ITEM_SIZE:hi * _ITEM_SIZE])
+
+        with open(base + _VAL_SUFFIX, "rb") as f:
+            f.seek(lo * _ITEM_SIZE)
+            values.frombytes(f.read((hi - lo) * _ITEM_SIZE))
+
+        return timestamps, values
+
+    def query(self, mac, sensor_type: int, start: int, end: int, limit: int = None) -> tuple:
+        """
+        The raw readings of a series in [start, end)
+        @return: (timestamps, values, truncated), truncated is True if there were more than limit readings
+        """
+        query_start = time.monotonic()
+
+        timestamps = array('q')
+        values = array('d')
+        truncated = False
+
+        for partition_start, base in self._get_partitions(mac, sensor_type, start, end):
+            # one more than the limit, to tell whether there was more
+            remaining = None if (limit is None) else (limit + 1 - len(timestamps))
+            if (remaining is not None) and (remaining <= 0):
+                break
+            partition_timestamps, partition_values = self._read_range(base, start, end, remaining)
+            timestamps.extend(partition_timestamps)
+            values.extend(partition_values)
+
+        if (limit is not None) and (len(timestamps) > limit):
+            truncated = True
+            del timestamps[limit:]
+            del values[limit:]
+
+        STORE_QUERY_SECONDS.observe(time.monotonic() - query_start)
+        return timestamps, values, truncated
+
+    def query_downsampled(self, mac, sensor_type: int, start: int, end: int, bucket: int) -> list[tuple]:
+        """
+        The min/max/mean of a series per bucket milliseconds in [start, end), buckets are aligned to multiples of
+        bucket since the epoch and come from the rollups if bucket is a multiple of the rollup interval
+        @return: a list of (bucket start, min, max, mean, count) tuples, empty buckets are left out
+        """
+        query_start = time.monotonic()
+
+        buckets = dict()
+        use_rollups = (bucket % self.rollup_interval) == 0
+
+        for partition_start, base in self._get_partitions(mac, sensor_type, start, end):
+            raw_start = start
+
+            if use_rollups:
+                raw_start = self._read_rollups(base, start, end, bucket, buckets)
+
+            timestamps, values = self._read_range(base, raw_start, end)
+            for n in range(len(timestamps)):
+                value = values[n]
+                _merge_bucket(buckets, timestamps[n] - (timestamps[n] % bucket), value, value, value, 1)
+
+        STORE_QUERY_SECONDS.observe(time.monotonic() - query_start)
+        return [(bucket_start, stats[0], stats[1], stats[2] / stats[3], stats[3])
+                for bucket_start, stats in sorted(buckets.items())]
+
+    def _read_rollups(self, base: str, start: int, end: int, bucket: int, buckets: dict) -> int:
+        """
+        Merge a partition's rollup records inside [start, end) into the buckets
+        Only whole rollup buckets count, the partial ones at the edges of the range are left to the raw scan
+        @return: the time from which the raw readings have to be scanned
+        """
+        try:
+            with open(base + _ROLLUP_SUFFIX, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return start
+
+        data = data[:len(data) - (len(data) % _ROLLUP_RECORD.size)]
+
+        first_whole = start + ((-start) % self.rollup_interval)
+        covered_from = None
+        covered_until = start
+
+        for rollup_start, min_, max_, sum_, count in _ROLLUP_RECORD.iter_unpack(data):
+            if (rollup_start < first_whole) or ((rollup_start + self.rollup_interval) > end):
+                continue
+            _merge_bucket(buckets, rollup_start - (rollup_start % bucket), min_, max_, sum_, count)
+            if covered_from is None:
+                covered_from = rollup_start
+            covered_until = max(covered_until, rollup_start + self.rollup_interval)
+
+        if (covered_from is not None) and (covered_from > start):
+            # the partial rollup bucket at the start of the range comes from the raw readings
+            timestamps, values = self._read_range(base, start, covered_from)
+            for n in range(len(timestamps)):
+                value = values[n]
+                _merge_bucket(buckets, timestamps[n] - (timestamps[n] % bucket), value, value, value, 1)
+
+        return covered_until
@@ -0,0 +1,125 @@
+import json
+import math
+from array import array
+from sensor_message_item import SensorMessageItem
+
+
+def _encode_float(value: float) -> str:
+    # repr() is what the json encoder uses for finite floats, only NaN / inf need its special spelling
+    if math.isfinite(value):
+        return repr(value)
+    return json.dumps(value)
+
+
+class SensorMessageBatch:
+    """
+    A columnar container for a batch of sensor messages
+    The type, timestamp and value columns are arrays and the macs are stored once in a table,
+    so a batch of N readings is a handful of objects rather than N SensorMessageItems
+    The sinks serialize straight from the columns
+    """
+
+    def __init__(self):
+        self._mac_table: list = []
+        self._mac_index: dict = dict()
+        # the mac of each row as an index into the mac table
+        self._macs = array('H')
+        self._types = array('l')
+        self._timestamps = array('q')
+        self._values = array('d')
+
+    def __len__(self) -> int:
+        return len(self._types)
+
+    def _get_mac_idx(self, mac) -> int:
+        idx = self._mac_index.get(mac)
+        if idx is None:
+            idx = len(self._mac_table)
+            self._mac_table.append(mac)
+            self._mac_index[mac] = idx
+        return idx
+
+    def append(self, mac, sensor_type: int, value: float, timestamp: int):
+        self._macs.append(self._get_mac_idx(mac))
+        self._types.append(sensor_type)
+        self._timestamps.append(timestamp)
+        self._values.append(value)
+
+    def append_item(self, message: SensorMessageItem):
+        self.append(message.get_mac(), message.get_type(), message.get_data(), message.get_timestamp())
+
+    def extend(self, other: 'SensorMessageBatch'):
+        for n in range(len(other)):
+            self.append(other._mac_table[other._macs[n]],
+                        other._types[n],
+                        other._values[n],
+                        other._timestamps[n])
+
+    def clear(self):
+        self._mac_table.clear()
+        self._mac_index.clear()
+        del self._macs[:]
+        del self._types[:]
+        del self._timestamps[:]
+        del self._values[:]
+
+    def get_mac(self, n: int):
+        return self._mac_table[self._macs[n]]
+
+    def get_type(self, n: int) -> int:
+        return self._types[n]
+
+    def get_timestamp(self, n: int) -> int:
+        return self._timestamps[n]
+
+    def get_data(self, n: int) -> float:
+        return self._values[n]
+
+    def get_item(self, n: int) -> SensorMessageItem:
+        """
+        Materialize one row as a SensorMessageItem, for code that still wants the object form
+        """
+        return SensorMessageItem(self.get_mac(n), self._types[n], self._values[n], self._timestamps[n])
+
+    def to_api_dicts(self) -> list[dict]:
+        """
+        @return: the batch as the list of datums the API ingest expects
+        """
+        macs = self._mac_table
+        return [{'mac': macs[m], 'type': t, 'timestamp': ts, 'data': v}
+                for m, t, ts, v in zip(self._macs, self._types, self._timestamps, self._values)]
+
+    def to_json(self) -> str:
+        """
+        @return: the batch encoded as a JSON array of API datums, without building the intermediate dicts
+        """
+        macs = [json.dumps(mac) for mac in self._mac_table]
+        rows = ['{{"mac":{},"type":{},"timestamp":{},"data":{}}}'.format(macs[m], t, ts, _encode_float(v))
+                for m, t, ts, v in zip(self._macs, self._types, self._timestamps, self._values)]
+        return "[" + ",".join(rows) + "]"
+
+    @staticmethod
+    def from_api_dicts(datums: list[dict]) -> 'SensorMessageBatch':
+        batch = SensorMessageBatch()
+        for datum in datums:
+            batch.append(datum['mac'], datum['type'], datum['data'], datum['timestamp'])
+        return batch
+
+    def iter_latest_json(self, class_tag: str):
+        """
+        Encode the last row of each (mac, type) the way jsonpickle encoded a SensorMessageItem
+        (for the Redis latest value hash, where only the last write per key counts)
+        @return: a generator of (mac, type, json) tuples, one per (mac, type) in the batch
+        """
+        # (mac index, type) -> the index of its last row
+        latest = dict()
+        for n, key in enumerate(zip(self._macs, self._types)):
+            latest[key] = n
+
+        prefix = '{{"py/object": {}, "_type": '.format(json.dumps(class_tag))
+        macs = [json.dumps(mac) for mac in self._mac_table]
+        mac_table = self._mac_table
+
+        for (m, t), n in latest.items():
+            yield mac_table[m], t, '{}{}, "_mac": {}, "_timestamp": {}, "_sent": false, "_data": {}}}'.format(
+                prefix, t, macs[m], self._timestamps[n], _encode_float(self._values[n]))
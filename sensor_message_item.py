@@ -1,7 +1,14 @@
+# the longest MAC (in bytes, utf-8 encoded) a reading can carry through the processes runtime's sample ring
+MAX_MAC_LENGTH = 64
+
+
 class SensorMessageItem:
     """
     A contract for the sensor message item type
+    Slotted since we create one of these per reading, there's no per instance __dict__
     """
+    __slots__ = ("_type", "_mac", "_timestamp", "_sent", "_data")
+
     def __init__(self, mac: int = -1,
                  sensor_type: int = -1,
                  payload_data: float = -1.0,
@@ -13,7 +20,6 @@ class SensorMessageItem:
         self._timestamp = timestamp
         self._sent = sent
         self._data = payload_data
-        pass
 
     def __repr__(self):
         return("{{ sensor_type:{}, mac:{}, timestamp:{}, data:{} sent:{} }}".format(
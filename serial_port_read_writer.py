@@ -1,13 +1,21 @@
-import configparser
 import logging
 import sys
 from multiprocessing import Event
-from queue import Queue
+from queue import Queue, Full
 from threading import Thread
-from time import time
+import time
 from AretasPythonAPI.utils import Utils as AretasUtils
+from app_config import AppConfig
+from deadline_scheduler import DeadlineScheduler
+from log_utils import RATE_LIMITED
+from meter_channel import MeterChannel, load_channels
+from meter_reader import MeterReader
+from metrics import REGISTRY, mark_startup
 from sensor_message_item import SensorMessageItem
-from XDM1041Python.xdm1041main import *
+
+
+SAMPLES_TAKEN = REGISTRY.counter("pmm_samples_total", "Samples taken from the meters")
+PAYLOAD_DROPPED = REGISTRY.counter("pmm_payload_dropped_total", "Readings dropped because the payload queue was full")
 
 
 class SerialPortReadWriter(Thread):
@@ -15,74 +23,124 @@ class SerialPortReadWriter(Thread):
     This thread monitors the serial port specified in the cfg
     and injects bytes and/or payloads into the semaphore queue
     """
-    def __init__(self, payload_queue: Queue, sig_event: Event):
+    def __init__(self, payload_queue: Queue, sig_event: Event, config: AppConfig):
 
         super(SerialPortReadWriter, self).__init__()
         self.logger = logging.getLogger(__name__)
 
         self.pause_reading = False
-        # read in the global app config
-        config = configparser.ConfigParser()
-        config.read('config.cfg')
 
-        self.mac = config['DEFAULT']['self_mac']
-        self.sample_interval = int(config['SERIAL']['sample_interval'])
-        self.last_sampled = 0
+        self.sample_interval = config.sample_interval
 
-        self.thread_sleep = config.getboolean('DEFAULT', 'thread_sleep')
+        # samples are taken at absolute deadlines, see DeadlineScheduler for the overrun policies
+        self.scheduler = DeadlineScheduler(self.sample_interval,
+                                           config.get('SERIAL', 'sample_overrun_policy', fallback='skip'),
+                                           config.getboolean('SERIAL', 'sample_align', fallback=False),
+                                           config.getint('SERIAL', 'sample_max_catch_up', fallback=3))
 
         self.payload_queue = payload_queue
+        # the payload queue is bounded, if the harvester falls behind we drop rather than stall sampling
+        self.dropped_items = 0
 
         self.sig_event = sig_event
 
-        # current measurement via XDM
-        self._xdm_current_device = None
-        self._xdm_current_enabled = config.getboolean("XDM", "xdm_current_enable")
-        self._xdm_shunt_resistance = config.getfloat("XDM", "xdm_shunt_resistance")
-        self._xdm_reverse_current_polarity = config.getboolean("XDM", "xdm_current_reverse_polarity")
-
-        if self._xdm_current_enabled:
-            xdm_serial_port = config.get("XDM", "xdm_current_port")
-            # initialize the XDM device to use voltage mode since we're measuring the voltage across the shunt
-            self._xdm_current_device = XDM1041(XDM1041Mode.MODE_VOLTAGE_DC, 1, xdm_serial_port)
-            self.logger.info("Initializing XDM Meter for Current Measurement")
-            self.logger.info(self._xdm_current_device.test_conn())
-
-        # voltage measurement via XDM
-        self._xdm_voltage_device = None
-        self._xdm_voltage_enabled = config.getboolean("XDM", "xdm_voltage_enable")
-
-        if self._xdm_voltage_enabled:
-            xdm_serial_port_v = config.get("XDM", "xdm_voltage_port")
-            # initialize the XDM device to use voltage mode since we're measuring the voltage across the shunt
-            self._xdm_voltage_device = XDM1041(XDM1041Mode.MODE_VOLTAGE_DC, 5, xdm_serial_port_v)
-            self.logger.info("Initializing XDM Meter for Voltage Measurement")
-            self.logger.info(self._xdm_voltage_device.test_conn())
-
-        if (self._xdm_voltage_enabled is False) and (self._xdm_current_enabled is False):
+        # the maximum time we'll wait on the meters for a sample (in seconds), read_timeout or
+        # read_budget of the sample interval, whichever is shorter
+        self.read_timeout = config.read_timeout
+        self.read_budget = config.read_budget
+
+        # in high rate mode every sample goes into a preallocated ring buffer per sensor type and
+        # only the per report window aggregates are enqueued
+        self.high_rate_mode = config.high_rate_mode
+        self.report_interval = config.report_interval
+        self.last_flushed = 0
+
+        # the channel groups, each one a MAC with its current and/or voltage meter, all sampled on the same tick
+        self.channels: list[MeterChannel] = load_channels(config, sig_event)
+
+        if len(self.get_meter_readers()) == 0:
             self.logger.error("Neither voltage or current are enabled, nothing to do... exiting.")
             sys.exit(0)
 
+        self.logger.info("Sampling {} meters on {} channels".format(len(self.get_meter_readers()), len(self.channels)))
+
+    def get_meter_readers(self) -> list[MeterReader]:
+        return [reader for channel in self.channels for reader in channel.get_meter_readers()]
+
+    def apply_config(self, config: AppConfig):
+        """
+        Pick up the reloadable settings (see ConfigWatcher), the meter readers and their ports keep running
+        """
+        if config.sample_interval != self.sample_interval:
+            self.sample_interval = config.sample_interval
+            self.scheduler.set_interval(self.sample_interval)
+
+        self.read_timeout = config.read_timeout
+        self.read_budget = config.read_budget
+        self.report_interval = config.report_interval
+
+        for channel in self.channels:
+            channel.apply_config(config)
+
     def run(self):
+        for reader in self.get_meter_readers():
+            reader.start()
+        mark_startup('sampler')
+
         # enqueue bytes into the self.message_queue
-        while True:
-            if not self.pause_reading:
-                # use the aretas utility function to ensure consistency
-                now_ms = AretasUtils.now_ms()
+        # the scheduler blocks until the next absolute deadline, a shutdown sets the event and wakes us immediately
+        while self.scheduler.wait_next(self.sig_event):
+            if self.pause_reading:
+                # skip this tick and allow UART to "settle"
+                continue
+
+            self.take_sample()
+
+        self.finish()
+        # wake the harvester, which is blocked on the queue
+        self.enqueue(None)
 
-                if (now_ms - self.last_sampled) > self.sample_interval:
-                    self.read_port()
-                    self.last_sampled = now_ms
-                else:
-                    time.sleep(0.05)
+    def take_sample(self, samples: list[tuple] = None):
+        """
+        Take (or, given the acquired samples, process) one sample on every channel and flush the aggregates
+        when they're due
+        @param samples: the (current, current_ts, voltage, voltage_ts) tuple of each channel, acquired here if None
+        """
+        if self.high_rate_mode is True:
+            self.record_sample(samples)
+        else:
+            self.read_port(samples)
+        SAMPLES_TAKEN.inc()
+        mark_startup('first_sample')
 
-                if self.sig_event.is_set():
-                    self.logger.info("Exiting {}".format(
-                        self.__class__.__name__))
-                    break
-            else:
+        # use the aretas utility function to ensure consistency
+        now_ms = AretasUtils.now_ms()
 
-                time.sleep(0.01)  # sleep for 10ms and allow UART to "settle"
+        if (self.high_rate_mode is True) and ((now_ms - self.last_flushed) >= self.report_interval):
+            self.flush_aggregates()
+            self.last_flushed = now_ms
+
+    def finish(self):
+        """
+        Stop the meter workers and checkpoint the energy counters on the way out
+        """
+        stats = self.scheduler.get_stats()
+        self.logger.info("Exiting {} after {} samples, {} overruns, {} skipped, jitter mean:{:.4f}s max:{:.4f}s".format(
+            self.__class__.__name__, stats['ticks'], stats['overruns'], stats['skipped'],
+            stats['jitter_mean'], stats['jitter_max']))
+        for reader in self.get_meter_readers():
+            reader.stop()
+        for channel in self.channels:
+            channel.checkpoint()
+
+    def enqueue(self, item: SensorMessageItem):
+        try:
+            self.payload_queue.put_nowait(item)
+        except Full:
+            self.dropped_items += 1
+            PAYLOAD_DROPPED.inc()
+            if (self.dropped_items % 100) == 1:
+                self.logger.error("Payload queue full, dropped {} items so far".format(self.dropped_items))
 
     def write_cmd(self, cmd: bytes):
         """
@@ -98,77 +156,80 @@ class SerialPortReadWriter(Thread):
         self.pause_reading = False
         pass
 
-    def read_port(self):
+    def read_port(self, samples: list[tuple] = None):
         """
         Fetch the XDM parameters, populate the SensorMessageItem contract and enqueue the messages
 
         @return:
         """
-        payload_items = self.do_fetch_params()
+        payload_items = self.do_fetch_params(samples)
 
         if payload_items is not None:
 
             for item in payload_items:
-                self.logger.debug(item)
-                self.payload_queue.put(item)
+                self.logger.debug(item, extra=RATE_LIMITED)
+                self.enqueue(item)
 
-            self.logger.info("Enqueued {} items".format(len(payload_items)))
+            self.logger.info("Enqueued {} items".format(len(payload_items)), extra=RATE_LIMITED)
         else:
             self.logger.error("Could not fetch XDM params")
 
-    def do_fetch_params(self) -> list[SensorMessageItem]:
+    def record_sample(self, samples: list[tuple] = None):
         """
-        Fetch current and voltage from XDM (if enabled)
-        if both are enabled, also return kW
-        @return: a list of SensorMessageItems
+        High rate mode: take a sample and write it straight into each channel's ring buffers,
+        no SensorMessageItems are allocated per reading, the threshold crossings are enqueued right away
         """
-        xdm_current_meas = None
-        xdm_voltage_meas = None
-
-        try:
+        if samples is None:
+            samples = self.acquire()
 
-            # several of these checks below are obnoxious and a remnant from the previous repo
-            # where we had the BMS params and wanted to support optional XDM1041s
-            # I'm going to keep things similar though so we can still have the flexibility of
-            # supporting one, both or none :D
-            if self._xdm_current_enabled and (self._xdm_current_device is not None):
+        for channel, sample in zip(self.channels, samples):
+            for item in channel.record_sample(sample):
+                self.enqueue(item)
 
-                xdm_voltage = self._xdm_current_device.read_val1_raw()
-                # apply I = V / R
-                xdm_current_meas = xdm_voltage / self._xdm_shunt_resistance
-                if self._xdm_reverse_current_polarity:
-                    xdm_current_meas = xdm_current_meas * -1.0
-
-            if self._xdm_voltage_enabled and (self._xdm_voltage_device is not None):
-                xdm_voltage_meas = self._xdm_voltage_device.read_val1_raw()
-
-        except ValueError as ve:
-            self.logger.error("Error reading XDM current device:{}".format(ve))
-        except serial.serialutil.SerialTimeoutException as ste:
-            self.logger.error("Error on XDM serial port:{}".format(ste))
-
-        ret = list()
+    def flush_aggregates(self):
+        """
+        High rate mode: enqueue the last/min/max/mean/RMS/count of the samples recorded since the last flush
+        """
+        payload_items = []
+        for channel in self.channels:
+            payload_items.extend(channel.flush_aggregates())
 
-        now = AretasUtils.now_ms()
+        for item in payload_items:
+            self.enqueue(item)
 
-        try:
+        self.logger.info("Enqueued {} aggregate items".format(len(payload_items)), extra=RATE_LIMITED)
 
-            if xdm_voltage_meas is not None:
-                msg_voltage = SensorMessageItem(self.mac, 532, float(xdm_voltage_meas), now)
-                ret.append(msg_voltage)
+    def get_read_deadline(self) -> float:
+        """
+        @return: when (on the time.monotonic() clock) the sample's read budget is up, every meter shares it
+        """
+        return time.monotonic() + min(self.read_timeout, self.read_budget * self.sample_interval / 1000)
 
-            if xdm_current_meas is not None:
-                msg_current = SensorMessageItem(self.mac, 531, float(xdm_current_meas), now)
-                ret.append(msg_current)
+    def acquire(self) -> list[tuple]:
+        """
+        Read current and voltage from every channel
+        All the meters are triggered together and read concurrently by their MeterReader workers,
+        a reading that misses the read budget is reported missing, and stale on the next sample
+        @return: a (current, current_ts, voltage, voltage_ts) tuple per channel, the values are None if not available
+        """
+        # kick off every meter before waiting on any of them
+        for channel in self.channels:
+            channel.trigger()
 
-            if (xdm_current_meas is not None) and (xdm_voltage_meas is not None):
-                # compute power for energy consumption calculations
-                kw = (float(xdm_voltage_meas) * float(xdm_current_meas)) / 1000
-                msg_kw = SensorMessageItem(self.mac, 533, kw, now)
-                ret.append(msg_kw)
+        deadline = self.get_read_deadline()
+        return [channel.wait_sample(deadline) for channel in self.channels]
 
-        except Exception as e:
+    def do_fetch_params(self, samples: list[tuple] = None) -> list[SensorMessageItem]:
+        """
+        Fetch current and voltage from every channel (see MeterChannel.get_messages)
+        @param samples: the already acquired sample of each channel, acquired here if None
+        @return: a list of SensorMessageItems
+        """
+        if samples is None:
+            samples = self.acquire()
 
-            self.logger.error("Unknown exception trying to decode BMS params:{}".format(e))
+        ret = list()
+        for channel, sample in zip(self.channels, samples):
+            ret.extend(channel.get_messages(sample))
 
         return ret
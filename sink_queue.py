@@ -0,0 +1,172 @@
+import time
+from collections import deque, OrderedDict
+from threading import Condition
+from sensor_message_item import SensorMessageItem
+
+POLICY_BLOCK = "block"
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_COALESCE = "coalesce"
+
+OVERFLOW_POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_COALESCE)
+
+
+class SinkQueue:
+    """
+    A bounded queue between the harvester and one sink, with a per sink overflow policy:
+     * block: put() waits for room, applying backpressure to the harvester
+     * drop_oldest: the oldest queued message is discarded to make room
+     * coalesce: only the latest message per (mac, type) is kept, if there are more distinct
+       keys than the capacity the oldest key is discarded
+    The queue also tracks the counters we need to report the sink's lag
+    """
+
+    def __init__(self, name: str, capacity: int, policy: str):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {} for sink {}, expected one of {}".format(
+                policy, name, OVERFLOW_POLICIES))
+
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+
+        self._cond = Condition()
+        self._closed = False
+
+        # entries are (enqueue time, message), coalesced entries are keyed by (mac, type)
+        if policy == POLICY_COALESCE:
+            self._entries = OrderedDict()
+        else:
+            self._entries = deque()
+
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_watermark = 0
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._entries)
+
+    def put(self, message: SensorMessageItem, block: bool = True):
+        """
+        @param block: with the block policy, whether to wait for room, if False a message that doesn't fit
+        is dropped (and counted as such) instead
+        """
+        with self._cond:
+            if self._closed:
+                return
+
+            if self.policy == POLICY_COALESCE:
+                key = (message.get_mac(), message.get_type())
+                entry = self._entries.get(key)
+                if entry is not None:
+                    # keep the original position and enqueue time, so the lag still reflects the oldest data
+                    self._entries[key] = (entry[0], message)
+                    self.coalesced += 1
+                    self.enqueued += 1
+                    self._cond.notify()
+                    return
+
+                if len(self._entries) >= self.capacity:
+                    self._entries.popitem(last=False)
+                    self.dropped += 1
+
+                self._entries[key] = (time.monotonic(), message)
+
+            else:
+                if len(self._entries) >= self.capacity:
+                    if (self.policy == POLICY_BLOCK) and (block is False):
+                        self.dropped += 1
+                        return
+                    elif self.policy == POLICY_BLOCK:
+                        while (len(self._entries) >= self.capacity) and (self._closed is False):
+                            self._cond.wait()
+                        if self._closed:
+                            return
+                    else:
+                        self._entries.popleft()
+                        self.dropped += 1
+
+                self._entries.append((time.monotonic(), message))
+
+            self.enqueued += 1
+            self.high_watermark = max(self.high_watermark, len(self._entries))
+            self._cond.notify_all()
+
+    def put_nowait(self, message: SensorMessageItem):
+        self.put(message, block=False)
+
+    def _pop(self) -> SensorMessageItem:
+        if self.policy == POLICY_COALESCE:
+            _, (_, message) = self._entries.popitem(last=False)
+        else:
+            _, message = self._entries.popleft()
+        self.dequeued += 1
+        # wake a blocked producer
+        self._cond.notify_all()
+        return message
+
+    def get(self, timeout: float = None):
+        """
+        Block until a message is available
+        @param timeout: seconds to wait, None waits until a message arrives or the queue is closed
+        @return: the oldest message, or None on timeout or once the queue is closed and empty
+        """
+        with self._cond:
+            if timeout is None:
+                while (len(self._entries) == 0) and (self._closed is False):
+                    self._cond.wait()
+            elif len(self._entries) == 0:
+                self._cond.wait_for(lambda: (len(self._entries) > 0) or self._closed, timeout)
+
+            if len(self._entries) == 0:
+                return None
+
+            return self._pop()
+
+    def drain(self, max_items: int) -> list[SensorMessageItem]:
+        """
+        @return: up to max_items of the queued messages without blocking
+        """
+        ret = []
+        with self._cond:
+            while (len(self._entries) > 0) and (len(ret) < max_items):
+                ret.append(self._pop())
+        return ret
+
+    def close(self):
+        """
+        Stop accepting messages and wake everyone waiting on the queue
+        The consumer still gets the messages that were queued before the close
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def get_lag(self) -> float:
+        """
+        @return: how long (in seconds) the oldest queued message has been waiting
+        """
+        with self._cond:
+            if len(self._entries) == 0:
+                return 0.0
+            if self.policy == POLICY_COALESCE:
+                enqueue_time = next(iter(self._entries.values()))[0]
+            else:
+                enqueue_time = self._entries[0][0]
+            return time.monotonic() - enqueue_time
+
+    def get_stats(self) -> dict:
+        return {
+            'depth': len(self),
+            'high_watermark': self.high_watermark,
+            'enqueued': self.enqueued,
+            'dequeued': self.dequeued,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'lag': self.get_lag()
+        }
@@ -0,0 +1,108 @@
+import json
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import urlparse, parse_qs
+from sample_store import SampleStore
+
+
+class StoreQueryServer(Thread):
+    """
+    The local HTTP query API over the SampleStore
+     * GET /series: the (mac, type) of every stored series
+     * GET /query?mac=<mac>&type=<type>[&start=<ms>][&end=<ms>][&bucket=<ms>][&limit=<n>]: the readings in
+       [start, end) (the last hour by default), raw or, with bucket, as min/max/mean/count per bucket
+    Everything is JSON, timestamps are in milliseconds since the epoch
+    """
+
+    def __init__(self, store: SampleStore, host: str, port: int, max_points: int = 100000):
+        super(StoreQueryServer, self).__init__(name="StoreQueryServer", daemon=True)
+
+        self.logger = logging.getLogger(__name__)
+        self.store = store
+        # the most readings or buckets a single query returns
+        self.max_points = max_points
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                try:
+                    if url.path == '/series':
+                        body = server.get_series()
+                    elif url.path == '/query':
+                        body = server.query({key: values[-1] for key, values in parse_qs(url.query).items()})
+                    else:
+                        self.reply(404, {'error': "Unknown path {}".format(url.path)})
+                        return
+                except ValueError as e:
+                    self.reply(400, {'error': str(e)})
+                    return
+                except Exception as e:
+                    server.logger.error("Error answering query {}:{}".format(self.path, e))
+                    self.reply(500, {'error': str(e)})
+                    return
+
+                self.reply(200, body)
+
+            def reply(self, status: int, body: dict):
+                data = json.dumps(body, separators=(',', ':')).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def get_series(self) -> dict:
+        return {'series': [{'mac': mac, 'type': sensor_type} for mac, sensor_type in self.store.get_series()]}
+
+    def query(self, params: dict) -> dict:
+        """
+        @param params: the query string parameters
+        @return: the response body, raises ValueError for a bad query
+        """
+        if ('mac' not in params) or ('type' not in params):
+            raise ValueError("mac and type are required")
+
+        mac = params['mac']
+        sensor_type = int(params['type'])
+        end = int(params.get('end', int(time.time() * 1000)))
+        start = int(params.get('start', end - 3600000))
+        limit = min(int(params.get('limit', self.max_points)), self.max_points)
+
+        if end <= start:
+            raise ValueError("end has to be after start")
+
+        ret = {'mac': mac, 'type': sensor_type, 'start': start, 'end': end}
+
+        if 'bucket' in params:
+            bucket = int(params['bucket'])
+            if bucket <= 0:
+                raise ValueError("bucket has to be positive")
+            if ((end - start) // bucket) > limit:
+                raise ValueError("{} buckets of {}ms is over the limit of {}, use larger buckets".format(
+                    (end - start) // bucket, bucket, limit))
+            ret['bucket'] = bucket
+            ret['buckets'] = [list(row) for row in self.store.query_downsampled(mac, sensor_type, start, end, bucket)]
+        else:
+            timestamps, values, truncated = self.store.query(mac, sensor_type, start, end, limit)
+            ret['points'] = [list(point) for point in zip(timestamps, values)]
+            ret['truncated'] = truncated
+
+        return ret
+
+    def run(self):
+        self.logger.info("Serving store queries on {}:{}".format(*self.server.server_address))
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()